@@ -0,0 +1,59 @@
+'''
+Time writing 20 years of daily prices for a symbol with one upsert a record
+against MongoTimeseries.set's unordered bulk batches.
+
+    python examples/mongo_bulk_benchmark.py [host:port] [days]
+
+host:port defaults to mongomock, an in-process stand in without network
+round trips that scans the collection for every upsert, so it understates
+the difference a real mongod shows. days defaults to 5000, use fewer with
+mongomock.
+'''
+import sys
+import time
+import datetime
+import pymongo
+from financial_fundamentals.mongo_drivers import MongoTimeseries
+
+
+def get_collection(address):
+    if address == 'mongomock':
+        import mongomock
+        client = mongomock.MongoClient()
+    else:
+        host, port = address.split(':')
+        client = pymongo.MongoClient(host, int(port))
+    collection = client.benchmark.prices
+    collection.drop()
+    return collection
+
+def update_each(collection, symbol, records):
+    '''how MongoTimeseries.set used to write, a round trip a record.'''
+    for date, value in records:
+        key = {'symbol' : symbol, 'date' : date}
+        collection.update(key, dict(key, price=value), upsert=True)
+
+def timed(function, *args):
+    start = time.time()
+    function(*args)
+    return time.time() - start
+
+if __name__ == '__main__':
+    address = sys.argv[1] if len(sys.argv) > 1 else 'mongomock'
+    days = int(sys.argv[2]) if len(sys.argv) > 2 else 5000
+    first_date = datetime.datetime(1994, 1, 3)
+    records = [(first_date + datetime.timedelta(days=i), float(i)) for i in range(days)]
+    collection = get_collection(address)
+    update_time = timed(update_each, collection, 'ABC', records)
+    print '{} records, update each: {:.2f}s, {} round trips'.format(days,
+                                                                    update_time,
+                                                                    days)
+    for batch_size in (100, 1000):
+        collection = get_collection(address)
+        driver = MongoTimeseries(collection, 'price', batch_size=batch_size)
+        elapsed = timed(driver.set, 'ABC', records)
+        print 'bulk batches of {}: {:.2f}s, {} round trips, speedup {:.2f}'.format(
+                                                            batch_size,
+                                                            elapsed,
+                                                            -(-days // batch_size),
+                                                            update_time / elapsed)
@@ -0,0 +1,41 @@
+'''
+Time parsing a corpus of XBRL instances with pools of 1 to n processes.
+
+    python examples/parse_benchmark.py [corpus_dir] [copies]
+
+corpus_dir defaults to the test fixtures, each document is parsed copies times.
+'''
+import os
+import sys
+import time
+import multiprocessing
+from financial_fundamentals.xbrl import extract_concurrently
+from financial_fundamentals.accounting_metrics import REGISTERED_METRICS
+
+
+def load_corpus(corpus_dir, copies):
+    contents = []
+    for file_name in sorted(os.listdir(corpus_dir)):
+        if file_name.endswith('.xml'):
+            with open(os.path.join(corpus_dir, file_name), 'rb') as f:
+                contents.append(f.read())
+    return contents * copies
+
+def benchmark(contents, processes):
+    start = time.time()
+    for _ in extract_concurrently(contents, REGISTERED_METRICS, processes=processes):
+        pass
+    return time.time() - start
+
+if __name__ == '__main__':
+    default_corpus = os.path.join(os.path.dirname(__file__), '..', 'tests', 'assets')
+    corpus_dir = sys.argv[1] if len(sys.argv) > 1 else default_corpus
+    copies = int(sys.argv[2]) if len(sys.argv) > 2 else 16
+    contents = load_corpus(corpus_dir, copies)
+    serial_time = benchmark(contents, processes=1)
+    print '{} documents, 1 process: {:.2f}s'.format(len(contents), serial_time)
+    for processes in range(2, multiprocessing.cpu_count() + 1):
+        elapsed = benchmark(contents, processes=processes)
+        print '{} processes: {:.2f}s, speedup {:.2f}'.format(processes,
+                                                            elapsed,
+                                                            serial_time / elapsed)
@@ -0,0 +1,79 @@
+'''
+Time reading every symbol's prices from a price table laid out the old way,
+timestamp dates in a rowid table with a separate index, then migrate it in
+place and time the same reads through SQLiteTimeseries.
+
+    python examples/timeseries_benchmark.py [symbols] [days]
+
+The database is built in a temporary file, symbols defaults to 200 and days
+to 2500, about ten years of trading days.
+'''
+import os
+import sys
+import time
+import random
+import tempfile
+import datetime
+import numpy as np
+import pytz
+from financial_fundamentals.sqlite_drivers import SQLiteTimeseries, SQLiteDriver
+
+METRIC = 'Adj Close'
+V1_STMTS = ('CREATE TABLE price (date timestamp, symbol text, metric text, value real)',
+            'CREATE INDEX time_series_index ON price (date, symbol, metric)',
+            )
+V1_QUERY = '''SELECT substr(date, 1, 19), value FROM price
+              WHERE symbol = ? AND metric = ? AND date BETWEEN ? AND ?
+              ORDER BY date
+           '''
+
+def build_v1(connection, symbols, dates):
+    for stmt in V1_STMTS:
+        connection.execute(stmt)
+    # rows arrive a day at a time, as they did from the daily downloads.
+    rows = ((date, symbol, METRIC, random.random()) for
+            date in dates for symbol in symbols)
+    with connection:
+        connection.executemany('INSERT INTO price VALUES (?, ?, ?, ?)', rows)
+
+def read_v1(connection, symbols, dates):
+    for symbol in symbols:
+        rows = connection.execute(V1_QUERY, (symbol, METRIC, dates[0], dates[-1])).fetchall()
+        np.array([row[0] for row in rows], dtype='datetime64[ns]')
+        np.array([row[1] for row in rows], dtype=float)
+
+def read_v2(driver, symbols, dates):
+    dates = np.array([date.replace(tzinfo=None) for date in dates], dtype='datetime64[ns]')
+    for symbol in symbols:
+        driver.get_array(symbol=symbol, dates=dates)
+
+def timed(function, *args):
+    start = time.time()
+    function(*args)
+    return time.time() - start
+
+if __name__ == '__main__':
+    symbol_count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    day_count = int(sys.argv[2]) if len(sys.argv) > 2 else 2500
+    symbols = ['S{:04d}'.format(i) for i in range(symbol_count)]
+    first_date = datetime.datetime(2000, 1, 3, tzinfo=pytz.UTC)
+    dates = [first_date + datetime.timedelta(days=i) for i in range(day_count)]
+    handle, path = tempfile.mkstemp(suffix='.sqlite')
+    os.close(handle)
+    try:
+        connection = SQLiteDriver.connect(path)
+        build_v1(connection, symbols, dates)
+        print '{} symbols x {} days, {:.1f}MB'.format(symbol_count, day_count,
+                                                      os.path.getsize(path) / 1e6)
+        v1_time = timed(read_v1, connection, symbols, dates)
+        print 'timestamp rowid table: {:.2f}s'.format(v1_time)
+        migrate_time = timed(SQLiteTimeseries, connection, 'price', METRIC)
+        driver = SQLiteTimeseries(connection=connection, table='price', metric=METRIC)
+        print 'migrated in {:.2f}s, {:.1f}MB'.format(migrate_time,
+                                                     os.path.getsize(path) / 1e6)
+        v2_time = timed(read_v2, driver, symbols, dates)
+        print 'epoch day WITHOUT ROWID table: {:.2f}s, speedup {:.2f}'.format(v2_time,
+                                                                             v1_time / v2_time)
+        connection.close()
+    finally:
+        os.remove(path)
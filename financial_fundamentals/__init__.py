@@ -6,4 +6,6 @@ Created on Sep 9, 2013
 from caches import sqlite_fundamentals_cache
 from caches import sqlite_price_cache
 from caches import mongo_fundamentals_cache
-from caches import mongo_price_cache
\ No newline at end of file
+from caches import mongo_price_cache
+from caches import sqlite_price_fields_cache
+from caches import mongo_price_fields_cache
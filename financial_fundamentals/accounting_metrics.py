@@ -4,7 +4,12 @@ Created on Jan 26, 2013
 @author: akittredge
 '''
 import datetime
+from collections import OrderedDict
+from itertools import izip
+import numpy as np
 from financial_fundamentals.edgar import HTMLEdgarDriver
+from financial_fundamentals.xbrl import MetricNodeNotFound, extract_concurrently
+from financial_fundamentals import document_store, sessions
                       
 class AccountingMetric(object):
     '''Parent class for accounting metrics.'''
@@ -19,6 +24,15 @@ class QuarterlyEPS(EPS):
 
 class AnnualEPS(EPS):
     filing_type = '10-K'
+    name = 'annual_eps'
+
+# Metrics extracted together, one pass over a filing finds all of its 
+# filing type's metrics and keeps them on the Filing for the rest of the 
+# process. Each filing type has one metric so far, a second 10-Q or 10-K 
+# metric registered here is read from the same parse while the Filing is in
+# memory. Only the getter's own metric is written to its cache, another 
+# process parses the filing again.
+REGISTERED_METRICS = [QuarterlyEPS, AnnualEPS]
 #===============================================================================
 # Book Value per-share is currently broken.
 #
@@ -50,10 +64,19 @@ class AccountingMetricGetter(object):
     '''Connect accounting metrics to sources of accounting metrics.
     
     '''
-    def __init__(self, metric, filing_getter=HTMLEdgarDriver):
+    def __init__(self, metric, filing_getter=HTMLEdgarDriver, 
+                 metrics=REGISTERED_METRICS):
+        '''The metrics with the same filing type as metric are extracted 
+        along with it and kept on the filings, in memory, for getters of
+        those metrics to read.
+        
+        '''
         self._metric = metric
         self._filing_getter = filing_getter
         self.metric_name  = self._metric.name
+        self._metrics = [metric] + [other for other in metrics if 
+                                    other is not metric and 
+                                    other.filing_type == metric.filing_type]
         
     def get_data(self, symbol, date):
         date = datetime.date(date.year, date.month, date.day)
@@ -65,5 +88,94 @@ class AccountingMetricGetter(object):
         if filing.next_filing:
             assert date <= filing.next_filing.date
         return (filing.date, 
-                filing.latest_metric_value(self._metric), 
-                filing.next_filing and filing.next_filing.date)
\ No newline at end of file
+                self._value_from_filing(filing), 
+                filing.next_filing and filing.next_filing.date)
+
+    def get_all_data(self, symbol):
+        '''Return a (start, value, end) interval for every one of the symbol's
+        filings, the value is NaN for filings that do not report the metric.
+        
+        '''
+        filings = self._filing_getter.get_filings(ticker=symbol,
+                                                  filing_type=self._metric.filing_type)
+        # download the instances concurrently before they're parsed one by one.
+        self._prefetch([filing for filing in filings 
+                        if not filing.has_extracted(self._metrics)])
+        return self._intervals(filings)
+
+    def get_new_data(self, symbol):
+        '''Return (start, value, end) intervals for the symbol's filings made
+        since the filing getter last looked, see HTMLEdgarDriver.refresh.
+        
+        '''
+        new_filings = self._filing_getter.refresh(ticker=symbol,
+                                                  filing_type=self._metric.filing_type)
+        self._prefetch(new_filings)
+        return self._intervals(new_filings)
+
+    def iter_all_data(self, symbols, processes=None):
+        '''Yield (symbol, intervals) pairs, intervals as returned by get_all_data,
+        for each of symbols. The XBRL instances are downloaded concurrently and
+        parsed by a pool of processes, a symbol is yielded as soon as all of
+        its filings are parsed. Each instance is parsed once, however many 
+        of symbols, or of their filings, share it.
+        
+        '''
+        symbol_filings = [(symbol, 
+                           self._filing_getter.get_filings(ticker=symbol,
+                                                           filing_type=self._metric.filing_type))
+                          for symbol in symbols]
+        unparsed = OrderedDict((id(filing), filing) for _, filings in symbol_filings 
+                               for filing in filings 
+                               if not filing.has_extracted(self._metrics)).values()
+        xbrl_urls = self._xbrl_urls(unparsed)
+        url_filings = OrderedDict()
+        for filing, xbrl_url in zip(unparsed, xbrl_urls):
+            if xbrl_url is None:
+                # there's no instance document, the filing doesn't report anything.
+                filing.set_extracted(self._metrics, {})
+            else:
+                url_filings.setdefault(xbrl_url, []).append(filing)
+        contents = document_store.iter_documents(url_filings.keys())
+        # results come back in the order the documents were sent.
+        extracted = izip(url_filings.itervalues(),
+                         extract_concurrently(contents, self._metrics, processes=processes))
+        for symbol, filings in symbol_filings:
+            for filing in filings:
+                while not filing.has_extracted(self._metrics):
+                    same_document_filings, values = next(extracted)
+                    for same_document_filing in same_document_filings:
+                        same_document_filing.set_extracted(self._metrics, values)
+            yield symbol, self._intervals(filings)
+
+    def _prefetch(self, filings):
+        '''Download the filings' instance documents concurrently into the 
+        document store, return their urls. Without a store configured the 
+        documents are downloaded one by one as they're parsed.
+        
+        '''
+        xbrl_urls = self._xbrl_urls(filings)
+        document_store.prefetch(xbrl_urls)
+        return xbrl_urls
+
+    def _xbrl_urls(self, filings):
+        '''Resolve the filings' instance urls concurrently.'''
+        return sessions.concurrent_map(lambda filing : filing.xbrl_url, filings)
+
+    def _intervals(self, filings):
+        intervals = []
+        for filing in filings:
+            try:
+                value = self._value_from_filing(filing)
+            except MetricNodeNotFound:
+                value = np.nan
+            intervals.append((filing.date,
+                              value,
+                              filing.next_filing and filing.next_filing.date))
+        return intervals
+
+    def _value_from_filing(self, filing):
+        try:
+            return filing.extract(self._metrics)[self._metric]
+        except KeyError:
+            raise MetricNodeNotFound('{} not in {}'.format(self.metric_name, filing))
@@ -1,50 +1,123 @@
-import pymongo
 from financial_fundamentals.mongo_drivers import MongoIntervalseries,\
-    MongoTimeseries
+    MongoTimeseries, MongoBucketTimeseries, get_client
 from financial_fundamentals.time_series_cache import FinancialIntervalCache,\
-    FinancialDataTimeSeriesCache
-from financial_fundamentals.prices import get_prices_from_yahoo
+    FinancialDataTimeSeriesCache, FinancialDataFieldsCache
+from financial_fundamentals.prices import YahooPriceSource
 
 
 import os
 from financial_fundamentals import sqlite_drivers
+from financial_fundamentals import document_store
 from financial_fundamentals.accounting_metrics import AccountingMetricGetter
-from financial_fundamentals.edgar import HTMLEdgarDriver
+from financial_fundamentals.edgar import HTMLEdgarDriver, read_company_tickers
+from financial_fundamentals.xbrl import XBRLDocument
+from financial_fundamentals.mongo_drivers import MongoFactStore
 
 
 def mongo_fundamentals_cache(metric, mongo_host='localhost', mongo_port=27017,
-                             filing_getter=HTMLEdgarDriver):
-    mongo_client = pymongo.MongoClient(mongo_host, mongo_port)
+                             filing_getter=HTMLEdgarDriver, backfill=False,
+                             filing_index_path=None, persist_facts=False,
+                             document_store_path=None,
+                             company_tickers_path=None):
+    if document_store_path:
+        document_store.configure(directory=document_store_path)
+    if filing_index_path:
+        connection = sqlite_drivers.SQLiteFilingIndex.connect(filing_index_path)
+        filing_getter.use_persistent_index(
+                        sqlite_drivers.SQLiteFilingIndex(connection=connection))
+        _use_ticker_ciks(filing_getter, connection, company_tickers_path)
+    mongo_client = get_client(mongo_host, mongo_port)
+    if persist_facts:
+        XBRLDocument.use_fact_store(MongoFactStore(mongo_client.fundamentals.facts))
     mongo_collection = mongo_client.fundamentals.fundamentals
     db = MongoIntervalseries(mongo_collection=mongo_collection, 
                          metric=metric.name)
     metric_getter = AccountingMetricGetter(metric=metric,
                                            filing_getter=filing_getter)
-    cache = FinancialIntervalCache(get_data=metric_getter.get_data, database=db)
+    cache = FinancialIntervalCache(get_data=metric_getter.get_data, 
+                                   database=db,
+                                   get_all_data=metric_getter.get_all_data if backfill else None,
+                                   get_new_data=metric_getter.get_new_data)
     return cache
 
-def mongo_price_cache(mongo_host='localhost', mongo_port=27017):
-    client = pymongo.MongoClient(mongo_host, mongo_port)
-    collection = client.prices.prices
-    db = MongoTimeseries(mongo_collection=collection, metric='price')
-    cache = FinancialDataTimeSeriesCache(gets_data=get_prices_from_yahoo, 
+def mongo_price_cache(mongo_host='localhost', mongo_port=27017, source=None, 
+                      bucketed=False):
+    '''Return a cache that stores prices in mongo, a document a day or, 
+    bucketed, a document a year in prices.price_buckets. 
+    mongo_drivers.migrate_to_buckets copies prices stored a document a day.
+    
+    '''
+    client = get_client(mongo_host, mongo_port)
+    if bucketed:
+        db = MongoBucketTimeseries(mongo_collection=client.prices.price_buckets, 
+                                   metric='price')
+    else:
+        db = MongoTimeseries(mongo_collection=client.prices.prices, metric='price')
+    cache = FinancialDataTimeSeriesCache(gets_data=source or YahooPriceSource(), 
                                          database=db)
     return cache
 
 DEFAULT_PRICE_PATH = os.path.join(os.path.expanduser('~'), '.prices.sqlite')
-def sqlite_price_cache(db_file_path=DEFAULT_PRICE_PATH):
-    '''Return a cache that persists prices downloaded from yahoo.
+def sqlite_price_cache(db_file_path=DEFAULT_PRICE_PATH, source=None):
+    '''Return a cache that persists prices downloaded from yahoo, or read 
+    from source, a PriceSource e.g. a CSVPriceSource.
     
     '''
     return FinancialDataTimeSeriesCache.build_sqlite_price_cache(sqlite_file_path=db_file_path, 
                                                                  table='prices', 
-                                                                 metric='Adj Close')
+                                                                 metric='Adj Close',
+                                                                 source=source)
+
+def mongo_price_fields_cache(mongo_host='localhost', mongo_port=27017, source=None):
+    '''Return a cache that stores every price field downloaded from yahoo,
+    see FinancialDataFieldsCache.load_from_cache.
+    
+    '''
+    return FinancialDataFieldsCache.build_mongo_price_cache(mongo_host=mongo_host,
+                                                            mongo_port=mongo_port,
+                                                            source=source)
+
+def sqlite_price_fields_cache(db_file_path=DEFAULT_PRICE_PATH, source=None):
+    '''Return a cache that persists every price field downloaded from yahoo,
+    open, high, low, close, volume and adjusted close, in one row per day.
+    
+    '''
+    return FinancialDataFieldsCache.build_sqlite_price_cache(sqlite_file_path=db_file_path,
+                                                             table='price_fields',
+                                                             source=source)
 
 DEFAULT_FUNDAMENTALS_PATH = os.path.join(os.path.expanduser('~'), '.fundamentals.sqlite')
 def sqlite_fundamentals_cache(metric, 
                               db_file_path=DEFAULT_FUNDAMENTALS_PATH, 
-                              filing_getter=HTMLEdgarDriver):
+                              filing_getter=HTMLEdgarDriver,
+                              backfill=False,
+                              persist_filing_index=False,
+                              persist_facts=False,
+                              document_store_path=None,
+                              company_tickers_path=None):
+    '''Return a cache that persists accounting metrics extracted from Edgar.
+    With backfill the first miss for a symbol caches every one of its filings.
+    With persist_filing_index the filings found in Edgar are stored in a 
+    filings table next to the fundamentals table, with persist_facts every 
+    numeric fact in the XBRL documents parsed is stored in a facts table.
+    Both are installed on filing_getter and XBRLDocument for the rest of the 
+    process, so they're off unless asked for. With document_store_path, 
+    Edgar pages and XBRL documents are kept under it for every download in 
+    the process, nothing is stored by default.
+    The filing index also keeps a ticker_ciks table, company_tickers_path is 
+    a company_tickers.json from Edgar to load into it, Edgar is searched by
+    the CIKs it knows.
+    
+    '''
+    if document_store_path:
+        document_store.configure(directory=document_store_path)
     connection = sqlite_drivers.SQLiteIntervalseries.connect(db_file_path)
+    if persist_filing_index:
+        filing_getter.use_persistent_index(
+                        sqlite_drivers.SQLiteFilingIndex(connection=connection))
+        _use_ticker_ciks(filing_getter, connection, company_tickers_path)
+    if persist_facts:
+        XBRLDocument.use_fact_store(sqlite_drivers.SQLiteFactStore(connection=connection))
     driver = sqlite_drivers.SQLiteIntervalseries(connection=connection,
                                                  table='fundamentals',
                                                  metric=metric.name)
@@ -52,5 +125,14 @@ def sqlite_fundamentals_cache(metric,
                                            filing_getter=filing_getter)
     
     cache = FinancialIntervalCache(get_data=metric_getter.get_data, 
-                                     database=driver)
-    return cache
\ No newline at end of file
+                                   database=driver,
+                                   get_all_data=metric_getter.get_all_data if backfill else None,
+                                   get_new_data=metric_getter.get_new_data)
+    return cache
+
+def _use_ticker_ciks(filing_getter, connection, company_tickers_path):
+    ticker_ciks = sqlite_drivers.SQLiteTickerCIKs(connection=connection)
+    if company_tickers_path:
+        with open(company_tickers_path) as company_tickers_file:
+            ticker_ciks.set(read_company_tickers(company_tickers_file))
+    filing_getter.use_ticker_ciks(ticker_ciks)
@@ -0,0 +1,213 @@
+'''
+A size capped, compressed on-disk store of downloaded documents, off until
+configure names its directory.
+'''
+
+import os
+import zlib
+import time
+import hashlib
+import sqlite3
+import tempfile
+import threading
+from financial_fundamentals import sessions
+from financial_fundamentals.exceptions import ExternalRequestFailed
+
+
+class DocumentNotStored(ExternalRequestFailed):
+    '''Raised when an offline store doesn't have the requested document.'''
+
+
+class RawDocumentStore(object):
+    '''Keep compressed copies of downloaded documents on disk.
+
+    Documents are addressed by the sha1 of their content so identical
+    documents are stored once, an sqlite index maps urls to digests. When
+    the blobs grow past max_bytes the least recently read are evicted. An
+    offline store never downloads, it raises DocumentNotStored instead.
+    '''
+    _create_stmts = ('''CREATE TABLE IF NOT EXISTS urls
+                        (url text PRIMARY KEY, digest text)''',
+                     '''CREATE TABLE IF NOT EXISTS blobs
+                        (digest text PRIMARY KEY, size integer, last_read real)''',
+                     '''CREATE INDEX IF NOT EXISTS urls_digest_index ON urls (digest)''',
+                     )
+    def __init__(self, directory, max_bytes=2 * 1024 ** 3, offline=False):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._directory = directory
+        self.max_bytes = max_bytes
+        self.offline = offline
+        self._connection = sqlite3.connect(os.path.join(directory, 'index.sqlite'),
+                                           check_same_thread=False)
+        # downloads run concurrently, the index is read and written under the lock.
+        self._lock = threading.RLock()
+        with self._connection:
+            for stmt in self._create_stmts:
+                self._connection.execute(stmt)
+
+    def fetch(self, url, download, refresh=False):
+        '''Return the content at url, calling download(url) when it isn't
+        stored or when refresh is set, e.g. for pages that change over time.
+
+        '''
+        if self.offline or not refresh:
+            content = self.get(url)
+            if content is not None:
+                return content
+            elif self.offline:
+                raise DocumentNotStored(url)
+        content = download(url)
+        self.set(url, content)
+        return content
+
+    def get(self, url):
+        '''return the stored content of url, None if it isn't stored.'''
+        with self._lock:
+            row = self._connection.execute('SELECT digest FROM urls WHERE url = ?',
+                                           (url,)).fetchone()
+        if not row:
+            return None
+        digest = row[0]
+        path = self._blob_path(digest)
+        try:
+            with open(path, 'rb') as blob:
+                content = zlib.decompress(blob.read())
+        except IOError:
+            # evicted by another process.
+            return None
+        except zlib.error:
+            # cut short by a crash before blobs were renamed into place.
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+        with self._lock, self._connection:
+            self._connection.execute('UPDATE blobs SET last_read = ? WHERE digest = ?',
+                                     (time.time(), digest))
+        return content
+
+    def set(self, url, content):
+        digest = hashlib.sha1(content).hexdigest()
+        path = self._blob_path(digest)
+        if not os.path.exists(path):
+            self._write_blob(path, zlib.compress(content))
+        with self._lock, self._connection:
+            self._connection.execute('INSERT OR REPLACE INTO blobs (digest, size, last_read) '
+                                     'VALUES (?, ?, ?)',
+                                     (digest, os.path.getsize(path), time.time()))
+            self._connection.execute('INSERT OR REPLACE INTO urls (url, digest) VALUES (?, ?)',
+                                     (url, digest))
+        with self._lock:
+            self._evict()
+
+    def _write_blob(self, path, data):
+        '''Write data to a temporary file next to path and rename it into 
+        place, readers never see a partly written blob.
+        
+        '''
+        directory = os.path.dirname(path)
+        try:
+            os.makedirs(directory)
+        except OSError:
+            if not os.path.isdir(directory):
+                raise
+        handle, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        try:
+            with os.fdopen(handle, 'wb') as blob:
+                blob.write(data)
+            os.rename(temp_path, path)
+        except:
+            os.remove(temp_path)
+            raise
+
+    def contains(self, url):
+        with self._lock:
+            return self._connection.execute('SELECT 1 FROM urls WHERE url = ?',
+                                            (url,)).fetchone() is not None
+
+    def size(self):
+        '''bytes used by the compressed documents.'''
+        with self._lock:
+            return self._connection.execute('SELECT COALESCE(SUM(size), 0) '
+                                            'FROM blobs').fetchone()[0]
+
+    def _evict(self):
+        excess = self.size() - self.max_bytes
+        if excess <= 0:
+            return
+        rows = self._connection.execute('SELECT digest, size FROM blobs '
+                                        'ORDER BY last_read').fetchall()
+        evicted = []
+        for digest, size in rows:
+            if excess <= 0:
+                break
+            evicted.append(digest)
+            excess -= size
+        with self._connection:
+            for digest in evicted:
+                self._connection.execute('DELETE FROM urls WHERE digest = ?', (digest,))
+                self._connection.execute('DELETE FROM blobs WHERE digest = ?', (digest,))
+                try:
+                    os.remove(self._blob_path(digest))
+                except OSError:
+                    pass
+
+    def _blob_path(self, digest):
+        return os.path.join(self._directory, digest[:2], digest[2:] + '.z')
+
+
+_store = None
+def configure(directory, max_bytes=2 * 1024 ** 3, offline=False):
+    '''Store the documents downloaded from Edgar under directory,
+    pass None to download without storing.
+
+    '''
+    global _store
+    if directory is None:
+        _store = None
+    else:
+        _store = RawDocumentStore(directory=directory,
+                                  max_bytes=max_bytes,
+                                  offline=offline)
+    return _store
+
+def get_document(url, refresh=False):
+    '''Return the content at url, from the configured store when it has it.'''
+    if _store is None:
+        return _download(url)
+    return _store.fetch(url, download=_download, refresh=refresh)
+
+def prefetch(urls, workers=8):
+    '''Download the urls the configured store doesn't have concurrently,
+    so that reading them later doesn't wait on the network. Does nothing 
+    without a store to keep them in.
+    
+    '''
+    if _store is None or _store.offline:
+        return
+    missing = [url for url in set(urls) if url and not _store.contains(url)]
+    sessions.concurrent_map(lambda url : _store.fetch(url, download=_download),
+                            missing, 
+                            workers=workers)
+
+def iter_documents(urls, workers=8, batch_size=32):
+    '''Yield get_document(url) for each of urls, in order. batch_size documents
+    at a time are fetched concurrently, from the configured store or, without
+    one, from the network, so a consumer that reads ahead, e.g. a process 
+    pool's feeder thread, downloads the next batch while the last is parsed.
+    
+    '''
+    urls = list(urls)
+    for start in xrange(0, len(urls), batch_size):
+        for content in sessions.concurrent_map(get_document, 
+                                               urls[start:start + batch_size],
+                                               workers=workers):
+            yield content
+
+def _download(url):
+    response = sessions.get(url)
+    if response.status_code != 200:
+        raise ExternalRequestFailed('{} returned {}'.format(url, response.status_code))
+    return response.content
@@ -3,34 +3,41 @@ Created on Jan 26, 2013
 
 @author: akittredge
 '''
-import requests
 from BeautifulSoup import BeautifulSoup
 import datetime
 from urlparse import urljoin
 import blist
+from StringIO import StringIO
 from financial_fundamentals.exceptions import NoDataForStock
-import time
-from requests.exceptions import ConnectionError
 from financial_fundamentals.sec_filing import Filing
+from financial_fundamentals.xbrl import XBRLDocument
+from financial_fundamentals.memory_cache import LRUCache
+from financial_fundamentals import document_store
+from financial_fundamentals import sessions
 import re
+import json
 
 
-SEARCH_URL = 'http://www.sec.gov/cgi-bin/browse-edgar?action=getcompany&CIK={symbol}&type={filing_type}&dateb=&owner=exclude&count=100'        
+SEARCH_URL = 'http://www.sec.gov/cgi-bin/browse-edgar?action=getcompany&CIK={cik}&type={filing_type}&dateb=&owner=exclude&count=100'        
+FULL_INDEX_URL = 'http://www.sec.gov/Archives/edgar/full-index/{year}/QTR{quarter}/{index_name}'
 class XBRLNotAvailable(NoDataForStock):
     pass
 
 class HTMLEdgarDriver(object):
     '''Get documents from Edgar by parsing the HTML.'''
-    _ticker_filings = {}
+    # sorted filings keyed by (CIK or ticker, filing_type), built on a miss.
+    _filing_index = LRUCache(maxsize=512)
+    _persistent_index = None
+    _ticker_ciks = None
+    # threads fetching document pages, requests are paced by the session's limiter.
+    crawl_workers = 8
     @classmethod
     def get_filing(cls, ticker, filing_type, date_after):
         '''Get the last xbrl filed before date.
             Returns a Filing object, return None if there are no XBRL documents
             prior to the date.
         '''
-        filings = cls._ticker_filings.setdefault(ticker,
-                                    cls._get_sorted_filings(ticker, filing_type)
-                                                 )
+        filings = cls.get_filings(ticker, filing_type)
         if filings:
             filing_before_index = filings.bisect_right(date_after) - 1
             if filing_before_index == -1:
@@ -39,52 +46,198 @@ class HTMLEdgarDriver(object):
             if filing.date == date_after:
                 filing_before_index -= 1
                 filing = filings[filing_before_index]
-            try:
-                next_filing = filings[filing_before_index + 1]
-            except IndexError:
-                next_filing = None
-            finally:
-                filing.next_filing = next_filing
             return filing
         else:
             raise XBRLNotAvailable('No XBRL filings found.')
 
+    @classmethod
+    def get_filings(cls, ticker, filing_type):
+        '''Get all of the ticker's XBRL filings sorted by filing date,
+            each filing's next_filing is set.
+        '''
+        filings = cls._filing_index.get(key=(cls._index_key(ticker), filing_type),
+                                        build=lambda : cls._load_sorted_filings(ticker, 
+                                                                                filing_type))
+        for filing, next_filing in zip(filings, list(filings[1:]) + [None]):
+            filing.next_filing = next_filing
+        return filings
+
+    @classmethod
+    def refresh(cls, ticker, filing_type):
+        '''Add the filings made since the newest one in the index, only the search
+            results filed on or after its date and their document pages are fetched.
+            Returns the new filings, sorted and linked to the ones before them.
+        '''
+        filings = cls.get_filings(ticker, filing_type)
+        newest_date = filings[-1].date if filings else None
+        known_urls = {filing.xbrl_url for filing in filings 
+                      if filing.date == newest_date}
+        new_filings = [filing for filing in 
+                       cls._get_filings_since(ticker, filing_type, newest_date)
+                       if filing.xbrl_url not in known_urls]
+        for filing in new_filings:
+            filings.add(filing)
+        cls._write_persistent_index(ticker, filing_type, new_filings)
+        # relink next_filing.
+        cls.get_filings(ticker, filing_type)
+        return sorted(new_filings, key=_filing_sort_key)
+
+    @classmethod
+    def filing_index_stats(cls):
+        '''hits, misses and size of the in-process filing index.'''
+        return cls._filing_index.stats()
+
+    @classmethod
+    def use_persistent_index(cls, persistent_index):
+        '''Read and write filings through persistent_index, e.g. an SQLiteFilingIndex,
+            so tickers indexed by an earlier process are not searched for again.
+        '''
+        cls._persistent_index = persistent_index
+
+    @classmethod
+    def use_ticker_ciks(cls, ticker_ciks):
+        '''Search Edgar by CIK instead of having it resolve the ticker, and key 
+            the filing indexes by CIK. ticker_ciks is a SQLiteTickerCIKs or any
+            mapping from normalize_ticker(ticker) to CIK. Tickers it doesn't 
+            know are still searched for by ticker.
+        '''
+        cls._ticker_ciks = ticker_ciks
+
+    @classmethod
+    def index_tickers(cls, tickers, filing_type):
+        '''Crawl Edgar for all of the tickers that haven't been indexed at once,
+            the search pages and then every document page are fetched concurrently.
+        '''
+        unindexed_tickers = []
+        for ticker in tickers:
+            if (cls._index_key(ticker), filing_type) in cls._filing_index:
+                continue
+            filings = cls._read_persistent_index(ticker, filing_type)
+            if filings is None:
+                unindexed_tickers.append(ticker)
+            else:
+                cls._filing_index[(cls._index_key(ticker), filing_type)] = filings
+        # resolve the CIKs here, the ticker table's connection belongs to this thread.
+        search_keys = [cls._index_key(ticker) for ticker in unindexed_tickers]
+        document_page_urls = sessions.concurrent_map(
+                        lambda search_key : [document_page_url for _, document_page_url in 
+                                             cls._search(search_key, filing_type)],
+                        search_keys,
+                        workers=cls.crawl_workers)
+        all_filings = iter(sessions.concurrent_map(cls._get_filing_from_document_page,
+                                                   [url for urls in document_page_urls 
+                                                    for url in urls],
+                                                   workers=cls.crawl_workers))
+        for ticker, urls in zip(unindexed_tickers, document_page_urls):
+            filings = _sorted_filings(next(all_filings) for _ in urls)
+            cls._write_persistent_index(ticker, filing_type, filings)
+            cls._filing_index[(cls._index_key(ticker), filing_type)] = filings
+
+    @classmethod
+    def _load_sorted_filings(cls, ticker, filing_type):
+        '''Read the filings from the persistent index, 
+            only crawl Edgar for tickers that haven't been indexed.
+        '''
+        filings = cls._read_persistent_index(ticker, filing_type)
+        if filings is None:
+            filings = cls._get_sorted_filings(ticker, filing_type)
+            cls._write_persistent_index(ticker, filing_type, filings)
+        return filings
+
+    @classmethod
+    def _read_persistent_index(cls, ticker, filing_type):
+        '''Return None if the ticker hasn't been indexed.'''
+        if cls._persistent_index is None:
+            return None
+        indexed_filings = cls._persistent_index.get(ticker=cls._index_key(ticker), 
+                                                    filing_type=filing_type)
+        if indexed_filings is None:
+            return None
+        return _sorted_filings(cls._indexed_filing(filing_date, cik, url) 
+                               for filing_date, cik, url in indexed_filings)
+
+    @classmethod
+    def _indexed_filing(cls, filing_date, cik, url):
+        '''url is the XBRL url, or the document page url of a filing whose 
+            XBRL url hadn't been looked up when it was indexed.
+        '''
+        if url.endswith('-index.htm'):
+            return Filing(filing_date=filing_date,
+                          document=IndexPageXBRLDocument(url, get_soup=cls.get_edgar_soup),
+                          cik=cik)
+        return Filing.from_xbrl_url(filing_date=filing_date, xbrl_url=url, cik=cik)
+
+    @classmethod
+    def _write_persistent_index(cls, ticker, filing_type, filings):
+        if cls._persistent_index is not None:
+            indexed_filings = ((filing.date, filing.cik, _index_url(filing)) 
+                               for filing in filings)
+            cls._persistent_index.set(ticker=cls._index_key(ticker),
+                                      filing_type=filing_type,
+                                      filings=[indexed_filing for indexed_filing in 
+                                               indexed_filings if indexed_filing[2] is not None])
+
     @classmethod
     def _get_sorted_filings(cls, ticker, filing_type):
         '''Step 1 Search for the ticker and filing type,
             generate the urls for the document pages that have interactive data/XBRL.
            Step 2 : Get the document pages, on each page find the url for the XBRL document.
+            The document pages are fetched concurrently by crawl_workers threads.
             Return a blist sorted by filing date.
         '''
-        def key_func(filing_or_date):
-            if isinstance(filing_or_date, Filing):
-                return filing_or_date.date
-            elif isinstance(filing_or_date, datetime.datetime):
-                return filing_or_date.date()
-            else:
-                return filing_or_date
-        filings = blist.sortedlist(key=key_func)
         document_page_urls = cls._get_document_page_urls(ticker, filing_type)
-        for url in document_page_urls:
-            filing = cls._get_filing_from_document_page(url)
-            filings.add(filing)
-        return filings
+        return _sorted_filings(sessions.concurrent_map(cls._get_filing_from_document_page,
+                                                       document_page_urls,
+                                                       workers=cls.crawl_workers))
     
 
+    @classmethod
+    def _get_filings_since(cls, ticker, filing_type, since_date):
+        '''Return the filings made on or after since_date, all of them if 
+            since_date is None. The search results are newest first, the walk 
+            stops at the first one filed before since_date.
+        '''
+        document_page_urls = []
+        for filing_date, document_page_url in cls._get_search_results(ticker, filing_type):
+            if since_date and filing_date and filing_date < since_date:
+                break
+            document_page_urls.append(document_page_url)
+        return sessions.concurrent_map(cls._get_filing_from_document_page,
+                                       document_page_urls,
+                                       workers=cls.crawl_workers)
+
     @classmethod
     def _get_document_page_urls(cls, symbol, filing_type):
         '''Get the edgar filing document pages for the CIK.
         
         '''
-        search_url = SEARCH_URL.format(symbol=symbol, filing_type=filing_type)
-        search_results_page = cls.get_edgar_soup(url=search_url)
+        return (document_page_url for _, document_page_url in 
+                cls._get_search_results(symbol, filing_type))
+
+    @classmethod
+    def _get_search_results(cls, symbol, filing_type):
+        '''Yield (filing_date, document_page_url) for the XBRL filings in the 
+            search results, newest first. filing_date is None if the row doesn't have one.
+        '''
+        return cls._search(cls._index_key(symbol), filing_type)
+
+    @classmethod
+    def _search(cls, search_key, filing_type):
+        '''_get_search_results for a CIK, or a ticker Edgar resolves, 
+            safe to call from the crawl threads.
+        '''
+        search_url = SEARCH_URL.format(cik=search_key, filing_type=filing_type)
+        # search results change as companies file, don't read them from the store.
+        search_results_page = cls.get_edgar_soup(url=search_url, refresh=True)
         xbrl_rows = [row for row in 
                      search_results_page.findAll('tr') if 
                      row.find(text=re.compile('Interactive Data'))]
         for xbrl_row in xbrl_rows:
             documents_page = xbrl_row.find('a', {'id' : 'documentsbutton'})['href']
             documents_url = 'http://sec.gov' + documents_page
-            yield documents_url
+            date_text = xbrl_row.find('td', text=re.compile(r'^\s*\d{4}-\d{2}-\d{2}\s*$'))
+            filing_date = date_text and datetime.date(*map(int, date_text.strip().split('-')))
+            yield filing_date, documents_url
 
     @classmethod
     def _get_filing_from_document_page(cls, document_page_url):
@@ -96,37 +249,235 @@ class HTMLEdgarDriver(object):
         period_of_report_elem = filing_page.find('div', text='Filing Date')
         filing_date = period_of_report_elem.findNext('div', {'class' : 'info'}).text
         filing_date = datetime.date(*map(int, filing_date.split('-')))
-        type_tds = filing_page.findAll('td', text='EX-101.INS')
-        for type_td in type_tds:
-            try:
-                xbrl_link = type_td.findPrevious('a', text=re.compile('\.xml$')).parent['href']
-            except AttributeError:
-                continue
-            else:
-                if not re.match(pattern='\d\.xml$', string=xbrl_link):
-                    # we don't want files of the form 'jcp-20120504_def.xml'
-                    continue
-                else:
-                    break
-        xbrl_url = urljoin('http://www.sec.gov', xbrl_link)
-        filing = Filing.from_xbrl_url(filing_date=filing_date, xbrl_url=xbrl_url)
+        cik_match = re.search(r'/edgar/data/(\d+)/', document_page_url)
+        filing = Filing.from_xbrl_url(filing_date=filing_date, 
+                                      xbrl_url=_find_xbrl_url(filing_page),
+                                      cik=cik_match and cik_match.group(1))
         return filing
     
+    @classmethod
+    def _cik(cls, ticker):
+        '''Return the ticker's CIK, None if it isn't known.'''
+        if cls._ticker_ciks is None:
+            return None
+        cik = cls._ticker_ciks.get(normalize_ticker(ticker))
+        return None if cik is None else int(cik)
+
+    @classmethod
+    def _index_key(cls, ticker):
+        '''The filing indexes are keyed by CIK, tickers get reused and renamed,
+            by the ticker when the CIK isn't known.
+        '''
+        cik = cls._cik(ticker)
+        return ticker if cik is None else str(cik)
+
     @staticmethod
-    def get_edgar_soup(url):
-        '''backoff retry.'''
-        wait = 0
-        while wait < 5:
-            try:
-                response = requests.get(url)
-            except ConnectionError:
-                print 'ConnectionError, trying again in ', wait
-                time.sleep(wait)
-                wait += 1
+    def get_edgar_soup(url, refresh=False):
+        '''Retries and backoff are handled by the shared session.'''
+        return BeautifulSoup(document_store.get_document(url, refresh=refresh))
+
+class FullIndexEdgarDriver(HTMLEdgarDriver):
+    '''Find filings in EDGAR's quarterly full-index files, xbrl.idx or master.idx,
+    instead of searching Edgar a ticker at a time. Each filing's XBRL url is 
+    read from its document page the first time it's needed.
+    
+    Load the index before using the driver, e.g.
+        FullIndexEdgarDriver.load_full_index(index_files, ticker_ciks={'AAPL' : 320193})
+    '''
+    _filing_index = LRUCache(maxsize=512)
+    _persistent_index = None
+    # (cik, form type) to a list of (date filed, document page url).
+    _full_index = {}
+    @classmethod
+    def load_full_index(cls, index_files, ticker_ciks=None):
+        '''Parse the index files, paths or file-like objects, ticker_ciks maps 
+        tickers to CIKs, without it the CIKs set with use_ticker_ciks are used.
+        Replaces whatever was loaded before, filings that are already indexed 
+        are kept, refresh adds the newly loaded ones.
+        
+        '''
+        full_index = {}
+        for index_file in index_files:
+            if isinstance(index_file, basestring):
+                with open(index_file) as f:
+                    entries = list(parse_full_index(f))
             else:
-                return BeautifulSoup(response.text)
+                entries = parse_full_index(index_file)
+            for cik, form_type, date_filed, document_page_url in entries:
+                full_index.setdefault((cik, form_type), []).append((date_filed, 
+                                                                    document_page_url))
+        cls._full_index = full_index
+        if ticker_ciks is not None:
+            cls.use_ticker_ciks({normalize_ticker(ticker) : int(cik) for ticker, cik in 
+                                 ticker_ciks.iteritems()})
+
+    @classmethod
+    def load_quarters(cls, quarters, ticker_ciks=None, index_name='xbrl.idx'):
+        '''Download the index files for (year, quarter) pairs and load them.'''
+        today = datetime.date.today()
+        current_quarter = (today.year, (today.month - 1) // 3 + 1)
+        index_files = []
+        for year, quarter in quarters:
+            url = FULL_INDEX_URL.format(year=year, quarter=quarter, index_name=index_name)
+            # the current quarter's index grows every day.
+            content = document_store.get_document(url, 
+                                                  refresh=(year, quarter) == current_quarter)
+            index_files.append(StringIO(content))
+        cls.load_full_index(index_files, ticker_ciks=ticker_ciks)
+
+    @classmethod
+    def _get_sorted_filings(cls, ticker, filing_type):
+        '''Build the filings from the loaded index without fetching anything.'''
+        cik = cls._required_cik(ticker)
+        return _sorted_filings(Filing(filing_date=date_filed,
+                                      document=IndexPageXBRLDocument(document_page_url,
+                                                                     get_soup=cls.get_edgar_soup),
+                                      cik=str(cik))
+                               for date_filed, document_page_url in 
+                               cls._full_index.get((cik, filing_type), []))
+
+    @classmethod
+    def _get_filings_since(cls, ticker, filing_type, since_date):
+        return [filing for filing in cls._get_sorted_filings(ticker, filing_type)
+                if since_date is None or filing.date >= since_date]
+
+    @classmethod
+    def _get_search_results(cls, symbol, filing_type):
+        cik = cls._required_cik(symbol)
+        return sorted(cls._full_index.get((cik, filing_type), []), reverse=True)
+
+    @classmethod
+    def _required_cik(cls, ticker):
+        '''the index is by CIK, there's no searching by ticker.'''
+        cik = cls._cik(ticker)
+        if cik is None:
+            raise XBRLNotAvailable('No CIK for {}.'.format(ticker))
+        return cik
+
+
+class IndexPageXBRLDocument(XBRLDocument):
+    '''An XBRL document whose url is found on its filing's document page
+    the first time it's needed, xbrl_url is None if there isn't one.
+    
+    '''
+    def __init__(self, document_page_url, get_soup=HTMLEdgarDriver.get_edgar_soup):
+        super(IndexPageXBRLDocument, self).__init__(xbrl_url=None)
+        self.document_page_url = document_page_url
+        self._get_soup = get_soup
+        self._resolved = False
+
+    @property
+    def index_url(self):
+        '''the XBRL url once it's been looked up, the document page url before.'''
+        return self._xbrl_url if self._resolved else self.document_page_url
+
+    @property
+    def xbrl_url(self):
+        if not self._resolved:
+            self._xbrl_url = _find_xbrl_url(self._get_soup(self.document_page_url))
+            self._resolved = True
+        return self._xbrl_url
+
+    def extract(self, metrics):
+        if self.xbrl_url is None:
+            return {}
+        return super(IndexPageXBRLDocument, self).extract(metrics)
+
+
+def normalize_ticker(ticker):
+    '''Edgar writes share classes with a dash, BRK.B is BRK-B.'''
+    return ticker.strip().upper().replace('.', '-')
+
+def read_company_tickers(company_tickers_file):
+    '''Yield (ticker, cik, title) from Edgar's company_tickers.json, 
+    https://www.sec.gov/files/company_tickers.json, tickers are normalized.
+    
+    '''
+    companies = json.load(company_tickers_file)
+    if isinstance(companies, dict):
+        companies = companies.values()
+    for company in companies:
+        yield (normalize_ticker(company['ticker']), 
+               int(company['cik_str']), 
+               company.get('title'))
+
+def parse_full_index(index_file):
+    '''Yield (cik, form_type, date_filed, document_page_url) for each filing
+    in a full-index file like xbrl.idx or master.idx, rows look like
+    CIK|Company Name|Form Type|Date Filed|Filename
+    
+    '''
+    for line in index_file:
+        fields = line.rstrip('\r\n').split('|')
+        if len(fields) != 5 or not fields[0].isdigit():
+            # the header and the column names.
+            continue
+        cik, _, form_type, date_filed, filename = fields
+        yield (int(cik), 
+               form_type, 
+               _parse_index_date(date_filed), 
+               _document_page_url(filename))
+
+def _parse_index_date(date_filed):
+    '''index files have used both 2013-02-14 and 20130214.'''
+    date_filed = date_filed.strip().replace('-', '')
+    return datetime.date(int(date_filed[:4]), int(date_filed[4:6]), int(date_filed[6:8]))
+
+def _document_page_url(filename):
+    '''edgar/data/1000045/0001193125-13-059046.txt to the filing's document page,
+    http://www.sec.gov/Archives/edgar/data/1000045/000119312513059046/0001193125-13-059046-index.htm
+    
+    '''
+    directory, accession_file = filename.strip().rsplit('/', 1)
+    accession = accession_file.rsplit('.', 1)[0]
+    return 'http://www.sec.gov/Archives/{}/{}/{}-index.htm'.format(directory,
+                                                                   accession.replace('-', ''),
+                                                                   accession)
+
+def _index_url(filing):
+    '''the url a filing is kept under in the persistent index, without 
+    fetching document pages for filings found in the full index.
+    
+    '''
+    document = filing._document
+    if isinstance(document, IndexPageXBRLDocument):
+        return document.index_url
+    return filing.xbrl_url
+
+def _find_xbrl_url(filing_page):
+    '''Return the url of the XBRL instance linked from a filing's document page,
+    None if the filing doesn't have one.
+    
+    '''
+    xbrl_link = None
+    type_tds = filing_page.findAll('td', text='EX-101.INS')
+    for type_td in type_tds:
+        try:
+            xbrl_link = type_td.findPrevious('a', text=re.compile('\.xml$')).parent['href']
+        except AttributeError:
+            continue
         else:
-            raise
+            if not re.match(pattern='\d\.xml$', string=xbrl_link):
+                # we don't want files of the form 'jcp-20120504_def.xml'
+                continue
+            else:
+                break
+    return xbrl_link and urljoin('http://www.sec.gov', xbrl_link)
+
+def _filing_sort_key(filing_or_date):
+    if isinstance(filing_or_date, Filing):
+        return filing_or_date.date
+    elif isinstance(filing_or_date, datetime.datetime):
+        return filing_or_date.date()
+    else:
+        return filing_or_date
+
+def _sorted_filings(filings):
+    '''Return a blist of filings sorted by filing date.'''
+    sorted_filings = blist.sortedlist(key=_filing_sort_key)
+    for filing in filings:
+        sorted_filings.add(filing)
+    return sorted_filings
 
 if __name__ == '__main__':
     print HTMLEdgarDriver.get_filing(ticker='GOOG', 
@@ -0,0 +1,151 @@
+'''
+An in-process LRU tier in front of a cache's database driver.
+'''
+
+import sys
+from collections import OrderedDict
+import numpy as np
+
+
+class LRUCache(object):
+    '''In-process mapping bounded to maxsize keys, and to max_bytes as 
+    measured by sizeof(value) when max_bytes is set. The least recently used
+    key is evicted first.
+
+    '''
+    def __init__(self, maxsize=256, max_bytes=None, sizeof=None):
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self._sizeof = sizeof or _sizeof
+        self._data = OrderedDict()
+        self._sizes = {}
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, build):
+        '''Return the value cached for key, on a miss call build() and cache
+        the value it returns.
+
+        '''
+        try:
+            value = self._data.pop(key)
+        except KeyError:
+            self.misses += 1
+            value = build()
+            self[key] = value
+        else:
+            self.hits += 1
+            self._data[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        self.pop(key)
+        self._data[key] = value
+        if self.max_bytes is not None:
+            self._sizes[key] = self._sizeof(value)
+            self.bytes += self._sizes[key]
+        while self._data and (len(self._data) > self.maxsize or
+                              (self.max_bytes is not None and 
+                               self.bytes > self.max_bytes)):
+            self.pop(next(iter(self._data)))
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def pop(self, key, default=None):
+        self.bytes -= self._sizes.pop(key, 0)
+        return self._data.pop(key, default)
+
+    def invalidate(self, match):
+        '''Drop every key for which match(key) is true.'''
+        for key in [key for key in self._data if match(key)]:
+            self.pop(key)
+
+    def clear(self):
+        self._data.clear()
+        self._sizes.clear()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        return {'hits' : self.hits,
+                'misses' : self.misses,
+                'size' : len(self._data),
+                'maxsize' : self.maxsize,
+                'bytes' : self.bytes,
+                'max_bytes' : self.max_bytes}
+
+
+class MemoryTier(object):
+    '''Wrap a timeseries or intervalseries driver, keeping the arrays, missing
+    dates and intervals it has read in memory, up to max_bytes, so that reading
+    the same symbol and range again doesn't go to the database. Writing a 
+    symbol drops what is kept for it. Anything else is passed to the driver.
+    
+    '''
+    def __init__(self, driver, max_bytes=64 * 1024 ** 2, maxsize=4096):
+        self._driver = driver
+        self._cache = LRUCache(maxsize=maxsize, max_bytes=max_bytes)
+
+    def __getattr__(self, name):
+        return getattr(self._driver, name)
+
+    def get_array(self, symbol, dates):
+        '''the driver's get_array, don't modify the arrays returned.'''
+        return self._cache.get(('get_array', symbol, dates.min(), dates.max()),
+                               lambda : self._driver.get_array(symbol=symbol, 
+                                                               dates=dates))
+
+    def get_missing(self, symbol, dates):
+        return self._cache.get(('get_missing', symbol, dates.min(), dates.max()),
+                               lambda : self._driver.get_missing(symbol=symbol, 
+                                                                 dates=dates))
+
+    def get_intervals(self, symbol):
+        return self._cache.get(('get_intervals', symbol),
+                               lambda : self._driver.get_intervals(symbol=symbol))
+
+    def set(self, symbol, records):
+        self._driver.set(symbol, records)
+        self.invalidate(symbol)
+
+    def set_array(self, symbol, dates, values):
+        self._driver.set_array(symbol, dates=dates, values=values)
+        self.invalidate(symbol)
+
+    def set_missing(self, symbol, dates, checked=None):
+        self._driver.set_missing(symbol, dates=dates, checked=checked)
+        self.invalidate(symbol)
+
+    def set_interval(self, symbol, start, end, value):
+        self._driver.set_interval(symbol=symbol, start=start, end=end, value=value)
+        self.invalidate(symbol)
+
+    def set_intervals(self, symbol, intervals):
+        self._driver.set_intervals(symbol=symbol, intervals=intervals)
+        self.invalidate(symbol)
+
+    def close_interval(self, symbol, end):
+        self._driver.close_interval(symbol=symbol, end=end)
+        self.invalidate(symbol)
+
+    def invalidate(self, symbol):
+        '''Drop everything kept for symbol.'''
+        self._cache.invalidate(lambda key : key[1] == symbol)
+
+    def stats(self):
+        return self._cache.stats()
+
+
+def _sizeof(value):
+    '''Estimate the bytes value takes, numpy arrays are measured by their data.'''
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, (tuple, list)):
+        return sys.getsizeof(value) + sum(_sizeof(item) for item in value)
+    return sys.getsizeof(value)
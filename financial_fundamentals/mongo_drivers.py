@@ -6,12 +6,20 @@ Created on Jul 28, 2013
 import pymongo
 import pytz
 import numpy as np
+import datetime
+import time
+import threading
 
 class MongoCache(object):
-    def __init__(self, mongo_collection, metric):
+    '''Writes are sent as unordered bulk operations of up to batch_size
+    documents, one round trip a batch rather than one a document.
+    
+    '''
+    def __init__(self, mongo_collection, metric, batch_size=1000):
         self._ensure_indexes(mongo_collection)
         self._collection = mongo_collection
         self._metric = metric
+        self.batch_size = batch_size
 
 class MongoTimeseries(MongoCache):
     @classmethod
@@ -19,6 +27,8 @@ class MongoTimeseries(MongoCache):
         collection.ensure_index([('date', pymongo.ASCENDING), 
                                  ('symbol', pymongo.ASCENDING)])
         collection.ensure_index('symbol')
+        _missing_collection(collection).ensure_index([('symbol', pymongo.ASCENDING),
+                                                      ('date', pymongo.ASCENDING)])
         
     def get(self, symbol, dates):
         records = self._collection.find({'symbol' : symbol,
@@ -29,26 +39,241 @@ class MongoTimeseries(MongoCache):
                    np.float(record[self._metric]))
         
     def set(self, symbol, records):
-        for date, value in records:
-            key = {'symbol' : symbol, 'date' : date}
-            data = {'symbol' : symbol,
-                    self._metric : value,
-                    'date' : date}
-            self._collection.update(key, data, upsert=True)
+        '''records is a sequence of date, value items.'''
+        _bulk_upsert(self._collection, 
+                     (({'symbol' : symbol, 'date' : date},
+                       {'symbol' : symbol, self._metric : value, 'date' : date})
+                      for date, value in records),
+                     batch_size=self.batch_size)
+
+    def get_array(self, symbol, dates):
+        '''Return (dates, values) arrays of the stored values between 
+        min(dates) and max(dates), dates is a datetime64 array of naive UTC dates.
+        'NaN' markers stored by older versions are left out, so those dates are
+        asked for again.
+        
+        '''
+        start, end = _datetimes(np.array([dates.min(), dates.max()]))
+        records = list(self._collection.find({'symbol' : symbol,
+                                              'date' : {'$gte' : start, '$lte' : end},
+                                              self._metric : {'$ne' : 'NaN'},
+                                              }).sort('date'))
+        return (np.array([record['date'].replace(tzinfo=None) for record in records],
+                         dtype='datetime64[ns]'),
+                np.array([record[self._metric] for record in records], dtype=float))
+
+    def set_array(self, symbol, dates, values):
+        '''Store aligned datetime64 dates and float values arrays, NaNs are
+        stored as None. Record dates the source doesn't have with set_missing.
+        
+        '''
+        values = np.asarray(values, dtype=float)
+        self.set(symbol, ((date, None if np.isnan(value) else float(value)) for 
+                          date, value in zip(_datetimes(dates), values)))
+
+    def get_missing(self, symbol, dates):
+        '''Return (dates, checked) arrays of the dates between min(dates) and 
+        max(dates) the source didn't have, checked is when it was last asked 
+        in seconds since the epoch.
+        
+        '''
+        start, end = _datetimes(np.array([dates.min(), dates.max()]))
+        records = list(_missing_collection(self._collection).find(
+                                {'symbol' : symbol,
+                                 'metric' : self._metric,
+                                 'date' : {'$gte' : start, '$lte' : end},
+                                 }).sort('date'))
+        return (np.array([record['date'] for record in records], dtype='datetime64[ns]'),
+                np.array([record['checked'] for record in records], dtype=float))
+
+    def set_missing(self, symbol, dates, checked=None):
+        '''Record that the source didn't have dates, a datetime64 array, 
+        at checked, now by default.
+        
+        '''
+        checked = time.time() if checked is None else checked
+        keys = ({'symbol' : symbol, 'metric' : self._metric, 'date' : date} for 
+                date in _datetimes(dates))
+        _bulk_upsert(_missing_collection(self._collection), 
+                     ((key, dict(key, checked=checked)) for key in keys),
+                     batch_size=self.batch_size)
 
     @classmethod
     def price_db(cls, host='localhost', port=27017):
-        client = pymongo.MongoClient(host, port)
-        collection = client.prices.prices
+        collection = get_client(host, port).prices.prices
         return cls(collection, 'price')
         
         
+class MongoFieldsTimeseries(MongoTimeseries):
+    '''Store several fields, e.g. a day's open, high, low, close, volume and
+    adjusted close, in one document per symbol and date.
+    
+    '''
+    def __init__(self, mongo_collection, fields, batch_size=1000):
+        super(MongoFieldsTimeseries, self).__init__(mongo_collection, 
+                                                    metric=None, 
+                                                    batch_size=batch_size)
+        self.fields = list(fields)
+
+    def get_array(self, symbol, dates):
+        '''Return (dates, values) arrays, values has a column for each of fields.'''
+        start, end = _datetimes(np.array([dates.min(), dates.max()]))
+        records = list(self._collection.find({'symbol' : symbol,
+                                              'date' : {'$gte' : start, '$lte' : end},
+                                              }).sort('date'))
+        values = np.array([[record.get(field) for field in self.fields] for 
+                           record in records], dtype=float)
+        return (np.array([record['date'].replace(tzinfo=None) for record in records],
+                         dtype='datetime64[ns]'),
+                values.reshape(len(records), len(self.fields)))
+
+    def set_array(self, symbol, dates, values):
+        '''Store datetime64 dates and a values array with a column for each of 
+        fields, NaNs are stored as None.
+        
+        '''
+        values = np.asarray(values, dtype=float)
+        _bulk_upsert(self._collection, 
+                     (({'symbol' : symbol, 'date' : date}, 
+                       self._document(symbol, date, row)) for
+                      date, row in zip(_datetimes(dates), values)),
+                     batch_size=self.batch_size)
+
+    def _document(self, symbol, date, row):
+        document = {field : None if np.isnan(value) else float(value) for 
+                    field, value in zip(self.fields, row)}
+        document.update({'symbol' : symbol, 'date' : date})
+        return document
+
+    @classmethod
+    def price_db(cls, fields, host='localhost', port=27017):
+        return cls(get_client(host, port).prices.price_fields, fields=fields)
+
+
+class MongoBucketTimeseries(MongoTimeseries):
+    '''Store a symbol's metric values in one document per year,
+    {symbol, metric, year, days, values}, days are the days into the year of
+    the values, sorted. Reading a date range fetches a document a year 
+    rather than a document a day. Missing dates are recorded like 
+    MongoTimeseries.
+    
+    '''
+    @classmethod
+    def _ensure_indexes(cls, collection):
+        collection.ensure_index([('symbol', pymongo.ASCENDING),
+                                 ('metric', pymongo.ASCENDING),
+                                 ('year', pymongo.ASCENDING)],
+                                unique=True)
+        _missing_collection(collection).ensure_index([('symbol', pymongo.ASCENDING),
+                                                      ('date', pymongo.ASCENDING)])
+
+    def get(self, symbol, dates):
+        '''yield the stored (date, value) of the dates in dates.'''
+        requested = _datetime64s(dates)
+        stored_dates, values = self.get_array(symbol, requested)
+        wanted = np.in1d(stored_dates, requested)
+        for date, value in zip(_datetimes(stored_dates[wanted]), values[wanted]):
+            yield date.replace(tzinfo=pytz.UTC), value
+
+    def set(self, symbol, records):
+        '''records is a sequence of date, value items.'''
+        records = list(records)
+        if records:
+            dates, values = zip(*records)
+            self.set_array(symbol, _datetime64s(dates), values)
+
+    def get_array(self, symbol, dates):
+        '''Return (dates, values) arrays of the stored values between 
+        min(dates) and max(dates), dates is a datetime64 array of naive UTC dates.
+        
+        '''
+        start, end = np.array([dates.min(), dates.max()]).astype('datetime64[D]')
+        buckets = self._collection.find({'symbol' : symbol,
+                                         'metric' : self._metric,
+                                         'year' : {'$gte' : _year(start), 
+                                                   '$lte' : _year(end)},
+                                         }).sort('year')
+        stored_dates, values = [], []
+        for bucket in buckets:
+            stored_dates.append(_year_start(bucket['year']) + np.array(bucket['days'], dtype=int))
+            values.append(np.array(bucket['values'], dtype=float))
+        if not stored_dates:
+            return np.array([], dtype='datetime64[ns]'), np.array([], dtype=float)
+        stored_dates, values = np.concatenate(stored_dates), np.concatenate(values)
+        in_range = (stored_dates >= start) & (stored_dates <= end)
+        return stored_dates[in_range].astype('datetime64[ns]'), values[in_range]
+
+    def set_array(self, symbol, dates, values):
+        '''Store aligned datetime64 dates and float values arrays, NaNs are
+        stored as None. Each year's document is read, merged and replaced, 
+        setting a date again replaces its value.
+        
+        '''
+        dates = np.asarray(dates).astype('datetime64[D]')
+        values = np.asarray(values, dtype=float)
+        years = sorted(set(_year(date) for date in dates))
+        if not years:
+            return
+        key = {'symbol' : symbol, 'metric' : self._metric}
+        buckets = {bucket['year'] : dict(zip(bucket['days'], bucket['values'])) for 
+                   bucket in self._collection.find(dict(key, year={'$in' : years}))}
+        for date, value in zip(dates, values):
+            year = _year(date)
+            day = int((date - _year_start(year)).astype(int))
+            buckets.setdefault(year, {})[day] = None if np.isnan(value) else float(value)
+        _bulk_upsert(self._collection,
+                     ((dict(key, year=year), 
+                       dict(key, 
+                            year=year, 
+                            days=sorted(buckets[year]),
+                            values=[buckets[year][day] for day in sorted(buckets[year])]))
+                      for year in years),
+                     batch_size=self.batch_size)
+
+    @classmethod
+    def price_db(cls, host='localhost', port=27017):
+        return cls(get_client(host, port).prices.price_buckets, 'price')
+
+
+def migrate_to_buckets(timeseries_collection, bucket_collection, metric, batch_size=1000):
+    '''Copy the metric values stored a document a day by MongoTimeseries in 
+    timeseries_collection into MongoBucketTimeseries documents in 
+    bucket_collection, a symbol at a time. 'NaN' markers stored by older
+    versions are recorded as missing dates. Returns the number of symbols
+    copied, timeseries_collection is left as it was.
+    
+    '''
+    buckets = MongoBucketTimeseries(bucket_collection, metric, batch_size=batch_size)
+    symbols = timeseries_collection.distinct('symbol')
+    for symbol in symbols:
+        records = timeseries_collection.find({'symbol' : symbol,
+                                              metric : {'$exists' : True}},
+                                             ['date', metric]).sort('date')
+        dates, values, missing = [], [], []
+        for record in records:
+            date = record['date'].replace(tzinfo=None)
+            if record[metric] == 'NaN':
+                missing.append(date)
+            else:
+                dates.append(date)
+                values.append(record[metric])
+        if dates:
+            buckets.set_array(symbol, 
+                              np.array(dates, dtype='datetime64[ns]'), 
+                              np.array(values, dtype=float))
+        if missing:
+            buckets.set_missing(symbol, np.array(missing, dtype='datetime64[ns]'), checked=0)
+    return len(symbols)
+
+
 class MongoIntervalseries(MongoTimeseries):
     @classmethod
     def _ensure_indexes(cls, collection):
         collection.ensure_index([('start', pymongo.ASCENDING),
                                  ('end', pymongo.ASCENDING),
                                  ('symbol', pymongo.ASCENDING)])
+        collection.ensure_index([('symbol', pymongo.ASCENDING),
+                                 ('start', pymongo.ASCENDING)])
         
     def get(self, symbol, date):
         cursor = self._collection.find({'symbol' : symbol,
@@ -63,10 +288,156 @@ class MongoIntervalseries(MongoTimeseries):
             return None
         else:
             return np.float(record[self._metric])
+
+    def get_intervals(self, symbol):
+        '''return all of symbol's (start, end, value) intervals sorted by start.'''
+        records = self._collection.find({'symbol' : symbol,
+                                         self._metric : {'$exists' : True},
+                                         }).sort('start')
+        return [(record['start'], 
+                 record['end'], 
+                 np.float(record[self._metric])) for record in records]
                     
     def set_interval(self, symbol, start, end, value):
-        data = {'symbol' : symbol,
-                'start' : start,
-                'end' : end,
-                self._metric : value}
-        self._collection.insert(data)
\ No newline at end of file
+        self.set_intervals(symbol=symbol, intervals=[(start, end, value)])
+
+    def set_intervals(self, symbol, intervals):
+        '''set many (start, end, value) intervals in bulk, an interval that
+        starts on a stored start replaces it.
+        
+        '''
+        _bulk_upsert(self._collection,
+                     (({'symbol' : symbol, 
+                        'start' : start, 
+                        self._metric : {'$exists' : True}},
+                       {'symbol' : symbol,
+                        'start' : start,
+                        'end' : end,
+                        self._metric : value}) for start, end, value in intervals),
+                     batch_size=self.batch_size)
+
+    def close_interval(self, symbol, end):
+        '''Set the end of the symbol's open ended interval, the one whose end is None.'''
+        self._collection.update({'symbol' : symbol,
+                                 self._metric : {'$exists' : True},
+                                 'end' : None,
+                                 'start' : {'$lt' : end}},
+                                {'$set' : {'end' : end}},
+                                multi=True)
+
+
+class MongoFactStore(object):
+    '''Persist every numeric fact in the XBRL documents that are parsed, 
+    metrics can be extracted from stored documents without downloading them.
+    
+    '''
+    def __init__(self, mongo_collection):
+        self._ensure_indexes(mongo_collection)
+        self._collection = mongo_collection
+        self._documents = mongo_collection.documents
+
+    @classmethod
+    def _ensure_indexes(cls, collection):
+        collection.ensure_index([('xbrl_url', pymongo.ASCENDING),
+                                 ('tag', pymongo.ASCENDING)])
+        collection.ensure_index('tag')
+
+    def get(self, xbrl_url, tags):
+        '''return (tag, start, end, unit, value) tuples for the document's 
+        facts in tags, in document order. None if the document isn't stored.
+        
+        '''
+        if not self._documents.find_one({'xbrl_url' : xbrl_url}):
+            return None
+        records = self._collection.find({'xbrl_url' : xbrl_url,
+                                         'tag' : {'$in' : list(tags)},
+                                         }).sort('position')
+        return [(record['tag'],
+                 record['start'] and record['start'].date(),
+                 record['end'] and record['end'].date(),
+                 record['unit'],
+                 record['value']) for record in records]
+
+    def set(self, xbrl_url, facts):
+        '''facts is a sequence of (tag, start, end, unit, value) items in document order.'''
+        self._collection.remove({'xbrl_url' : xbrl_url})
+        documents = [{'xbrl_url' : xbrl_url,
+                      'position' : position,
+                      'tag' : tag,
+                      'start' : _datetime(start),
+                      'end' : _datetime(end),
+                      'unit' : unit,
+                      'value' : value} for 
+                     position, (tag, start, end, unit, value) in enumerate(facts)]
+        if documents:
+            self._collection.insert(documents)
+        self._documents.update({'xbrl_url' : xbrl_url}, 
+                               {'xbrl_url' : xbrl_url}, 
+                               upsert=True)
+
+_clients = {}
+_max_pool_size = 100
+_clients_lock = threading.Lock()
+def configure_clients(max_pool_size=100):
+    '''Set the connection pool size of the shared clients, clients already 
+    made are closed and made again when they're next asked for.
+    
+    '''
+    global _max_pool_size
+    with _clients_lock:
+        _max_pool_size = max_pool_size
+        for client in _clients.itervalues():
+            client.close()
+        _clients.clear()
+
+def get_client(host='localhost', port=27017):
+    '''Return the process' MongoClient for host and port, every cache and 
+    driver connecting to a server shares its client and connection pool,
+    and the indexes the client's ensure_index has already created.
+    
+    '''
+    with _clients_lock:
+        if (host, port) not in _clients:
+            _clients[host, port] = pymongo.MongoClient(host, port, 
+                                                       max_pool_size=_max_pool_size)
+        return _clients[host, port]
+
+def _bulk_upsert(collection, documents, batch_size=1000):
+    '''Replace, or insert, the (key, document) pairs in documents with 
+    unordered bulk operations of up to batch_size documents.
+    
+    '''
+    bulk, batched = None, 0
+    for key, document in documents:
+        if bulk is None:
+            bulk = collection.initialize_unordered_bulk_op()
+        bulk.find(key).upsert().replace_one(document)
+        batched += 1
+        if batched == batch_size:
+            bulk.execute()
+            bulk, batched = None, 0
+    if bulk is not None:
+        bulk.execute()
+
+def _datetime(date):
+    '''BSON doesn't have dates without times.'''
+    return date and datetime.datetime(date.year, date.month, date.day)
+
+def _missing_collection(collection):
+    '''the collection the dates missing from collection are recorded in.'''
+    return collection.database[collection.name + '_missing']
+
+def _datetime64s(dates):
+    '''Return a sequence of datetimes, naive or UTC, as a datetime64 array.'''
+    return np.array([date.astimezone(pytz.UTC).replace(tzinfo=None) if date.tzinfo 
+                     else date for date in dates], dtype='datetime64[ns]')
+
+def _year(date):
+    return int(np.datetime64(date, 'Y').astype(int)) + 1970
+
+def _year_start(year):
+    return np.datetime64('{:04d}-01-01'.format(year), 'D')
+
+def _datetimes(dates):
+    '''Return a datetime64 array as a list of naive UTC datetimes.'''
+    return np.asarray(dates).astype('datetime64[us]').astype(object).tolist()
@@ -5,13 +5,15 @@ Created on Jul 2, 2013
 '''
 
 
-from pandas.io.data import get_data_yahoo
+import abc
 import datetime
+from StringIO import StringIO
 import numpy as np
+import pandas as pd
 import pytz
+from financial_fundamentals import sessions
 from financial_fundamentals.exceptions import NoDataForStock,\
     ExternalRequestFailed
-import re
 
 SYMBOLS_YAHOO_DOES_NOT_HAVE = {'CVH',
                                'HNZ',
@@ -20,29 +22,178 @@ SYMBOLS_YAHOO_DOES_NOT_HAVE = {'CVH',
                                }
 
 
+PRICE_FIELDS = ('Open', 'High', 'Low', 'Close', 'Volume', 'Adj Close')
+
 def get_prices_from_yahoo(symbol, dates, type_of_price='Adj Close'):
-    '''Yields date, value pairs.'''
+    '''Return a (dates, prices) pair of arrays sorted by date, dates are 
+    naive UTC datetime64s. dates is a sequence of UTC datetimes or datetime64s,
+    prices are downloaded for every trading day between the first and last,
+    at least 30 days worth.
+    
+    '''
+    prices = _get_prices_between(symbol, dates)
+    return (prices.index.values.astype('datetime64[ns]'), 
+            prices[type_of_price].values.astype(float))
+
+def get_price_fields_from_yahoo(symbol, dates, fields=PRICE_FIELDS):
+    '''Like get_prices_from_yahoo but prices is a 2d array with a column
+    for each of fields, every field comes from the one download.
+    
+    '''
+    prices = _get_prices_between(symbol, dates)
+    return (prices.index.values.astype('datetime64[ns]'), 
+            prices[list(fields)].values.astype(float))
+
+def _get_prices_between(symbol, dates):
     if symbol in SYMBOLS_YAHOO_DOES_NOT_HAVE:
         raise NoDataForStock("Cannot download {} from yahoo".format(symbol))
-    # Yahoo errors out if you only ask for recent dates.
-    start = min(min(dates), 
-                datetime.datetime.now(pytz.UTC) - datetime.timedelta(days=30))
-    end = max(dates)
-    
-    prices = _wrapped_get_data_yahoo(symbol=symbol, start=start, end=end)
+    first, last = _utc_timestamp(np.min(dates)), _utc_timestamp(np.max(dates))
+    # Yahoo errors out if the dates are too close together.
+    start = min(first, last - datetime.timedelta(days=30))
+    return _wrapped_get_data_yahoo(symbol=symbol, start=start, end=last)
 
-    for date_price in prices.iterrows():
-        date = datetime.datetime(date_price[0].year,
-                                  date_price[0].month,
-                                  date_price[0].day,
-                                  tzinfo=pytz.UTC)
-        yield date, np.float(date_price[1][type_of_price])
+def _utc_timestamp(date):
+    '''naive datetime64s and datetimes are UTC.'''
+    timestamp = pd.Timestamp(date)
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.tz_localize(pytz.UTC)
+    return timestamp
 
+YAHOO_URL = ('http://ichart.finance.yahoo.com/table.csv?s={symbol}'
+             '&a={start_month}&b={start.day}&c={start.year}'
+             '&d={end_month}&e={end.day}&f={end.year}&g=d&ignore=.csv')
 def _wrapped_get_data_yahoo(symbol, start, end):
-    '''Handle the various exceptions that downloading from yahoo raises.'''
-    try:
-        return get_data_yahoo(symbols=symbol, start=start, end=end)
-    except IOError as e:
-        if re.match(r'after \d tries, Yahoo! did not return a 200 for url',
-                    e.message):
-            raise ExternalRequestFailed(e.message)
+    '''Download daily prices from yahoo with the shared session, 
+    raise ExternalRequestFailed when yahoo doesn't return them.
+    
+    '''
+    url = YAHOO_URL.format(symbol=symbol,
+                           start=start,
+                           start_month=start.month - 1,
+                           end=end,
+                           end_month=end.month - 1)
+    response = sessions.get(url)
+    if response.status_code != 200:
+        raise ExternalRequestFailed('Yahoo! did not return a 200 for url {}'.format(url))
+    prices = pd.read_csv(StringIO(response.text), 
+                         index_col=0, 
+                         parse_dates=True, 
+                         na_values='-')
+    return prices.sort_index()
+
+
+class PriceSource(object):
+    '''Where a price cache gets prices from. Sources are called like 
+    get_prices_from_yahoo, source(symbol, dates) returns a (dates, values) 
+    pair of arrays, and get_many fetches several symbols at once. fields is
+    a field name, values is 1d, or a list of field names, values has a 
+    column for each. Subclasses implement get_prices.
+    
+    '''
+    __metaclass__ = abc.ABCMeta
+    def __init__(self, fields='Adj Close'):
+        self.fields = fields if isinstance(fields, basestring) else list(fields)
+
+    def __call__(self, symbol, dates):
+        return self.get_prices(symbol=symbol, dates=dates)
+
+    @abc.abstractmethod
+    def get_prices(self, symbol, dates):
+        '''Return (dates, values) arrays for the trading days between the first
+        and last of dates, raise NoDataForStock if there aren't any.
+        
+        '''
+
+    def get_many(self, symbols, dates):
+        '''Return a dict of symbol to (dates, values) arrays, symbols the 
+        source doesn't have are left out.
+        
+        '''
+        return get_many(self.get_prices, symbols=symbols, dates=dates)
+
+    def _arrays(self, prices, date_values):
+        '''Return the (dates, values) arrays of the DataFrame prices sorted by date.'''
+        order = np.argsort(date_values, kind='mergesort')
+        return (date_values[order].astype('datetime64[ns]'), 
+                prices[self.fields].values[order].astype(float))
+
+
+def get_many(get_prices, symbols, dates):
+    '''Call get_prices for each symbol, return a dict of symbol to (dates, values),
+    symbols without data are left out.
+    
+    '''
+    symbol_prices = {}
+    for symbol in symbols:
+        try:
+            symbol_prices[symbol] = get_prices(symbol, dates)
+        except (NoDataForStock, ExternalRequestFailed):
+            continue
+    return symbol_prices
+
+
+class YahooPriceSource(PriceSource):
+    '''Download prices from Yahoo!, get_many downloads workers symbols 
+    at a time.
+    
+    '''
+    def __init__(self, fields='Adj Close', workers=8):
+        super(YahooPriceSource, self).__init__(fields=fields)
+        self.workers = workers
+
+    def get_prices(self, symbol, dates):
+        prices = _get_prices_between(symbol, dates)
+        return self._arrays(prices, prices.index.values)
+
+    def get_many(self, symbols, dates):
+        symbols = list(symbols)
+        symbol_prices = sessions.concurrent_map(
+                                lambda symbol : get_many(self.get_prices, [symbol], dates),
+                                symbols, 
+                                workers=self.workers)
+        return {symbol : prices for found in symbol_prices for 
+                symbol, prices in found.iteritems()}
+
+
+class CSVPriceSource(PriceSource):
+    '''Read prices from one bulk file, e.g. a vendor's flat file, with a row
+    per symbol and day and a column per field. Dates are UTC. The file is 
+    read once, chunksize rows at a time, when the source is made and kept 
+    as date sorted arrays for each symbol.
+    
+    '''
+    def __init__(self, 
+                 path, 
+                 fields='Adj Close', 
+                 symbol_column='Symbol', 
+                 date_column='Date', 
+                 chunksize=100000):
+        super(CSVPriceSource, self).__init__(fields=fields)
+        self.path = path
+        self.symbol_column = symbol_column
+        self.date_column = date_column
+        self.chunksize = chunksize
+        self._symbol_prices = self._read()
+
+    def _read(self):
+        fields = [self.fields] if isinstance(self.fields, basestring) else self.fields
+        prices = pd.concat(pd.read_csv(self.path, 
+                                       usecols=[self.symbol_column, self.date_column] + fields,
+                                       parse_dates=[self.date_column], 
+                                       chunksize=self.chunksize))
+        return {symbol : self._arrays(frame, frame[self.date_column].values) for
+                symbol, frame in prices.groupby(self.symbol_column)}
+
+    def get_prices(self, symbol, dates):
+        try:
+            symbol_dates, values = self._symbol_prices[symbol]
+        except KeyError:
+            raise NoDataForStock('{} is not in {}'.format(symbol, self.path))
+        start = np.datetime64(_utc_timestamp(np.min(dates)).value, 'ns')
+        end = np.datetime64(_utc_timestamp(np.max(dates)).value, 'ns')
+        first = symbol_dates.searchsorted(start, side='left')
+        last = symbol_dates.searchsorted(end, side='right')
+        if first == last:
+            raise NoDataForStock('{} has no prices between {} and {} in {}'\
+                                 .format(symbol, start, end, self.path))
+        return symbol_dates[first:last], values[first:last]
@@ -4,24 +4,60 @@ Created on Oct 28, 2013
 @author: akittredge
 '''
 
-from financial_fundamentals.xbrl import XBRLDocument
+from financial_fundamentals.xbrl import XBRLDocument, MetricNodeNotFound
 
 
 class Filing(object):
     '''Wrap SEC filings, 10-Ks, 10-Qs.'''
-    def __init__(self, filing_date, document, next_filing=None):
+    def __init__(self, filing_date, document, next_filing=None, cik=None):
         self._document = document
         self.date = filing_date
         self.next_filing = next_filing
+        self.cik = cik
+        self._metric_values = {}
+
+    @property
+    def xbrl_url(self):
+        return self._document.xbrl_url
 
     def latest_metric_value(self, metric):
-        return self._document.latest_metric_value(metric)
+        try:
+            return self.extract([metric])[metric]
+        except KeyError:
+            raise MetricNodeNotFound('{} not in {}'.format(metric.xbrl_tags, self))
+
+    def extract(self, metrics):
+        '''Return a dict of metric to value, leaving out metrics the filing
+        doesn't report. Metrics that haven't been extracted from this filing 
+        yet are all extracted in one pass over the document.
+        
+        '''
+        new_metrics = [metric for metric in metrics if 
+                       metric not in self._metric_values]
+        if new_metrics:
+            values = self._document.extract(new_metrics)
+            for metric in new_metrics:
+                self._metric_values[metric] = values.get(metric)
+        return {metric : self._metric_values[metric] for metric in metrics
+                if self._metric_values[metric] is not None}
+
+    def set_extracted(self, metrics, values):
+        '''Record metric values extracted elsewhere, e.g. in another process,
+        values is a dict like the one extract returns.
+        
+        '''
+        for metric in metrics:
+            self._metric_values[metric] = values.get(metric)
+
+    def has_extracted(self, metrics):
+        '''True when all of the metrics have been extracted from this filing.'''
+        return all(metric in self._metric_values for metric in metrics)
 
     @classmethod
-    def from_xbrl_url(cls, filing_date, xbrl_url):
+    def from_xbrl_url(cls, filing_date, xbrl_url, cik=None):
         '''constructor.'''
         document = XBRLDocument(xbrl_url=xbrl_url)
-        return cls(filing_date=filing_date, document=document)
+        return cls(filing_date=filing_date, document=document, cik=cik)
     
     def __repr__(self):
         return '{} - {}'.format(self.__class__, self.date)
@@ -0,0 +1,141 @@
+'''
+The process' shared, rate limited HTTP session and a thread pool map for 
+concurrent downloads.
+'''
+
+import time
+import logging
+import threading
+from multiprocessing.pool import ThreadPool
+import requests
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError, Timeout
+from financial_fundamentals.exceptions import ExternalRequestFailed
+
+logger = logging.getLogger(__name__)
+
+class TokenBucket(object):
+    '''Limit the rate of an operation shared between threads, acquire() 
+    blocks until a token is available. Tokens are added at rate per second,
+    at most burst are saved up.
+    
+    '''
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.burst = burst
+        self._tokens = float(burst)
+        self._last = time.time()
+        self._lock = threading.Lock()
+        self.acquired = 0
+
+    def acquire(self):
+        with self._lock:
+            now = time.time()
+            self._tokens = min(self.burst, 
+                               self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            # a negative balance reserves a token in the future, 
+            # waiting threads are served in the order they arrived.
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+            self.acquired += 1
+        if wait:
+            time.sleep(wait)
+
+
+class HTTPSession(object):
+    '''Share pooled keep-alive connections between downloads.
+
+    Connection errors, timeouts and retry_statuses are retried with
+    exponential backoff, ExternalRequestFailed is raised once the retries
+    are used up. pool_maxsize caps the connections kept open to each host.
+    Every attempt, from any thread, waits for a token from one limiter,
+    SEC asks for no more than 10 requests a second, None turns it off.
+    '''
+    def __init__(self,
+                 pool_connections=10,
+                 pool_maxsize=10,
+                 max_requests_per_second=10,
+                 timeout=30,
+                 retries=4,
+                 backoff=.5,
+                 max_backoff=30,
+                 retry_statuses=(429, 500, 502, 503, 504),
+                 user_agent='FinancialFundamentals'):
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.retry_statuses = set(retry_statuses)
+        self.limiter = (TokenBucket(rate=max_requests_per_second) 
+                        if max_requests_per_second else None)
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_connections,
+                              pool_maxsize=pool_maxsize,
+                              pool_block=True)
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+        self._session.headers['User-Agent'] = user_agent
+
+    def get(self, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        for attempt in range(self.retries + 1):
+            if self.limiter is not None:
+                self.limiter.acquire()
+            try:
+                response = self._session.get(url, **kwargs)
+            except (ConnectionError, Timeout) as e:
+                error = e
+            else:
+                if response.status_code not in self.retry_statuses:
+                    return response
+                error = 'status {}'.format(response.status_code)
+            if attempt < self.retries:
+                wait = min(self.backoff * 2 ** attempt, self.max_backoff)
+                logger.warning('%s getting %s, trying again in %s', error, url, wait)
+                time.sleep(wait)
+        raise ExternalRequestFailed('Getting {} failed after {} attempts: {}'\
+                                    .format(url, self.retries + 1, error))
+
+    def close(self):
+        self._session.close()
+
+
+_session = None
+# the crawl threads make the shared session on first use, only one may.
+_session_lock = threading.Lock()
+def configure(**kwargs):
+    '''Replace the shared session, kwargs are passed to HTTPSession.'''
+    global _session
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+        _session = HTTPSession(**kwargs)
+        return _session
+
+def get_session():
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = HTTPSession()
+        return _session
+
+def get(url, **kwargs):
+    '''GET url with the shared session.'''
+    return get_session().get(url, **kwargs)
+
+def concurrent_map(function, items, workers=8):
+    '''Return [function(item) for item in items], calling function from a pool 
+    of workers threads. The shared session's limiter paces the requests the
+    threads make.
+    
+    '''
+    items = list(items)
+    if workers <= 1 or len(items) <= 1:
+        return [function(item) for item in items]
+    pool = ThreadPool(min(workers, len(items)))
+    try:
+        return pool.map(function, items, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
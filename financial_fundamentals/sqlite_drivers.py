@@ -4,6 +4,7 @@ Created on Aug 21, 2013
 @author: akittredge
 '''
 
+import time
 import numpy as np
 import sqlite3
 
@@ -29,95 +30,566 @@ class SQLiteDriver(object):
         return sqlite3.connect(database, 
                                detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES)
             
-class SQLiteTimeseries(SQLiteDriver):
+class SQLiteMissingDates(object):
+    '''Record the dates a source didn't have, and the time it was last asked,
+    in a {table}_missing table next to the values. Rows that older versions
+    stored as markers in the values table, for every metric, are moved there,
+    checked at 0, once, when the missing table is created.
+    
+    '''
+    _create_missing_stmt = '''CREATE TABLE IF NOT EXISTS {table_name}_missing
+                            (symbol text NOT NULL, 
+                            metric text NOT NULL, 
+                            date integer NOT NULL, 
+                            checked real,
+                            PRIMARY KEY (symbol, metric, date)) WITHOUT ROWID
+                         '''
+    _move_markers_stmts = ('''INSERT OR IGNORE INTO {table_name}_missing
+                             (symbol, metric, date, checked)
+                             SELECT symbol, {metric}, date, 0 FROM {table_name} WHERE {markers}
+                          ''',
+                          'DELETE FROM {table_name} WHERE {markers}',
+                          )
+    def _ensure_missing_table(self):
+        missing_table = '{}_missing'.format(self._table)
+        create_stmt = self._create_missing_stmt.format(table_name=self._table)
+        if not _table_exists(self._connection, missing_table):
+            markers, metric = self._markers()
+            stmts = [create_stmt] + [stmt.format(table_name=self._table,
+                                                 markers=markers,
+                                                 metric=metric) for 
+                                     stmt in self._move_markers_stmts]
+            _execute_in_transaction(self._connection, stmts)
+        _migrate_to_epoch_days(self._connection, 
+                               table=missing_table, 
+                               create_stmt=create_stmt,
+                               columns=('symbol', 'metric', 'checked'))
+
+    @property
+    def _missing_metric(self):
+        return self._metric or ''
+
+    _get_missing_query = '''SELECT date, checked FROM {}_missing
+                            WHERE symbol = ?
+                            AND metric = ?
+                            AND date BETWEEN ? AND ?
+                            ORDER BY date
+                         '''
+    def get_missing(self, symbol, dates):
+        '''Return (dates, checked) arrays of the dates between min(dates) and 
+        max(dates) the source didn't have, checked is when it was last asked 
+        in seconds since the epoch.
+        
+        '''
+        start, end = _epoch_days(np.array([dates.min(), dates.max()]))
+        rows = self._connection.execute(self._get_missing_query.format(self._table),
+                                        (symbol, self._missing_metric, start, end)).fetchall()
+        return (_from_epoch_days([row[0] for row in rows]),
+                np.array([row[1] for row in rows], dtype=float))
+
+    _set_missing_query = ('INSERT INTO {}_missing (symbol, metric, date, checked) '
+                          'VALUES (?, ?, ?, ?) '
+                          'ON CONFLICT (symbol, metric, date) DO UPDATE SET checked = excluded.checked')
+    def set_missing(self, symbol, dates, checked=None):
+        '''Record that the source didn't have dates, a datetime64 array, 
+        at checked, now by default.
+        
+        '''
+        checked = time.time() if checked is None else checked
+        with self._connection:
+            self._connection.executemany(self._set_missing_query.format(self._table),
+                                         ((symbol, self._missing_metric, date, checked) for 
+                                          date in _epoch_days(dates)))
+
+
+class SQLiteTimeseries(SQLiteMissingDates, SQLiteDriver):
+    '''Store daily metric values in a WITHOUT ROWID table clustered on 
+    (symbol, metric, date), so reading a symbol's date range is one 
+    contiguous scan. Dates are integer days since the epoch, no timestamp 
+    text is decoded, and setting a date again replaces its value. Tables 
+    created by older versions, with timestamp dates, are migrated in place.
+    
+    '''
     _create_stmt = '''CREATE TABLE IF NOT EXISTS {table_name}
-                    (date timestamp, symbol text, metric text, value real);
+                    (symbol text NOT NULL, 
+                    metric text NOT NULL, 
+                    date integer NOT NULL, 
+                    value real,
+                    PRIMARY KEY (symbol, metric, date)) WITHOUT ROWID
                  '''
-    _create_index_stmt = '''
-                        CREATE INDEX IF NOT EXISTS 
-                        time_series_index ON {table_name} (date, symbol, metric);
-                        '''
+    def __init__(self, connection, table, metric):
+        super(SQLiteTimeseries, self).__init__(connection=connection, 
+                                               table=table, 
+                                               metric=metric)
+        _migrate_to_epoch_days(connection, 
+                               table=table, 
+                               create_stmt=self._create_stmt.format(table_name=table),
+                               columns=('symbol', 'metric', 'value'))
+        self._ensure_missing_table()
 
-    @classmethod
-    def _ensure_table_exists(cls, connection, table):
-        super(SQLiteTimeseries, cls)._ensure_table_exists(connection,
-                                                          table)
-        with connection:
-            cursor = connection.cursor()
-            cursor.execute(cls._create_index_stmt.format(table_name=table))
+    def _markers(self):
+        return "typeof(value) = 'text'", 'metric'
 
-    _get_query = '''SELECT value, date from {} 
+    _get_query = '''SELECT date, value FROM {} 
                     WHERE symbol = ?
+                    AND metric = ?
                     AND date BETWEEN ? AND ?
-                    AND metric =  ?
                 '''
     def get(self, symbol, dates):
         '''return all stored symbol metric values for dates between min(dates) and max(dates).
         
         '''
         qry = self._get_query.format(self._table)
-        args = [symbol, min(dates), max(dates), self._metric]
+        args = [symbol, self._metric, _epoch_day(min(dates)), _epoch_day(max(dates))]
         with self._connection:
             cursor = self._connection.cursor()
             cursor.execute(qry, args)
             for row in cursor.fetchall():
-                yield row['date'], np.float(row['value'])
+                yield _EPOCH + datetime.timedelta(days=row['date']), \
+                      (np.float(row['value']) if row['value'] is not None else np.nan)
        
-    _insert_query = 'INSERT INTO {} (symbol, date, metric, value) VALUES (?, ?, ?, ?)'
+    _upsert_query = ('INSERT INTO {} (symbol, metric, date, value) VALUES (?, ?, ?, ?) '
+                     'ON CONFLICT (symbol, metric, date) DO UPDATE SET value = excluded.value')
     def set(self, symbol, records):
         '''records is a sequence of date, value items.'''
-        query = self._insert_query.format(self._table)
+        query = self._upsert_query.format(self._table)
         with self._connection:
-            self._connection.executemany(query, ((symbol, date, self._metric, value)
+            self._connection.executemany(query, ((symbol, self._metric, _epoch_day(date), value)
                                                  for date, value in records))
 
+    _get_array_query = '''SELECT date, value FROM {}
+                          WHERE symbol = ?
+                          AND metric = ?
+                          AND date BETWEEN ? AND ?
+                          ORDER BY date
+                       '''
+    def get_array(self, symbol, dates):
+        '''Return (dates, values) arrays of the stored symbol metric values 
+        between min(dates) and max(dates), dates is a datetime64 array of 
+        naive UTC dates.
+        
+        '''
+        start, end = _epoch_days(np.array([dates.min(), dates.max()]))
+        qry = self._get_array_query.format(self._table)
+        rows = self._connection.execute(qry, (symbol, self._metric, start, end)).fetchall()
+        return (_from_epoch_days([row[0] for row in rows]),
+                np.array([row[1] for row in rows], dtype=float))
+
+    def set_array(self, symbol, dates, values):
+        '''Store aligned datetime64 dates and float values arrays, NaN values
+        are stored as NULLs. Record dates the source doesn't have with 
+        set_missing.
+        
+        '''
+        values = np.asarray(values, dtype=float)
+        row_values = values.astype(object)
+        row_values[np.isnan(values)] = None
+        query = self._upsert_query.format(self._table)
+        with self._connection:
+            self._connection.executemany(query, 
+                                         ((symbol, self._metric, date, value) for 
+                                          date, value in zip(_epoch_days(dates), 
+                                                             row_values)))
+
+class SQLiteFieldsTimeseries(SQLiteMissingDates, SQLiteDriver):
+    '''Store several fields, e.g. a day's open, high, low, close, volume and
+    adjusted close, in one row per symbol and date. Laid out like 
+    SQLiteTimeseries.
+    
+    '''
+    _create_stmt = '''CREATE TABLE IF NOT EXISTS {table_name}
+                    (symbol text NOT NULL, date integer NOT NULL, {columns}, 
+                    PRIMARY KEY (symbol, date)) WITHOUT ROWID
+                 '''
+    def __init__(self, connection, table, fields):
+        self.fields = list(fields)
+        self._columns = ', '.join('"{}"'.format(field) for field in self.fields)
+        super(SQLiteFieldsTimeseries, self).__init__(connection=connection,
+                                                     table=table,
+                                                     metric=None)
+        _migrate_to_epoch_days(connection, 
+                               table=table, 
+                               create_stmt=self._table_stmt(table),
+                               columns=['symbol'] + ['"{}"'.format(field) for 
+                                                     field in self.fields])
+        self._ensure_missing_table()
+
+    def _table_stmt(self, table):
+        columns = ', '.join('"{}" real'.format(field) for field in self.fields)
+        return self._create_stmt.format(table_name=table, columns=columns)
+
+    def _ensure_table_exists(self, connection, table):
+        with connection:
+            connection.execute(self._table_stmt(table))
+
+    def _markers(self):
+        return ' AND '.join('"{}" IS NULL'.format(field) for field in self.fields), "''"
+
+    _get_array_query = '''SELECT date, {columns} FROM {table}
+                          WHERE symbol = ?
+                          AND date BETWEEN ? AND ?
+                          ORDER BY date
+                       '''
+    def get_array(self, symbol, dates):
+        '''Return (dates, values) arrays like SQLiteTimeseries.get_array, values
+        has a column for each of fields.
+        
+        '''
+        start, end = _epoch_days(np.array([dates.min(), dates.max()]))
+        qry = self._get_array_query.format(columns=self._columns, table=self._table)
+        rows = self._connection.execute(qry, (symbol, start, end)).fetchall()
+        values = np.array([tuple(row)[1:] for row in rows], dtype=float)
+        return (_from_epoch_days([row[0] for row in rows]),
+                values.reshape(len(rows), len(self.fields)))
+
+    _upsert_query = ('INSERT INTO {table} (symbol, date, {columns}) VALUES ({params}) '
+                     'ON CONFLICT (symbol, date) DO UPDATE SET {updates}')
+    def set_array(self, symbol, dates, values):
+        '''Store datetime64 dates and a values array with a column for each of
+        fields, NaNs are stored as NULLs. Setting a date again replaces its row.
+        
+        '''
+        values = np.asarray(values, dtype=float)
+        row_values = values.astype(object)
+        row_values[np.isnan(values)] = None
+        query = self._upsert_query.format(table=self._table, 
+                                          columns=self._columns,
+                                          params=', '.join('?' * (len(self.fields) + 2)),
+                                          updates=', '.join('"{0}" = excluded."{0}"'.format(field)
+                                                            for field in self.fields))
+        with self._connection:
+            self._connection.executemany(query, 
+                                         ((symbol, date) + tuple(row) for 
+                                          date, row in zip(_epoch_days(dates), 
+                                                           row_values)))
+
+_EPOCH = datetime.datetime(1970, 1, 1, tzinfo=pytz.UTC)
+
+def _epoch_day(date):
+    '''Return the days between the epoch and date, a date or UTC datetime.'''
+    if isinstance(date, datetime.datetime) and date.tzinfo is not None:
+        date = date.astimezone(pytz.UTC)
+    return (datetime.date(date.year, date.month, date.day) - _EPOCH.date()).days
+
+def _epoch_days(dates):
+    '''Return a datetime64 array as a list of days since the epoch.'''
+    return np.asarray(dates).astype('datetime64[D]').astype(np.int64).tolist()
+
+def _from_epoch_days(days):
+    return np.array(days, dtype=np.int64).astype('datetime64[D]').astype('datetime64[ns]')
+
+# days since the epoch of the date part of a timestamp column, as stored by older versions.
+_EPOCH_DAY_SQL = 'CAST(julianday(substr(date, 1, 10)) - 2440587.5 AS INTEGER)'
+
+def _table_exists(connection, table):
+    return connection.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+                              (table,)).fetchone() is not None
+
+def _migrate_to_epoch_days(connection, table, create_stmt, columns):
+    '''Rebuild table, if it was created by an older version with timestamp 
+    dates, as create_stmt with dates as days since the epoch. columns are the
+    other columns to copy, duplicate rows collapse to the last one written.
+    Returns True when the table was migrated.
+    
+    '''
+    declared_types = {row[1] : row[2] for row in 
+                      connection.execute('PRAGMA table_info("{}")'.format(table))}
+    if declared_types.get('date', '').lower() != 'timestamp':
+        return False
+    columns = ', '.join(columns)
+    _rebuild_table(connection, table, create_stmt, 
+                   insert_columns='{}, date'.format(columns),
+                   select_columns='{}, {}'.format(columns, _EPOCH_DAY_SQL))
+    return True
+
+def _rebuild_table(connection, table, create_stmt, insert_columns, select_columns):
+    '''Recreate table as create_stmt, copying select_columns of its rows into
+    insert_columns in the order they were written, rows that conflict with 
+    the new table's keys collapse to the last one written.
+    
+    '''
+    old_table = '{}_old'.format(table)
+    stmts = ('ALTER TABLE "{}" RENAME TO "{}"'.format(table, old_table),
+             create_stmt,
+             'INSERT OR REPLACE INTO "{}" ({}) SELECT {} FROM "{}" ORDER BY rowid'\
+                .format(table, insert_columns, select_columns, old_table),
+             'DROP TABLE "{}"'.format(old_table),
+             )
+    _execute_in_transaction(connection, stmts)
+
+def _execute_in_transaction(connection, stmts):
+    '''Execute stmts, DDL included, all or nothing.'''
+    # python's sqlite3 commits before DDL, run stmts as one explicit transaction.
+    isolation_level = connection.isolation_level
+    connection.isolation_level = None
+    try:
+        connection.execute('BEGIN')
+        try:
+            for stmt in stmts:
+                connection.execute(stmt)
+        except:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+    finally:
+        connection.isolation_level = isolation_level
+
 
 class SQLiteIntervalseries(SQLiteDriver):
+    '''Store (start, end, value) intervals in a WITHOUT ROWID table keyed on
+    (metric, symbol, start), the key is the covering index every lookup 
+    walks. Setting an interval that starts on the same day as a stored one 
+    replaces it. Tables created by older versions, without a key, are 
+    rebuilt in place.
+    
+    '''
     _create_stmt = '''CREATE TABLE IF NOT EXISTS {table_name} 
-                        (start timestamp, 
+                        (metric text NOT NULL, 
+                        symbol text NOT NULL, 
+                        start timestamp NOT NULL, 
                         end timestamp, 
-                        symbol text, 
-                        metric text, 
-                        value real)
+                        value real,
+                        PRIMARY KEY (metric, symbol, start)) WITHOUT ROWID
                     '''
-    _get_qry = '''SELECT value FROM {} \
-                    WHERE metric = ? AND symbol = ? AND start <= ? AND (? <= end OR end IS NULL)\
+    _columns = 'metric, symbol, start, end, value'
+    def __init__(self, connection, table, metric):
+        super(SQLiteIntervalseries, self).__init__(connection=connection, 
+                                                   table=table, 
+                                                   metric=metric)
+        key_columns = [row[1] for row in 
+                       connection.execute('PRAGMA table_info("{}")'.format(table))
+                       if row[5]]
+        if not key_columns:
+            _rebuild_table(connection, table, 
+                           create_stmt=self._create_stmt.format(table_name=table),
+                           insert_columns=self._columns,
+                           select_columns=self._columns)
+
+    _get_qry = '''SELECT value FROM {table} \
+                    WHERE metric = ? AND symbol = ? AND (? <= end OR end IS NULL) AND start = \
+                    (SELECT max(start) FROM {table} WHERE metric = ? AND symbol = ? AND start {op} ?)\
                     '''
     def get(self, symbol, date):
-        '''return the metric value of symbol on date.'''
+        '''return the metric value of symbol on date. A date on the border of 
+        two intervals belongs to the earlier one, like 
+        time_series_cache._resolve_intervals: the last interval starting before 
+        the date is tried, then one starting on it.
+        
+        '''
         date = date.replace(tzinfo=None) # can't figure out timezones in sqlite.
-        qry = self._get_qry.format(self._table)
         cursor = self._connection.cursor()
-        cursor.execute(qry, (self._metric,
-                             symbol,
-                             date,
-                             date))
-        row = cursor.fetchone()
-        
-        return row and (np.float(row['value']) if row['value'] else np.NaN)
+        for op in ('<', '<='):
+            qry = self._get_qry.format(table=self._table, op=op)
+            cursor.execute(qry, (self._metric, symbol, date, self._metric, symbol, date))
+            row = cursor.fetchone()
+            if row:
+                return np.float(row['value']) if row['value'] else np.NaN
+        return None
+
+    _get_intervals_qry = '''SELECT start, end, value FROM {} \
+                            WHERE metric = ? AND symbol = ? ORDER BY start\
+                         '''
+    def get_intervals(self, symbol):
+        '''return all of symbol's (start, end, value) intervals sorted by start.'''
+        qry = self._get_intervals_qry.format(self._table)
+        cursor = self._connection.cursor()
+        cursor.execute(qry, (self._metric, symbol))
+        return [(row['start'], 
+                 row['end'], 
+                 np.float(row['value']) if row['value'] is not None else np.NaN)
+                for row in cursor.fetchall()]
 
-    _insert_query = ('INSERT INTO {} '
-                     '(symbol, start, end, metric, value) VALUES (?, ?, ?, ?, ?)')
+    _upsert_query = ('INSERT INTO {} (metric, symbol, start, end, value) VALUES (?, ?, ?, ?, ?) '
+                     'ON CONFLICT (metric, symbol, start) '
+                     'DO UPDATE SET end = excluded.end, value = excluded.value')
     def set_interval(self, symbol, start, end, value):
         '''set value for interval start and end.'''
-        qry = self._insert_query.format(self._table)
+        self.set_intervals(symbol=symbol, intervals=[(start, end, value)])
+
+    def set_intervals(self, symbol, intervals):
+        '''set many (start, end, value) intervals in one transaction.'''
+        qry = self._upsert_query.format(self._table)
         with self._connection:
-            cursor = self._connection.cursor()
-            cursor.execute(qry, (symbol, 
-                                 start, 
-                                 end, 
-                                 self._metric, 
-                                 value))
-        self._detect_duplicates()
+            self._connection.executemany(qry, ((self._metric, symbol, start, end, value)
+                                               for start, end, value in intervals))
             
-    duplicate_query = ('select * from {table_name} where rowid not in ' 
-                       '(select max(rowid) from {table_name}\n'
-                       'group by start, end, symbol, metric);')
+    _close_interval_query = ('UPDATE {} SET end = ? '
+                             'WHERE metric = ? AND symbol = ? AND end IS NULL AND start < ?')
+    def close_interval(self, symbol, end):
+        '''Set the end of the symbol's open ended interval, the one whose end is NULL.'''
+        with self._connection:
+            self._connection.execute(self._close_interval_query.format(self._table),
+                                     (end, self._metric, symbol, end))
+        
+
+class SQLiteFilingIndex(SQLiteDriver):
+    '''Persist the XBRL filings found in Edgar, a ticker and filing type 
+    that has been indexed is never searched for again. The edgar drivers 
+    index by CIK instead of ticker when they know it.
+    
+    '''
+    _create_stmt = '''CREATE TABLE IF NOT EXISTS {table_name}
+                        (ticker text,
+                        cik text,
+                        filing_type text,
+                        filing_date date,
+                        xbrl_url text,
+                        UNIQUE (ticker, filing_type, xbrl_url))
+                    '''
+    _create_index_stmt = '''CREATE INDEX IF NOT EXISTS
+                            {table_name}_index ON {table_name} (ticker, filing_type, filing_date)
+                         '''
+    _create_searches_stmt = '''CREATE TABLE IF NOT EXISTS {table_name}_searches
+                                (ticker text,
+                                filing_type text,
+                                searched timestamp,
+                                PRIMARY KEY (ticker, filing_type))
+                            '''
+    def __init__(self, connection, table='filings'):
+        super(SQLiteFilingIndex, self).__init__(connection=connection,
+                                                table=table,
+                                                metric=None)
+
+    @classmethod
+    def _ensure_table_exists(cls, connection, table):
+        super(SQLiteFilingIndex, cls)._ensure_table_exists(connection, table)
+        with connection:
+            cursor = connection.cursor()
+            cursor.execute(cls._create_index_stmt.format(table_name=table))
+            cursor.execute(cls._create_searches_stmt.format(table_name=table))
+
+    _searched_qry = 'SELECT searched FROM {}_searches WHERE ticker = ? AND filing_type = ?'
+    _get_qry = '''SELECT filing_date, cik, xbrl_url FROM {}
+                  WHERE ticker = ? AND filing_type = ? ORDER BY filing_date
+               '''
+    def get(self, ticker, filing_type):
+        '''return (filing_date, cik, xbrl_url) tuples sorted by filing date, 
+        None if the ticker and filing type have not been indexed.
+        
+        '''
+        cursor = self._connection.cursor()
+        cursor.execute(self._searched_qry.format(self._table), (ticker, filing_type))
+        if not cursor.fetchone():
+            return None
+        cursor.execute(self._get_qry.format(self._table), (ticker, filing_type))
+        return [(row['filing_date'], row['cik'], row['xbrl_url']) 
+                for row in cursor.fetchall()]
+
+    _insert_query = ('INSERT OR IGNORE INTO {} '
+                     '(ticker, cik, filing_type, filing_date, xbrl_url) VALUES (?, ?, ?, ?, ?)')
+    _searched_insert_query = ('INSERT OR REPLACE INTO {}_searches '
+                              '(ticker, filing_type, searched) VALUES (?, ?, ?)')
+    def set(self, ticker, filing_type, filings):
+        '''filings is a sequence of filing_date, cik, xbrl_url items.'''
+        with self._connection:
+            self._connection.executemany(self._insert_query.format(self._table),
+                                         ((ticker, cik, filing_type, filing_date, xbrl_url) 
+                                          for filing_date, cik, xbrl_url in filings))
+            self._connection.execute(self._searched_insert_query.format(self._table),
+                                     (ticker, 
+                                      filing_type, 
+                                      datetime.datetime.now(pytz.UTC)))
+        
+
+class SQLiteTickerCIKs(SQLiteDriver):
+    '''Persist the mapping from tickers to the CIKs Edgar identifies companies by,
+    tickers are stored normalized, e.g. BRK-B.
+    
+    '''
+    _create_stmt = '''CREATE TABLE IF NOT EXISTS {table_name}
+                        (ticker text PRIMARY KEY,
+                        cik integer,
+                        title text)
+                    '''
+    def __init__(self, connection, table='ticker_ciks'):
+        super(SQLiteTickerCIKs, self).__init__(connection=connection,
+                                               table=table,
+                                               metric=None)
+
+    _get_qry = 'SELECT cik FROM {} WHERE ticker = ?'
+    def get(self, ticker, default=None):
+        '''return the CIK of a normalized ticker, default if it isn't known.'''
+        row = self._connection.execute(self._get_qry.format(self._table), 
+                                       (ticker,)).fetchone()
+        return row['cik'] if row else default
+
+    _insert_query = 'INSERT OR REPLACE INTO {} (ticker, cik, title) VALUES (?, ?, ?)'
+    def set(self, ticker_ciks):
+        '''ticker_ciks is a sequence of (ticker, cik, title) items, e.g. from 
+        edgar.read_company_tickers, a ticker that moved to another company is replaced.
+        
+        '''
+        with self._connection:
+            self._connection.executemany(self._insert_query.format(self._table),
+                                         ticker_ciks)
+
+
+class SQLiteFactStore(SQLiteDriver):
+    '''Persist every numeric fact in the XBRL documents that are parsed, 
+    metrics can be extracted from stored documents without downloading them.
     
-    def _detect_duplicates(self):
+    '''
+    _create_stmt = '''CREATE TABLE IF NOT EXISTS {table_name}
+                        (xbrl_url text,
+                        position integer,
+                        tag text,
+                        start date,
+                        end date,
+                        unit text,
+                        value real,
+                        PRIMARY KEY (xbrl_url, position))
+                    '''
+    _create_index_stmt = '''CREATE INDEX IF NOT EXISTS
+                            {table_name}_tag_index ON {table_name} (tag)
+                         '''
+    _create_documents_stmt = '''CREATE TABLE IF NOT EXISTS {table_name}_documents
+                                (xbrl_url text PRIMARY KEY)
+                             '''
+    def __init__(self, connection, table='facts'):
+        super(SQLiteFactStore, self).__init__(connection=connection,
+                                              table=table,
+                                              metric=None)
+
+    @classmethod
+    def _ensure_table_exists(cls, connection, table):
+        super(SQLiteFactStore, cls)._ensure_table_exists(connection, table)
+        with connection:
+            cursor = connection.cursor()
+            cursor.execute(cls._create_index_stmt.format(table_name=table))
+            cursor.execute(cls._create_documents_stmt.format(table_name=table))
+
+    _stored_qry = 'SELECT 1 FROM {}_documents WHERE xbrl_url = ?'
+    _get_qry = '''SELECT tag, start, end, unit, value FROM {table_name}
+                  WHERE xbrl_url = ? AND tag IN ({tags}) ORDER BY position
+               '''
+    def get(self, xbrl_url, tags):
+        '''return (tag, start, end, unit, value) tuples for the document's 
+        facts in tags, in document order. None if the document isn't stored.
+        
+        '''
+        cursor = self._connection.cursor()
+        cursor.execute(self._stored_qry.format(self._table), (xbrl_url,))
+        if not cursor.fetchone():
+            return None
+        tags = list(tags)
+        qry = self._get_qry.format(table_name=self._table, 
+                                   tags=', '.join('?' * len(tags)))
+        cursor.execute(qry, [xbrl_url] + tags)
+        return [(row['tag'], row['start'], row['end'], row['unit'], row['value'])
+                for row in cursor.fetchall()]
+
+    _insert_query = ('INSERT OR REPLACE INTO {} '
+                     '(xbrl_url, position, tag, start, end, unit, value) '
+                     'VALUES (?, ?, ?, ?, ?, ?, ?)')
+    _document_insert_query = 'INSERT OR REPLACE INTO {}_documents (xbrl_url) VALUES (?)'
+    def set(self, xbrl_url, facts):
+        '''facts is a sequence of (tag, start, end, unit, value) items in document order.'''
         with self._connection:
-            qry = self.duplicate_query.format(table_name=self._table)
-            assert not self._connection.execute(qry).fetchone()
+            self._connection.executemany(self._insert_query.format(self._table),
+                                         ((xbrl_url, position) + tuple(fact) 
+                                          for position, fact in enumerate(facts)))
+            self._connection.execute(self._document_insert_query.format(self._table),
+                                     (xbrl_url,))
         
 
 def _tz_aware_timestamp_adapter(val):
@@ -9,77 +9,156 @@ import pytz
 from zipline.utils.tradingcalendar import get_trading_days
 import datetime
 from financial_fundamentals import prices
-from financial_fundamentals.sqlite_drivers import SQLiteTimeseries
+from financial_fundamentals.sqlite_drivers import SQLiteTimeseries,\
+    SQLiteFieldsTimeseries
 
-from financial_fundamentals.mongo_drivers import MongoTimeseries
+from financial_fundamentals.mongo_drivers import MongoTimeseries,\
+    MongoFieldsTimeseries
+from financial_fundamentals.memory_cache import MemoryTier
 from financial_fundamentals.exceptions import NoDataForStock,\
     ExternalRequestFailed, NoDataForStockOnDate
+import time
+import logging
 import warnings
+import functools
 import numpy as np
-from numbers import Number
 
+logger = logging.getLogger(__name__)
+
+
+# (age, ttl) pairs, a date the source didn't have is asked for again once
+# ttl has passed if the date is at most age old, older dates aren't asked for
+# again, they're holidays and the like. Recent prices are sometimes late.
+MISSING_TTLS = ((datetime.timedelta(days=7), datetime.timedelta(hours=12)),
+                (datetime.timedelta(days=60), datetime.timedelta(days=7)),
+                )
 
 class FinancialDataTimeSeriesCache(object):
     '''Cache data, such as prices, that are accurate at some instant in time.
     
     '''
-    def __init__(self, gets_data, database):
+    def __init__(self, gets_data, database, missing_ttls=MISSING_TTLS):
         self._get_data = gets_data
         self._database = database
+        self._missing_ttls = missing_ttls
+
+    def use_memory_tier(self, max_bytes=64 * 1024 ** 2):
+        '''Serve repeated reads of the database from memory, see MemoryTier.'''
+        self._database = MemoryTier(self._database, max_bytes=max_bytes)
+        return self._database
         
     def get(self, symbol, dates):
-        '''yield date, data pairs in no particular order.
-        dates is a list of UTC datetimes.
+        '''Return date, data pairs for dates, a list of UTC datetimes.'''
+        dates = list(dates)
+        return zip(dates, self.get_array(symbol=symbol, dates=dates))
 
+    def get_array(self, symbol, dates):
+        '''Return a numpy array of values aligned to dates.
+        
+        dates are UTC datetimes, a DatetimeIndex or a datetime64 array. The 
+        cached values are read as arrays and joined against dates. The dates
+        the database doesn't have are merged into contiguous ranges, ranges
+        that no cached date falls between, and gets_data is called once per
+        range, so a gap doesn't re-download the years around it. Dates the 
+        source didn't have are NaN until their missing_ttls entry expires.
         '''
-        cached_values = self._database.get(symbol=symbol, dates=dates)
-        missing_dates = set(dates)
-        for date, value in cached_values:
-            try:
-                missing_dates.remove(date)
-            except KeyError:
-                #_database.get can return data more dates than we asked for.
-                continue
-            else:
-                yield date, value
-        if missing_dates:
-            for date, value in self._get_set(symbol, dates=missing_dates):
-                yield date, value
+        dates = _datetime64(dates)
+        if not len(dates):
+            return np.empty(0)
+        values, found = self._cached(symbol, dates)
+        for missing_range in _missing_ranges(dates, found):
+            range_values, in_range = _align(dates, 
+                                            missing_range, 
+                                            self._get_set(symbol, dates=missing_range))
+            values[in_range] = range_values[in_range]
+        return values
             
+    def _cached(self, symbol, dates):
+        '''Return values and found arrays aligned to dates, dates the source 
+        didn't have count as found until they're stale.
+        
+        '''
+        cached_dates, cached_values = self._database.get_array(symbol=symbol, 
+                                                               dates=dates)
+        values, found = _align(dates, cached_dates, cached_values)
+        missing_dates, checked = self._database.get_missing(symbol=symbol, dates=dates)
+        fresh = ~_stale(missing_dates, checked, ttls=self._missing_ttls)
+        found |= np.in1d(dates, missing_dates[fresh])
+        return values, found
+
     def _get_set(self, symbol, dates):
-        new_records = list(self._get_data(symbol, dates))
-        self._database.set(symbol, new_records)
-        missing_dates = set(dates)
-        for date, value in new_records:
-            missing_dates.discard(date)
-            if date in dates: # only yield dates that were missing.
-                yield date, value
-        self._database.set(symbol, ((missing_date, 'NaN') for 
-                                    missing_date in missing_dates)
-                           )
-        for missing_date in missing_dates:
-            yield missing_date, np.nan
+        '''Fetch, store and return the values for dates, sorted unique dates. 
+        Only the fetched rows that aren't already stored are written, dates the
+        source doesn't return are recorded as missing.
         
+        '''
+        new_dates, new_values = self._get_data(symbol, dates)
+        return self._store(symbol, dates, new_dates, new_values)
+
+    def _store(self, symbol, dates, new_dates, new_values):
+        '''Store the rows a source returned when asked for dates, return the 
+        values aligned to dates.
+        
+        '''
+        new_dates = _datetime64(new_dates)
+        new_values = np.asarray(new_values, dtype=float)
+        values, returned = _align(dates, new_dates, new_values)
+        if len(new_dates):
+            # sources return more dates than asked for, some are already stored.
+            stored_dates, _ = self._database.get_array(symbol=symbol, dates=new_dates)
+            is_new = ~np.in1d(new_dates, stored_dates)
+            new_dates, new_values = new_dates[is_new], new_values[is_new]
+        if len(new_dates):
+            self._database.set_array(symbol, dates=new_dates, values=new_values)
+        if not returned.all():
+            self._database.set_missing(symbol, dates=dates[~returned])
+        return values
     
+    def warm(self, symbols, dates):
+        '''Cache every one of symbols' values for dates with one batch fetch,
+        e.g. YahooPriceSource's concurrent downloads. Symbols that are already 
+        cached aren't fetched, the source isn't asked for symbols one at a time
+        unless it is a plain function rather than a PriceSource.
+        
+        '''
+        dates = np.unique(_datetime64(dates))
+        if not len(dates):
+            return
+        missing_dates = {}
+        for symbol in symbols:
+            _, found = self._cached(symbol, dates)
+            if not found.all():
+                missing_dates[symbol] = dates[~found]
+        if not missing_dates:
+            return
+        get_many = getattr(self._get_data, 'get_many', None) or \
+                    functools.partial(prices.get_many, self._get_data)
+        symbol_prices = get_many(symbols=list(missing_dates), dates=dates)
+        for symbol, (new_dates, new_values) in symbol_prices.iteritems():
+            self._store(symbol, missing_dates[symbol], new_dates, new_values)
+
     @classmethod
     def build_sqlite_price_cache(cls, 
                                  sqlite_file_path, 
                                  table='prices', 
-                                 metric='Adj Close'):
+                                 metric='Adj Close',
+                                 source=None):
+        '''source is a PriceSource, prices of metric are downloaded from yahoo by default.'''
         connection = SQLiteTimeseries.connect(sqlite_file_path)
         db = SQLiteTimeseries(connection=connection, 
                               table=table, 
                               metric=metric)
-        cache = cls(gets_data=prices.get_prices_from_yahoo,
+        cache = cls(gets_data=source or prices.YahooPriceSource(fields=metric),
                     database=db)
         return cache
     
     @classmethod
     def build_mongo_price_cache(cls,
                                 mongo_host='localhost', 
-                                mongo_port=27017):
+                                mongo_port=27017,
+                                source=None):
         mongo_driver = MongoTimeseries.price_db(host=mongo_host, port=mongo_port)
-        cache = cls(gets_data=prices.get_prices_from_yahoo, database=mongo_driver)
+        cache = cls(gets_data=source or prices.YahooPriceSource(), database=mongo_driver)
         return cache
     
     def load_from_cache(self,
@@ -94,26 +173,84 @@ class FinancialDataTimeSeriesCache(object):
         assert start <= end, 'start must be before end'
         datetime_index = get_trading_days(start=start, end=end)
         df = pd.DataFrame(index=datetime_index)
-        python_datetimes = list(datetime_index.to_pydatetime())
-        for symbol in stocks:
-            # there's probably a clever way of avoiding building a dictionary.
+        dates = _datetime64(datetime_index)
+        for symbol, values in self._load_arrays(symbols=stocks, dates=dates):
+            df[symbol] = pd.Series(values, index=datetime_index)
+            
+        for name, ticker in indexes.iteritems():
+            df[name] = pd.Series(self.get_array(symbol=ticker, dates=dates),
+                                 index=datetime_index)
+        return df
+
+    def _load_arrays(self, symbols, dates):
+        '''yield symbol, values pairs, warning about the symbols that fail.'''
+        for symbol in symbols:
             try:
-                date_values = self.get(symbol=symbol, dates=python_datetimes)
-                values = {date : value for date, value in date_values}
+                values = self.get_array(symbol=symbol, dates=dates)
             except NoDataForStock:
                 warnings.warn('No data for {}'.format(symbol))
             except ExternalRequestFailed as e:
                 warnings.warn('Getting data for {} failed {}'.format(symbol,
                                                                      e.message))
             else:
-                series = pd.Series(values)
-                df[symbol] = series
-            
-        for name, ticker in indexes.iteritems():
-            values = {date : value for date, value in self.get(symbol=ticker, 
-                                                               dates=python_datetimes)}
-            df[name] = pd.Series(values)
-        return df
+                yield symbol, values
+
+
+class FinancialDataFieldsCache(FinancialDataTimeSeriesCache):
+    '''Cache every field of a download, e.g. a day's open, high, low, close,
+    volume and adjusted close, so asking for another field doesn't download
+    the prices again. gets_data returns a (dates, values) pair, values has a
+    column for each of the database's fields.
+    
+    '''
+    @classmethod
+    def build_sqlite_price_cache(cls, 
+                                 sqlite_file_path, 
+                                 table='price_fields', 
+                                 fields=prices.PRICE_FIELDS,
+                                 source=None):
+        '''source is a PriceSource whose fields match fields, yahoo by default.'''
+        connection = SQLiteFieldsTimeseries.connect(sqlite_file_path)
+        db = SQLiteFieldsTimeseries(connection=connection, 
+                                    table=table, 
+                                    fields=fields)
+        return cls(gets_data=source or prices.YahooPriceSource(fields=fields),
+                   database=db)
+
+    @classmethod
+    def build_mongo_price_cache(cls,
+                                mongo_host='localhost', 
+                                mongo_port=27017,
+                                fields=prices.PRICE_FIELDS,
+                                source=None):
+        mongo_driver = MongoFieldsTimeseries.price_db(fields=fields,
+                                                      host=mongo_host, 
+                                                      port=mongo_port)
+        return cls(gets_data=source or prices.YahooPriceSource(fields=fields),
+                   database=mongo_driver)
+
+    def load_from_cache(self,
+                        stocks=[],
+                        fields=None,
+                        start=pd.datetime(1990, 1, 1, 0, 0, 0, 0, pytz.utc),
+                        end=datetime.datetime.now().replace(tzinfo=pytz.utc),
+                        ):
+        '''Equivalent to zipline.utils.factory.load_bars_from_yahoo, return a
+        Panel with an item for each stock, dates on the major axis and fields,
+        all of the cached fields by default, on the minor axis.
+        
+        '''
+        assert start <= end, 'start must be before end'
+        fields = list(fields or self._database.fields)
+        columns = [self._database.fields.index(field) for field in fields]
+        datetime_index = get_trading_days(start=start, end=end)
+        data = {}
+        for symbol, values in self._load_arrays(symbols=stocks, 
+                                                dates=_datetime64(datetime_index)):
+            data[symbol] = pd.DataFrame(values[:, columns], 
+                                        index=datetime_index, 
+                                        columns=fields)
+        return pd.Panel(data)
 
     
 class FinancialIntervalCache(object):
@@ -122,41 +259,111 @@ class FinancialIntervalCache(object):
     until the next filing is submitted.
     
     '''
-    def __init__(self, get_data, database):
+    def __init__(self, get_data, database, get_all_data=None, get_new_data=None):
+        '''get_all_data is optional, when it is passed the first miss for a 
+        symbol backfills the symbol's entire history in one transaction.
+        get_new_data is needed for refresh.
+        
+        '''
         self._get_data = get_data
+        self._get_all_data = get_all_data
+        self._get_new_data = get_new_data
         self._database = database
+        self._backfilled_symbols = set()
+
+    def use_memory_tier(self, max_bytes=64 * 1024 ** 2):
+        '''Serve repeated reads of the database from memory, see MemoryTier.'''
+        self._database = MemoryTier(self._database, max_bytes=max_bytes)
+        return self._database
         
     def get(self, symbol, dates):
-        '''Return cache's metric value for the passed dates.
+        '''Return a numpy array of the cache's metric values aligned to dates.
         
+        All of the symbol's intervals are read with one query and joined 
+        against dates, only dates no interval covers are passed to _get_set.
         dates should be UTC.
         '''
-        for date in dates:
-            # Not looking for more than one date at a time because the set
-            # operation will set multiple dates per call.
-            cached_value = self._database.get(symbol=symbol, date=date)
-            if isinstance(cached_value, Number):
-                yield cached_value
-            else:
-                yield self._get_set(symbol=symbol, date=date)
+        dates = list(dates)
+        values, covered = _resolve_intervals(
+                                self._database.get_intervals(symbol=symbol),
+                                dates)
+        while not covered.all():
+            missing_index = np.flatnonzero(~covered)[0]
+            values[missing_index] = self._get_set(symbol=symbol, 
+                                                  date=dates[missing_index])
+            covered[missing_index] = True
+            # the interval we just set probably covers other missing dates.
+            new_values, new_covered = _resolve_intervals(
+                                self._database.get_intervals(symbol=symbol),
+                                dates)
+            filled = new_covered & ~covered
+            values[filled] = new_values[filled]
+            covered |= filled
+        return values
     
     def _get_set(self, symbol, date):
-        print 'cache miss', symbol, date
+        if self._get_all_data and symbol not in self._backfilled_symbols:
+            self._backfill(symbol=symbol)
+            values, covered = _resolve_intervals(
+                                self._database.get_intervals(symbol=symbol),
+                                [date])
+            if covered[0]:
+                return values[0]
+        logger.debug('cache miss %s %s', symbol, date)
         start, value, end = self._get_data(symbol=symbol, date=date)
-        start = start and datetime.datetime(start.year, 
-                                            start.month, 
-                                            start.day, 
-                                            tzinfo=pytz.UTC)
-        end = end and datetime.datetime(end.year, 
-                                        end.month, 
-                                        end.day, 
-                                        tzinfo=pytz.UTC)
         self._database.set_interval(symbol=symbol, 
-                                    start=start, 
-                                    end=end, 
+                                    start=_utc_datetime(start), 
+                                    end=_utc_datetime(end), 
                                     value=value)
         return value
 
+    def _backfill(self, symbol):
+        '''Set an interval for every filing in the symbol's history that 
+        isn't already cached.
+        
+        '''
+        self._backfilled_symbols.add(symbol)
+        self._set_new_intervals(symbol=symbol, 
+                                intervals=self._get_all_data(symbol=symbol))
+
+    def backfill(self, symbol_intervals, batch_size=500):
+        '''Cache (symbol, intervals) pairs, intervals are (start, value, end) 
+        tuples, e.g. from AccountingMetricGetter.iter_all_data. Intervals that 
+        aren't already cached are written batch_size at a time.
+        
+        '''
+        for symbol, intervals in symbol_intervals:
+            self._backfilled_symbols.add(symbol)
+            self._set_new_intervals(symbol=symbol, 
+                                    intervals=intervals, 
+                                    batch_size=batch_size)
+
+    def refresh(self, symbols):
+        '''Cache the intervals of the symbols' filings made since they were 
+        last looked for. The open ended interval of each symbol's previous 
+        latest filing is closed at the first new filing. Only new filings are
+        fetched, see AccountingMetricGetter.get_new_data.
+        
+        '''
+        for symbol in symbols:
+            new_intervals = sorted(self._get_new_data(symbol=symbol))
+            if not new_intervals:
+                continue
+            self._database.close_interval(symbol=symbol, 
+                                          end=_utc_datetime(new_intervals[0][0]))
+            self._set_new_intervals(symbol=symbol, intervals=new_intervals)
+
+    def _set_new_intervals(self, symbol, intervals, batch_size=None):
+        cached_starts = {_naive_utc(start) for start, _, _ in 
+                         self._database.get_intervals(symbol=symbol)}
+        new_intervals = [(_utc_datetime(start), _utc_datetime(end), value) for 
+                         start, value, end in intervals
+                         if _naive_utc(_utc_datetime(start)) not in cached_starts]
+        batch_size = batch_size or len(new_intervals) or 1
+        for i in range(0, len(new_intervals), batch_size):
+            self._database.set_intervals(symbol=symbol, 
+                                         intervals=new_intervals[i:i + batch_size])
+
     def load_from_cache(self, 
                         stocks, 
                         start=pd.datetime(1990, 1, 1, 0, 0, 0, 0, pytz.utc),
@@ -176,4 +383,118 @@ class FinancialIntervalCache(object):
                                                                      e.message))
             else:
                 df[symbol] = series
-        return df
\ No newline at end of file
+        return df
+
+_OPEN_ENDED = np.datetime64('9999-12-31T00:00:00', 'us')
+
+def _utc_datetime(date):
+    '''Return a UTC datetime at midnight of date, None if date is None.'''
+    return date and datetime.datetime(date.year, 
+                                      date.month, 
+                                      date.day, 
+                                      tzinfo=pytz.UTC)
+
+def _naive_utc(date):
+    '''Return date as a naive UTC datetime, numpy doesn't do timezones.'''
+    if not isinstance(date, datetime.datetime):
+        date = datetime.datetime(date.year, date.month, date.day)
+    if date.tzinfo is not None:
+        date = date.astimezone(pytz.UTC).replace(tzinfo=None)
+    return date
+
+def _datetime64(dates):
+    '''Return dates, UTC datetimes, a DatetimeIndex or a datetime64 array, 
+    as a datetime64[ns] array of naive UTC dates.
+    
+    '''
+    if isinstance(dates, pd.DatetimeIndex):
+        # asi8 is nanoseconds since the epoch in UTC, with or without a timezone.
+        return dates.asi8.view('datetime64[ns]')
+    if isinstance(dates, np.ndarray) and dates.dtype.kind == 'M':
+        return dates.astype('datetime64[ns]')
+    return np.array([_naive_utc(date) for date in dates], dtype='datetime64[ns]')
+
+def _nans(length, like):
+    '''Return NaN values for length dates shaped like the values array like.'''
+    values = np.empty((length,) + like.shape[1:])
+    values.fill(np.nan)
+    return values
+
+def _align(dates, source_dates, source_values):
+    '''Look dates up in the source_dates, source_values arrays, source_values
+    has a row for each source date and may have several columns.
+    
+    Returns a values array and a boolean found array, both aligned to dates,
+    dates that aren't in source_dates are NaN.
+    '''
+    values = _nans(len(dates), like=source_values)
+    found = np.zeros(len(dates), dtype=bool)
+    if not len(source_dates):
+        return values, found
+    order = np.argsort(source_dates, kind='mergesort')
+    source_dates, source_values = source_dates[order], source_values[order]
+    indexes = source_dates.searchsorted(dates).clip(0, len(source_dates) - 1)
+    found = source_dates[indexes] == dates
+    values[found] = source_values[indexes[found]]
+    return values, found
+
+def _stale(dates, checked, ttls):
+    '''Return a boolean array, true for the missing dates, checked at checked,
+    whose ttl has passed.
+    
+    '''
+    now = time.time()
+    ages = now - dates.astype('datetime64[s]').astype(np.int64)
+    date_ttls = np.empty(len(dates))
+    date_ttls.fill(np.inf)
+    for age, ttl in sorted(ttls, reverse=True):
+        date_ttls[ages <= age.total_seconds()] = ttl.total_seconds()
+    return checked + date_ttls < now
+
+def _missing_ranges(dates, found):
+    '''Split the dates that weren't found into contiguous ranges, runs of 
+    missing dates that no found date falls between. Returns a list of sorted 
+    unique datetime64 arrays, one per range.
+    
+    '''
+    order = np.argsort(dates, kind='mergesort')
+    sorted_dates, sorted_found = dates[order], found[order]
+    # missing dates preceded by the same number of found dates are one range.
+    range_ids = np.cumsum(sorted_found)[~sorted_found]
+    missing_dates = sorted_dates[~sorted_found]
+    if not len(missing_dates):
+        return []
+    splits = np.flatnonzero(np.diff(range_ids)) + 1
+    return [np.unique(missing_range) for missing_range in 
+            np.split(missing_dates, splits)]
+
+def _resolve_intervals(intervals, dates):
+    '''Join dates against (start, end, value) intervals sorted by start.
+    
+    Returns a values array and a boolean covered array, both aligned to dates.
+    A date on the border of two intervals belongs to the earlier one, the 
+    interval that ends on a filing date is the one in effect on that date.
+    '''
+    date_array = _datetime64(dates).astype('datetime64[us]')
+    values = np.empty(len(date_array))
+    values.fill(np.nan)
+    covered = np.zeros(len(date_array), dtype=bool)
+    if not intervals:
+        return values, covered
+    starts = np.array([_naive_utc(start) for start, _, _ in intervals],
+                      dtype='datetime64[us]')
+    ends = np.array([_naive_utc(end) if end is not None else _OPEN_ENDED 
+                     for _, end, _ in intervals],
+                    dtype='datetime64[us]')
+    interval_values = np.array([value for _, _, value in intervals], 
+                               dtype=float)
+    # 'left' finds intervals starting strictly before the date, 'right' picks
+    # up intervals starting on the date.
+    for side in ('left', 'right'):
+        indexes = starts.searchsorted(date_array, side=side) - 1
+        in_bounds = indexes >= 0
+        indexes = indexes.clip(0, len(starts) - 1)
+        hits = in_bounds & (date_array <= ends[indexes]) & ~covered
+        values[hits] = interval_values[indexes[hits]]
+        covered |= hits
+    return values, covered
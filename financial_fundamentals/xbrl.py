@@ -4,9 +4,11 @@ Created on Oct 8, 2013
 @author: akittredge
 '''
 
-import dateutil
-import xmltodict
-import requests
+import datetime
+import multiprocessing
+from io import BytesIO
+from xml.etree import cElementTree
+from financial_fundamentals import document_store
 from financial_fundamentals.exceptions import NoDataForStockOnDate
 
 class TimeSpanContext(object):
@@ -14,71 +16,267 @@ class TimeSpanContext(object):
     def __init__(self, start_date, end_date):
         self.start_date = start_date
         self.end_date = end_date
-        
+
     def __repr__(self):
-        return '{}(start_date={}, end_date={})'.format(self.__class__, 
-                                                       self.start_date, 
+        return '{}(start_date={}, end_date={})'.format(self.__class__,
+                                                       self.start_date,
                                                        self.end_date)
-        
-    @classmethod
-    def from_period(cls, period):
-        start_date = dateutil.parser.parse(_find_node(xml_dict=period, 
-                                                      key='startDate')
-                                           ).date()
-        end_date = dateutil.parser.parse(_find_node(xml_dict=period, 
-                                                    key='endDate')
-                                         ).date()
-        return cls(start_date, end_date)
 
 class XBRLDocument(object):
     '''wrapper for XBRL documents, lazily downloads XBRL text.'''
+    _fact_store = None
     def __init__(self, xbrl_url):
         self._xbrl_url = xbrl_url
-        self._xbrl_dict_ = None
 
     @property
-    def _xbrl_dict(self):
-        if not self._xbrl_dict_:
-            doc_text = requests.get(self._xbrl_url).text
-            xml_dict = xmltodict.parse(doc_text)
-            self._xbrl_dict_ = _find_node(xml_dict, 'xbrl')
-        return self._xbrl_dict_
+    def xbrl_url(self):
+        return self._xbrl_url
+
+    def _open(self):
+        '''Return a file-like object reading the instance document.'''
+        return BytesIO(document_store.get_document(self.xbrl_url))
 
     def time_span_contexts_dict(self):
-        contexts = {}
-        for context in _find_node(xml_dict=self._xbrl_dict, key='context'):
-            try:
-                period = _find_node(context, 'period')
-                _find_node(xml_dict=period, key='startDate')
-            except KeyError:
-                continue
-            else:
-                contexts[context['@id']] = TimeSpanContext.from_period(period)
+        _, contexts = parse_instance(self._open(), tags=())
         return contexts
 
     def latest_metric_value(self, metric):
-        context_dates = self.time_span_contexts_dict()
-        for tag in metric.xbrl_tags:
-            try:
-                metric_nodes = self._xbrl_dict[tag]
-            except KeyError:
-                continue
-            else:
-                break
+        try:
+            return self.extract([metric])[metric]
+        except KeyError:
+            raise MetricNodeNotFound('Did not find any of {} in the document @ {}'\
+                                     .format(metric.xbrl_tags, self.xbrl_url))
+
+    def extract(self, metrics):
+        '''Resolve all of the metrics in one pass over the document.
+        Returns a dict of metric to value, metrics that aren't in the 
+        document are left out.
+        
+        '''
+        tags = {tag for metric in metrics for tag in metric.xbrl_tags}
+        if self._fact_store is None:
+            facts, contexts = parse_instance(self._open(), tags=tags)
         else:
-            raise MetricNodeNotFound('Did not find any of {} in the document @ '\
-                                     .format(metric.xbrl_tags, self._xbrl_url))
-        metric_node = sorted(metric_nodes,
-                             key=lambda value : context_dates[value['@contextRef']].start_date, 
-                             reverse=True)[0]
-        return float(metric_node['#text'])
-    
+            facts, contexts = self._stored_facts_and_contexts(tags)
+        return metric_values(metrics=metrics, facts=facts, contexts=contexts)
+
+    @classmethod
+    def use_fact_store(cls, fact_store):
+        '''Persist every numeric fact of the documents parsed to fact_store,
+        e.g. an SQLiteFactStore, documents already in the store aren't downloaded.
+        
+        '''
+        cls._fact_store = fact_store
+
+    def _stored_facts_and_contexts(self, tags):
+        stored_facts = self._fact_store.get(xbrl_url=self.xbrl_url, tags=tags)
+        if stored_facts is None:
+            all_facts = parse_facts(self._open())
+            self._fact_store.set(xbrl_url=self.xbrl_url, facts=all_facts)
+            stored_facts = [fact for fact in all_facts if fact[0] in tags]
+        return stored_facts_and_contexts(stored_facts)
+
 class MetricNodeNotFound(NoDataForStockOnDate):
     pass
 
-def _find_node(xml_dict, key):
-    '''OMG I hate XML.'''
+def parse_instance(source, tags):
+    '''Stream the XBRL instance document in the file-like source, keeping
+    only the facts whose prefixed tag, e.g. us-gaap:EarningsPerShareDiluted,
+    is in tags.
+
+    Returns a (facts, contexts) pair, facts maps tag to a list of
+    (context_ref, unit_ref, text) tuples in document order, contexts maps
+    context id to TimeSpanContext. When tags is empty every time span context
+    is returned, otherwise only the contexts the kept facts reference.
+    '''
+    tags = set(tags)
+    facts = {}
+    contexts = {}
+    for item in _iter_instance(source, tags=tags):
+        if item[0] == 'context':
+            _, context_id, start_date, end_date = item
+            if start_date:
+                contexts[context_id] = TimeSpanContext(start_date, end_date)
+        else:
+            _, tag, context_ref, unit_ref, text = item
+            facts.setdefault(tag, []).append((context_ref, unit_ref, text))
+    if tags:
+        referenced = {context_ref for nodes in facts.itervalues()
+                      for context_ref, _, _ in nodes}
+        contexts = {context_id : context for context_id, context in
+                    contexts.iteritems() if context_id in referenced}
+    return facts, contexts
+
+def extract_from_instance(content, metrics):
+    '''Return the metric values, as returned by XBRLDocument.extract, in the
+    instance document content, a string.
+    
+    '''
+    tags = {tag for metric in metrics for tag in metric.xbrl_tags}
+    facts, contexts = parse_instance(BytesIO(content), tags=tags)
+    return metric_values(metrics=metrics, facts=facts, contexts=contexts)
+
+def extract_concurrently(contents, metrics, processes=None, chunksize=2):
+    '''Yield extract_from_instance(content, metrics) for each of the instance
+    documents in contents, in order. The documents are parsed by a pool of 
+    processes, one per core by default, only the metric values come back 
+    to this process. metrics have to be picklable, e.g. module level classes.
+    
+    '''
+    metrics = list(metrics)
+    if processes == 1:
+        for content in contents:
+            yield extract_from_instance(content, metrics)
+        return
+    pool = multiprocessing.Pool(processes)
     try:
-        return xml_dict[key]
-    except KeyError:
-        return xml_dict['xbrli:{}'.format(key)]
+        for values in pool.imap(_extract_worker, 
+                                ((content, metrics) for content in contents),
+                                chunksize):
+            yield {metric : value for metric, value in zip(metrics, values) 
+                   if value is not None}
+    finally:
+        pool.terminate()
+
+def _extract_worker(content_metrics):
+    '''Runs in the pool, return a tuple of values aligned with metrics.'''
+    content, metrics = content_metrics
+    values = extract_from_instance(content, metrics)
+    return tuple(values.get(metric) for metric in metrics)
+
+def parse_facts(source):
+    '''Stream every numeric fact out of the XBRL instance document in source.
+    Returns (tag, start_date, end_date, unit_ref, value) tuples in document
+    order, start_date is None for instant contexts.
+    
+    '''
+    context_dates = {}
+    numeric_facts = []
+    for item in _iter_instance(source, tags=None):
+        if item[0] == 'context':
+            _, context_id, start_date, end_date = item
+            context_dates[context_id] = (start_date, end_date)
+        else:
+            _, tag, context_ref, unit_ref, text = item
+            if unit_ref is None:
+                continue
+            try:
+                value = float(text)
+            except (TypeError, ValueError):
+                continue
+            numeric_facts.append((tag, context_ref, unit_ref, value))
+    return [(tag,) + context_dates.get(context_ref, (None, None)) + (unit_ref, value)
+            for tag, context_ref, unit_ref, value in numeric_facts]
+
+def stored_facts_and_contexts(stored_facts):
+    '''Turn (tag, start_date, end_date, unit_ref, value) tuples, as returned by
+    parse_facts, back into parse_instance's facts and contexts.
+    
+    '''
+    facts = {}
+    contexts = {}
+    for tag, start_date, end_date, unit_ref, value in stored_facts:
+        context_ref = (start_date, end_date)
+        if start_date:
+            contexts[context_ref] = TimeSpanContext(start_date, end_date)
+        facts.setdefault(tag, []).append((context_ref, unit_ref, value))
+    return facts, contexts
+
+def _iter_instance(source, tags):
+    '''Yield ('context', context_id, start_date, end_date) and
+    ('fact', tag, context_ref, unit_ref, text) tuples from the instance 
+    document, clearing each element once it has been read. Facts are limited
+    to tags unless tags is None.
+    
+    '''
+    uri_prefixes = {}
+    root = None
+    depth = 0
+    for event, item in cElementTree.iterparse(source,
+                                              events=('start', 'end', 'start-ns')):
+        if event == 'start-ns':
+            prefix, uri = item
+            uri_prefixes.setdefault(uri, prefix)
+        elif event == 'start':
+            depth += 1
+            if root is None:
+                root = item
+        else:
+            depth -= 1
+            if depth != 1:
+                # only the root's children are facts and contexts.
+                continue
+            uri, local_name = _split_tag(item.tag)
+            if local_name == 'context':
+                start_date, end_date = _context_dates(item)
+                yield 'context', item.get('id'), start_date, end_date
+            elif item.get('contextRef'):
+                prefix = uri_prefixes.get(uri)
+                tag = '{}:{}'.format(prefix, local_name) if prefix else local_name
+                if tags is None or tag in tags:
+                    yield ('fact', 
+                           tag, 
+                           item.get('contextRef'), 
+                           item.get('unitRef'), 
+                           item.text)
+            # drop the elements we've consumed.
+            root.clear()
+
+def metric_values(metrics, facts, contexts):
+    '''Pick each metric's value out of facts and contexts as returned by 
+    parse_instance, the first of the metric's xbrl_tags that is present wins.
+    
+    '''
+    values = {}
+    for metric in metrics:
+        for tag in metric.xbrl_tags:
+            if tag in facts:
+                try:
+                    values[metric] = _latest_value(facts[tag], contexts)
+                except MetricNodeNotFound:
+                    pass
+                break
+    return values
+
+def _latest_value(metric_nodes, contexts):
+    '''Return the value of the node whose time span context starts last,
+    the first one in the document wins a tie.
+
+    '''
+    latest_start, latest_text = None, None
+    for context_ref, _, text in metric_nodes:
+        try:
+            start_date = contexts[context_ref].start_date
+        except KeyError:
+            # instant contexts don't have a start date.
+            continue
+        if latest_start is None or start_date > latest_start:
+            latest_start, latest_text = start_date, text
+    if latest_start is None:
+        raise MetricNodeNotFound('No time span values in {}'.format(metric_nodes))
+    return float(latest_text)
+
+def _context_dates(context_element):
+    '''Return a context's (start_date, end_date), (None, instant) for 
+    instant contexts.
+    
+    '''
+    dates = {}
+    for element in context_element.iter():
+        _, local_name = _split_tag(element.tag)
+        if local_name in ('startDate', 'endDate', 'instant'):
+            dates[local_name] = _parse_date(element.text)
+    if 'instant' in dates:
+        return None, dates['instant']
+    return dates.get('startDate'), dates.get('endDate')
+
+def _split_tag(tag):
+    '''split an ElementTree tag like {uri}local_name.'''
+    if tag.startswith('{'):
+        uri, local_name = tag[1:].split('}', 1)
+        return uri, local_name
+    return None, tag
+
+def _parse_date(text):
+    '''xs:date, YYYY-MM-DD with an optional timezone.'''
+    return datetime.date(*map(int, text.strip()[:10].split('-')))
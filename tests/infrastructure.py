@@ -12,6 +12,11 @@ def turn_on_request_caching():
     requests_cache.configure(os.path.join(os.path.expanduser('~'), 
                                           '.fundamentals_test_requests'))
 
+def turn_off_request_caching():
+    '''for tests that count the requests a local server sees.'''
+    import requests_cache
+    requests_cache.uninstall_cache()
+
 TEST_DOCS_DIR = os.path.join(os.path.dirname(__file__), 'assets') 
 
 
@@ -66,4 +71,86 @@ class IntervalseriesTestCase(object):
         cached_value = self.cache.get(symbol=symbol, 
                                       date=datetime.datetime(2012, 12, 2))
         self.assertEqual(cached_value, eps)
-        
+
+    def test_get_intervals(self):
+        symbol = 'ABC'
+        later = {'symbol' : symbol,
+                 'start' : datetime.datetime(2012, 12, 31),
+                 'end' : None,
+                 self.metric : 2.}
+        earlier = {'symbol' : symbol,
+                   'start' : datetime.datetime(2012, 12, 1),
+                   'end' : datetime.datetime(2012, 12, 31),
+                   self.metric : 1.}
+        self.insert_into_database(later)
+        self.insert_into_database(earlier)
+        intervals = self.cache.get_intervals(symbol=symbol)
+        self.assertEqual([value for _, _, value in intervals], [1., 2.])
+        self.assertIsNone(intervals[-1][1])
+
+    def test_set_intervals(self):
+        symbol = 'ABC'
+        intervals = [(datetime.datetime(2012, 12, 1), datetime.datetime(2012, 12, 31), 1.),
+                     (datetime.datetime(2012, 12, 31), None, 2.)]
+        self.cache.set_intervals(symbol=symbol, intervals=intervals)
+        self.assertEqual(self.find_in_database(start=intervals[0][0],
+                                               end=intervals[0][1],
+                                               symbol=symbol), 1.)
+        self.assertEqual(len(self.cache.get_intervals(symbol=symbol)), 2)
+
+    def test_close_interval(self):
+        symbol = 'ABC'
+        start = datetime.datetime(2012, 12, 1)
+        self.cache.set_intervals(symbol=symbol, intervals=[(start, None, 1.)])
+        end = datetime.datetime(2013, 1, 31)
+        self.cache.close_interval(symbol=symbol, end=end)
+        self.assertEqual(self.cache.get_intervals(symbol=symbol), [(start, end, 1.)])
+
+
+import threading
+import time
+import BaseHTTPServer
+import SocketServer
+class LocalHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    '''Stand in for Edgar and yahoo, serves responses[path], a list of
+    (status, body) pairs returned in turn, the last one repeats. Every 
+    response is delayed by latency seconds and requests records 
+    (path, client_address) as well as request_times.
+    
+    '''
+    daemon_threads = True
+    def __init__(self, responses, latency=0):
+        self.responses = responses
+        self.latency = latency
+        self.requests = []
+        self.request_times = []
+        self.lock = threading.Lock()
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), _LocalHandler)
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def url(self, path):
+        return 'http://127.0.0.1:{}{}'.format(self.server_address[1], path)
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+class _LocalHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    def do_GET(self):
+        with self.server.lock:
+            self.server.requests.append((self.path, self.client_address))
+            self.server.request_times.append(time.time())
+            path_responses = self.server.responses.get(self.path, [(404, 'not found')])
+            status, body = (path_responses.pop(0) if len(path_responses) > 1 
+                            else path_responses[0])
+        time.sleep(self.server.latency)
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
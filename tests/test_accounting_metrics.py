@@ -6,9 +6,15 @@ Created on Sep 12, 2013
 
 import unittest
 from financial_fundamentals.accounting_metrics import AccountingMetricGetter,\
-    QuarterlyEPS
+    QuarterlyEPS, AccountingMetric
+from financial_fundamentals import xbrl
 from financial_fundamentals.edgar import HTMLEdgarDriver
 import datetime
+import mock
+import numpy as np
+import os
+from tests.infrastructure import TEST_DOCS_DIR
+from financial_fundamentals.sec_filing import Filing
 
 class TestAccountingMetricGetter(unittest.TestCase):
     def test_google(self):
@@ -27,6 +33,106 @@ class TestAccountingMetricGetter(unittest.TestCase):
         date = datetime.date(2013, 4, 25)  #Google filed on this date.
         interval_start, _, _ = getter.get_data(symbol='goog', date=date)
         self.assertEqual(interval_start, datetime.date(2012, 10, 30))
+
+
+class TestRegisteredMetrics(unittest.TestCase):
+    def test_extracted_together(self):
+        '''metrics of the same filing type come out of the filing together.'''
+        quarterly_assets, annual_assets = mock.Mock(), mock.Mock()
+        quarterly_assets.filing_type, annual_assets.filing_type = '10-Q', '10-K'
+        filing = mock.Mock()
+        filing.date = datetime.date(2012, 12, 1)
+        filing.next_filing = None
+        filing.extract.return_value = {QuarterlyEPS : 1.5, quarterly_assets : 100.}
+        filing_getter = mock.Mock()
+        filing_getter.get_filing.return_value = filing
+        getter = AccountingMetricGetter(metric=QuarterlyEPS,
+                                        filing_getter=filing_getter,
+                                        metrics=[QuarterlyEPS, quarterly_assets, annual_assets])
+        _, value, _ = getter.get_data(symbol='ABC', date=datetime.date(2013, 1, 2))
+        self.assertEqual(value, 1.5)
+        filing.extract.assert_called_once_with([QuarterlyEPS, quarterly_assets])
+
+    @mock.patch('financial_fundamentals.document_store.get_document')
+    def test_one_parse(self, get_document):
+        '''getters for two metrics of one filing type parse each filing once.'''
+        class QuarterlyNetIncome(AccountingMetric):
+            xbrl_tags = ['us-gaap:NetIncomeLoss']
+            filing_type = '10-Q'
+            name = 'quarterly_net_income'
+        with open(os.path.join(TEST_DOCS_DIR, 'aapl-20121229.xml'), 'rb') as f:
+            get_document.return_value = f.read()
+        filings = [Filing.from_xbrl_url(filing_date=datetime.date(2013, 1, 24),
+                                        xbrl_url='http://sec.gov/aapl-20121229.xml')]
+        filing_getter = mock.Mock()
+        filing_getter.get_filings.return_value = filings
+        metrics = [QuarterlyEPS, QuarterlyNetIncome]
+        eps_getter, income_getter = [AccountingMetricGetter(metric=metric,
+                                                            filing_getter=filing_getter,
+                                                            metrics=metrics)
+                                     for metric in metrics]
+        with mock.patch.object(xbrl, 'parse_instance', 
+                               wraps=xbrl.parse_instance) as parse_instance:
+            [(_, eps, _)] = eps_getter.get_all_data(symbol='aapl')
+            [(_, income, _)] = income_getter.get_all_data(symbol='aapl')
+        self.assertEqual(eps, 13.81)
+        self.assertFalse(np.isnan(income))
+        self.assertEqual(parse_instance.call_count, 1)
+
+
+class TestIterAllData(unittest.TestCase):
+    @mock.patch('financial_fundamentals.document_store.get_document')
+    def test_iter_all_data(self, get_document):
+        '''filings are parsed in a process pool, symbols come back in order.'''
+        with open(os.path.join(TEST_DOCS_DIR, 'aapl-20121229.xml'), 'rb') as f:
+            aapl = f.read()
+        get_document.side_effect = lambda url : aapl if 'aapl' in url else '<xbrl/>'
+        def get_filings(ticker, filing_type):
+            filings = [Filing.from_xbrl_url(filing_date=datetime.date(2013, 1, 24),
+                                            xbrl_url='http://sec.gov/{}-20121229.xml'.format(ticker)),
+                       Filing.from_xbrl_url(filing_date=datetime.date(2013, 4, 24),
+                                            xbrl_url='http://sec.gov/empty.xml')]
+            filings[0].next_filing = filings[1]
+            return filings
+        filing_getter = mock.Mock()
+        filing_getter.get_filings.side_effect = get_filings
+        getter = AccountingMetricGetter(metric=QuarterlyEPS, filing_getter=filing_getter)
+        symbol_intervals = list(getter.iter_all_data(['aapl', 'abc'], processes=2))
+        self.assertEqual([symbol for symbol, _ in symbol_intervals], ['aapl', 'abc'])
+        aapl_intervals = symbol_intervals[0][1]
+        self.assertEqual(aapl_intervals[0], (datetime.date(2013, 1, 24), 13.81,
+                                             datetime.date(2013, 4, 24)))
+        self.assertTrue(all(np.isnan(value) for _, value, _ in 
+                            aapl_intervals[1:] + symbol_intervals[1][1]))
+
+    @mock.patch('financial_fundamentals.document_store.get_document')
+    def test_shared_filings(self, get_document):
+        '''a repeated symbol, and tickers with the same filings, get their own 
+        filings' values and each document is parsed once.
+        
+        '''
+        with open(os.path.join(TEST_DOCS_DIR, 'aapl-20121229.xml'), 'rb') as f:
+            aapl = f.read()
+        get_document.side_effect = lambda url : aapl if 'aapl' in url else '<xbrl/>'
+        aapl_filings = [Filing.from_xbrl_url(filing_date=datetime.date(2013, 1, 24),
+                                             xbrl_url='http://sec.gov/aapl-20121229.xml')]
+        # two share classes of one company, filings are looked up by CIK.
+        abc_filings = [Filing.from_xbrl_url(filing_date=datetime.date(2013, 1, 24),
+                                            xbrl_url='http://sec.gov/abc-20121229.xml')]
+        ticker_filings = {'aapl' : aapl_filings, 'abc-a' : abc_filings, 'abc-b' : abc_filings}
+        filing_getter = mock.Mock()
+        filing_getter.get_filings.side_effect = lambda ticker, filing_type : ticker_filings[ticker]
+        getter = AccountingMetricGetter(metric=QuarterlyEPS, filing_getter=filing_getter)
+        symbol_intervals = list(getter.iter_all_data(['aapl', 'aapl', 'abc-a', 'abc-b'], 
+                                                     processes=1))
+        self.assertEqual([symbol for symbol, _ in symbol_intervals], 
+                         ['aapl', 'aapl', 'abc-a', 'abc-b'])
+        for _, intervals in symbol_intervals[:2]:
+            self.assertEqual(intervals, [(datetime.date(2013, 1, 24), 13.81, None)])
+        for _, intervals in symbol_intervals[2:]:
+            self.assertTrue(np.isnan(intervals[0][1]))
+        self.assertEqual(sorted(call[0][0] for call in get_document.call_args_list),
+                         ['http://sec.gov/aapl-20121229.xml', 'http://sec.gov/abc-20121229.xml'])
         
 if __name__ == '__main__':
     suite = unittest.TestSuite()
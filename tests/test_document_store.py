@@ -0,0 +1,105 @@
+import unittest
+import os
+import shutil
+import tempfile
+import mock
+from financial_fundamentals import document_store
+from financial_fundamentals.document_store import RawDocumentStore,\
+    DocumentNotStored
+
+
+class RawDocumentStoreTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = RawDocumentStore(directory=self.directory)
+        self.download = mock.Mock(side_effect=lambda url : 'content of ' + url)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_fetch(self):
+        url = 'http://sec.gov/abc.xml'
+        self.assertEqual(self.store.fetch(url, download=self.download), 
+                         'content of ' + url)
+        self.assertEqual(self.store.fetch(url, download=self.download), 
+                         'content of ' + url)
+        self.assertEqual(self.download.call_count, 1)
+        self.store.fetch(url, download=self.download, refresh=True)
+        self.assertEqual(self.download.call_count, 2)
+
+    def test_persistent(self):
+        url = 'http://sec.gov/abc.xml'
+        self.store.fetch(url, download=self.download)
+        store = RawDocumentStore(directory=self.directory, offline=True)
+        self.assertEqual(store.fetch(url, download=self.download, refresh=True), 
+                         'content of ' + url)
+        self.assertEqual(self.download.call_count, 1)
+
+    def test_offline(self):
+        store = RawDocumentStore(directory=self.directory, offline=True)
+        self.assertRaises(DocumentNotStored,
+                          lambda : store.fetch('http://sec.gov/abc.xml', 
+                                               download=self.download))
+        self.assertFalse(self.download.called)
+
+    def test_content_addressed(self):
+        '''the same content at two urls is stored once.'''
+        self.store.set('http://sec.gov/a.xml', 'same')
+        size = self.store.size()
+        self.store.set('http://sec.gov/b.xml', 'same')
+        self.assertEqual(self.store.size(), size)
+        self.assertEqual(self.store.get('http://sec.gov/b.xml'), 'same')
+
+    def test_eviction(self):
+        content = os.urandom(1000)
+        self.store.max_bytes = 2500
+        for url in ('a', 'b', 'c'):
+            self.store.set(url, content + url)
+        self.assertLessEqual(self.store.size(), 2500)
+        self.assertIsNone(self.store.get('a'))
+        self.assertEqual(self.store.get('c'), content + 'c')
+
+    def test_truncated_blob(self):
+        '''a blob cut short is a miss, fetching downloads it again.'''
+        url = 'http://sec.gov/abc.xml'
+        self.store.fetch(url, download=self.download)
+        digest = self.store._connection.execute('SELECT digest FROM urls').fetchone()[0]
+        path = self.store._blob_path(digest)
+        with open(path, 'r+b') as blob:
+            blob.truncate(5)
+        self.assertIsNone(self.store.get(url))
+        self.assertEqual(self.store.fetch(url, download=self.download), 
+                         'content of ' + url)
+        self.assertEqual(self.download.call_count, 2)
+        self.assertEqual(os.listdir(os.path.dirname(path)), [os.path.basename(path)])
+
+
+class IterDocumentsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.urls = ['http://sec.gov/{}.xml'.format(i) for i in range(5)]
+
+    def tearDown(self):
+        document_store.configure(None)
+        shutil.rmtree(self.directory)
+
+    @mock.patch('financial_fundamentals.document_store._download',
+                side_effect=lambda url : 'content of ' + url)
+    def test_without_store(self, download):
+        '''without a store documents are still downloaded in concurrent batches.'''
+        document_store.configure(None)
+        with mock.patch('financial_fundamentals.sessions.concurrent_map',
+                        wraps=document_store.sessions.concurrent_map) as concurrent_map:
+            contents = list(document_store.iter_documents(self.urls, batch_size=2))
+        self.assertEqual(contents, ['content of ' + url for url in self.urls])
+        self.assertEqual([call[0][1] for call in concurrent_map.call_args_list],
+                         [self.urls[:2], self.urls[2:4], self.urls[4:]])
+
+    @mock.patch('financial_fundamentals.document_store._download',
+                side_effect=lambda url : 'content of ' + url)
+    def test_with_store(self, download):
+        document_store.configure(self.directory)
+        list(document_store.iter_documents(self.urls))
+        contents = list(document_store.iter_documents(self.urls))
+        self.assertEqual(contents, ['content of ' + url for url in self.urls])
+        self.assertEqual(download.call_count, len(self.urls))
@@ -7,12 +7,22 @@ Created on Sep 12, 2013
 import mock
 import unittest
 from datetime import date
-from tests.infrastructure import turn_on_request_caching, TEST_DOCS_DIR
+from tests.infrastructure import turn_on_request_caching, TEST_DOCS_DIR,\
+    LocalHTTPServer, turn_off_request_caching
 import os
+import time
 from financial_fundamentals.edgar import HTMLEdgarDriver, XBRLNotAvailable,\
-    Filing
+    Filing, FullIndexEdgarDriver, parse_full_index, read_company_tickers
 import datetime
 import urlparse
+from financial_fundamentals.memory_cache import LRUCache
+from financial_fundamentals.sqlite_drivers import SQLiteFilingIndex,\
+    SQLiteTickerCIKs
+from financial_fundamentals.xbrl import XBRLDocument
+from financial_fundamentals import sessions, document_store
+from financial_fundamentals.accounting_metrics import AccountingMetricGetter,\
+    QuarterlyEPS
+from StringIO import StringIO
 
 class TestsEdgar(unittest.TestCase):
     def setUp(self):
@@ -35,14 +45,14 @@ class TestsEdgar(unittest.TestCase):
                                                 date_after=date(2010, 1, 04))
         self.assertTrue(filing._document._xbrl_url.endswith('.xml'))
         
-    @mock.patch('requests.models.Response.text', new_callable=mock.PropertyMock)
-    def test_ABBV(self, text):
+    @mock.patch('financial_fundamentals.document_store.get_document')
+    def test_ABBV(self, get_document):
         '''Test page with no 10-Q's, downloaded 2013-3-2, 
         ABBV had just been spun off or something.
         
         '''
         with open(os.path.join(TEST_DOCS_DIR, 'abbv_search_results.html')) as test_html:
-            text.return_value = test_html.read()
+            get_document.return_value = test_html.read()
 
         ticker = 'ABBV'
         self.assertFalse(list(HTMLEdgarDriver._get_document_page_urls(symbol=ticker, 
@@ -64,6 +74,8 @@ class TestsEdgar(unittest.TestCase):
                         datetime.date(2012, 12, 15),
                         datetime.date(2012, 12, 5)]
         class TestDriver(HTMLEdgarDriver):
+            _ticker_ciks = None
+            _persistent_index = None
             @classmethod
             def _get_document_page_urls(cls, *args, **kwargs):
                 return iter(filing_dates)
@@ -89,12 +101,348 @@ class TestsEdgar(unittest.TestCase):
                               filing_type=None, 
                               date_after=datetime.date(2012, 12, 16))
             
+    def test_get_filings(self):
+        '''every filing is linked to the one after it.'''
+        filing_dates = [datetime.date(2012, 12, 5),
+                        datetime.date(2012, 12, 1),
+                        datetime.date(2012, 12, 3)]
+        class TestDriver(HTMLEdgarDriver):
+            _ticker_ciks = None
+            _filing_index = LRUCache()
+            _persistent_index = None
+            @classmethod
+            def _get_document_page_urls(cls, *args, **kwargs):
+                return iter(filing_dates)
+                
+            @classmethod
+            def _get_filing_from_document_page(cls, date):
+                return Filing(filing_date=date, document=None)
+
+        filings = TestDriver.get_filings(ticker=None, filing_type=None)
+        self.assertEqual([filing.date for filing in filings], sorted(filing_dates))
+        self.assertEqual([filing.next_filing and filing.next_filing.date for filing in filings],
+                         sorted(filing_dates)[1:] + [None])
+
+    def test_filing_index_is_lazy(self):
+        '''the second request for a ticker and filing type doesn't crawl Edgar.'''
+        crawled = []
+        class TestDriver(HTMLEdgarDriver):
+            _ticker_ciks = None
+            _filing_index = LRUCache()
+            _persistent_index = None
+            @classmethod
+            def _get_sorted_filings(cls, ticker, filing_type):
+                crawled.append((ticker, filing_type))
+                return [Filing(filing_date=datetime.date(2012, 12, 1), document=None)]
+
+        TestDriver.get_filings(ticker='ABC', filing_type='10-Q')
+        TestDriver.get_filings(ticker='ABC', filing_type='10-Q')
+        TestDriver.get_filings(ticker='ABC', filing_type='10-K')
+        self.assertEqual(crawled, [('ABC', '10-Q'), ('ABC', '10-K')])
+        self.assertEqual(TestDriver.filing_index_stats()['hits'], 1)
+        self.assertEqual(TestDriver.filing_index_stats()['misses'], 2)
+
+    def test_persistent_index(self):
+        '''a new process reads filings from the persistent index instead of Edgar.'''
+        crawled = []
+        filing_index = SQLiteFilingIndex(connection=SQLiteFilingIndex.connect(':memory:'))
+        def build_driver():
+            class TestDriver(HTMLEdgarDriver):
+                _ticker_ciks = None
+                _filing_index = LRUCache()
+                _persistent_index = None
+                @classmethod
+                def _get_sorted_filings(cls, ticker, filing_type):
+                    crawled.append(ticker)
+                    return [Filing(filing_date=datetime.date(2012, 12, 1),
+                                   document=XBRLDocument('http://sec.gov/abc-20121201.xml'),
+                                   cik='123')]
+            TestDriver.use_persistent_index(filing_index)
+            return TestDriver
+
+        build_driver().get_filings(ticker='ABC', filing_type='10-Q')
+        filings = build_driver().get_filings(ticker='ABC', filing_type='10-Q')
+        self.assertEqual(crawled, ['ABC'])
+        self.assertEqual(filings[0].date, datetime.date(2012, 12, 1))
+        self.assertEqual(filings[0].xbrl_url, 'http://sec.gov/abc-20121201.xml')
+        self.assertEqual(filings[0].cik, '123')
+
+    def test_refresh(self):
+        '''only search results filed since the newest known filing are fetched.'''
+        search_results = [(datetime.date(2012, 12, 5), 'page/3'),
+                          (datetime.date(2012, 12, 3), 'page/2'),
+                          (datetime.date(2012, 12, 1), 'page/1')]
+        fetched = []
+        filing_index = SQLiteFilingIndex(connection=SQLiteFilingIndex.connect(':memory:'))
+        class TestDriver(HTMLEdgarDriver):
+            _ticker_ciks = None
+            _filing_index = LRUCache()
+            _persistent_index = filing_index
+            @classmethod
+            def _get_search_results(cls, symbol, filing_type):
+                return iter(search_results)
+
+            @classmethod
+            def _get_filing_from_document_page(cls, url):
+                fetched.append(url)
+                filing_date = dict((url, date) for date, url in search_results)[url]
+                return Filing.from_xbrl_url(filing_date=filing_date,
+                                            xbrl_url='http://sec.gov/{}.xml'.format(url))
+
+        self.assertEqual(len(TestDriver.get_filings(ticker='ABC', filing_type='10-Q')), 3)
+        search_results.insert(0, (datetime.date(2013, 3, 5), 'page/4'))
+        del fetched[:]
+        new_filings = TestDriver.refresh(ticker='ABC', filing_type='10-Q')
+        self.assertEqual([filing.date for filing in new_filings], [datetime.date(2013, 3, 5)])
+        self.assertEqual(sorted(fetched), ['page/3', 'page/4'])
+        filings = TestDriver.get_filings(ticker='ABC', filing_type='10-Q')
+        self.assertEqual(len(filings), 4)
+        self.assertIs(filings[2].next_filing, new_filings[0])
+        self.assertEqual(len(filing_index.get(ticker='ABC', filing_type='10-Q')), 4)
+        self.assertEqual(TestDriver.refresh(ticker='ABC', filing_type='10-Q'), [])
+
+    def test_read_company_tickers(self):
+        with open(os.path.join(TEST_DOCS_DIR, 'company_tickers.json')) as f:
+            ticker_ciks = {ticker : cik for ticker, cik, _ in read_company_tickers(f)}
+        self.assertEqual(ticker_ciks['BRK-B'], 1067983)
+        self.assertEqual(ticker_ciks['AAPL'], 320193)
+
+    @mock.patch('financial_fundamentals.document_store.get_document')
+    def test_search_by_cik(self, get_document):
+        '''searches use the CIK, filings are indexed under it.'''
+        with open(os.path.join(TEST_DOCS_DIR, 'abbv_search_results.html')) as test_html:
+            get_document.return_value = test_html.read()
+        ticker_ciks = SQLiteTickerCIKs(connection=SQLiteTickerCIKs.connect(':memory:'))
+        with open(os.path.join(TEST_DOCS_DIR, 'company_tickers.json')) as f:
+            ticker_ciks.set(read_company_tickers(f))
+        filing_index = SQLiteFilingIndex(connection=SQLiteFilingIndex.connect(':memory:'))
+        class TestDriver(HTMLEdgarDriver):
+            _ticker_ciks = None
+            _filing_index = LRUCache()
+            _persistent_index = filing_index
+        TestDriver.use_ticker_ciks(ticker_ciks)
+        self.assertEqual(len(TestDriver.get_filings(ticker='abbv', filing_type='10-Q')), 0)
+        search_url = get_document.call_args[0][0]
+        self.assertIn('CIK=1551152&', search_url)
+        self.assertEqual(filing_index.get(ticker='1551152', filing_type='10-Q'), [])
+        TestDriver.get_filings(ticker='ABBV', filing_type='10-Q')
+        self.assertEqual(TestDriver.filing_index_stats()['hits'], 1)
+        # share classes are written with a dash in Edgar.
+        TestDriver.get_filings(ticker='BRK.B', filing_type='10-Q')
+        self.assertIn('CIK=1067983&', get_document.call_args[0][0])
+        # unknown tickers are still searched for by ticker.
+        TestDriver.get_filings(ticker='XYZ', filing_type='10-Q')
+        self.assertIn('CIK=XYZ&', get_document.call_args[0][0])
+
     def test_JCP(self):
         '''was getting a non-xbrl doc back.'''
         document_page_that_failed = 'http://sec.gov/Archives/edgar/data/1166126/000116612613000041/0001166126-13-000041-index.htm'
         filing = HTMLEdgarDriver._get_filing_from_document_page(document_page_url=document_page_that_failed)
         self.assertEqual(filing._document._xbrl_url.split('/')[-1], 'jcp-20130504.xml')
         
+
+DOCUMENT_PAGE = '''<html><body>
+<div class="formGrouping"><div class="infoHead">Filing Date</div>
+<div class="info">{filing_date}</div></div>
+<table><tr><td><a href="/Archives/edgar/data/{cik}/{accession}/abc-{filing_date}.xml">abc-{filing_date}.xml</a></td>
+<td>EX-101.INS</td></tr></table>
+</body></html>'''
+
+class ConcurrentCrawlTestCase(unittest.TestCase):
+    '''Crawl document pages served by a local server that takes .1s to respond.'''
+    def setUp(self):
+        turn_off_request_caching()
+        document_store.configure(directory=None)
+        sessions.configure(max_requests_per_second=None)
+        self.filing_dates = [datetime.date(2010 + i // 4, 1 + 3 * (i % 4), 15) 
+                             for i in range(12)]
+        responses = {}
+        self.page_urls = {}
+        for i, filing_date in enumerate(self.filing_dates):
+            ticker = 'ABC' if i % 2 else 'XYZ'
+            path = '/Archives/edgar/data/{}/{}/{}-index.htm'.format(100 + i % 2, i, i)
+            responses[path] = [(200, DOCUMENT_PAGE.format(filing_date=filing_date,
+                                                          cik=100 + i % 2,
+                                                          accession=i))]
+            self.page_urls.setdefault(ticker, []).append(path)
+        self.server = LocalHTTPServer(responses=responses, latency=.1)
+        server = self.server
+        page_urls = self.page_urls
+        class TestDriver(HTMLEdgarDriver):
+            _ticker_ciks = None
+            _filing_index = LRUCache()
+            _persistent_index = None
+            @classmethod
+            def _search(cls, search_key, filing_type):
+                return ((None, server.url(path)) for path in page_urls[search_key])
+        self.driver = TestDriver
+
+    def tearDown(self):
+        self.server.stop()
+        sessions.configure()
+
+    def test_same_filings(self):
+        self.driver.crawl_workers = 1
+        start = time.time()
+        sequential = self.driver._get_sorted_filings(ticker='ABC', filing_type='10-Q')
+        sequential_time = time.time() - start
+        self.driver.crawl_workers = 6
+        start = time.time()
+        concurrent = self.driver._get_sorted_filings(ticker='ABC', filing_type='10-Q')
+        concurrent_time = time.time() - start
+        self.assertEqual([(filing.date, filing.xbrl_url, filing.cik) for filing in concurrent],
+                         [(filing.date, filing.xbrl_url, filing.cik) for filing in sequential])
+        self.assertEqual([filing.date for filing in concurrent], self.filing_dates[1::2])
+        self.assertLess(concurrent_time, sequential_time / 2)
+
+    def test_rate_limited(self):
+        sessions.configure(max_requests_per_second=20)
+        self.driver.crawl_workers = 6
+        start = time.time()
+        self.driver._get_sorted_filings(ticker='ABC', filing_type='10-Q')
+        # the first request goes right away, then one every 1/20s.
+        self.assertGreaterEqual(time.time() - start, .2)
+        request_times = sorted(self.server.request_times)
+        self.assertGreaterEqual(request_times[-1] - request_times[0], .2)
+
+    def test_index_tickers(self):
+        filing_index = SQLiteFilingIndex(connection=SQLiteFilingIndex.connect(':memory:'))
+        self.driver.use_persistent_index(filing_index)
+        self.driver.index_tickers(['ABC', 'XYZ'], filing_type='10-Q')
+        self.assertEqual(len(self.server.requests), len(self.filing_dates))
+        for ticker, dates in (('ABC', self.filing_dates[1::2]), 
+                              ('XYZ', self.filing_dates[::2])):
+            filings = self.driver.get_filings(ticker=ticker, filing_type='10-Q')
+            self.assertEqual([filing.date for filing in filings], dates)
+            self.assertEqual([filing_date for filing_date, _, _ in 
+                              filing_index.get(ticker=ticker, filing_type='10-Q')],
+                             dates)
+        self.assertEqual(self.driver.filing_index_stats()['misses'], 0)
+        self.driver.index_tickers(['ABC', 'XYZ'], filing_type='10-Q')
+        self.assertEqual(len(self.server.requests), len(self.filing_dates))
+
+    def test_index_tickers_by_cik(self):
+        '''CIKs are read from the SQLite ticker table on the calling thread.'''
+        ticker_ciks = SQLiteTickerCIKs(connection=SQLiteTickerCIKs.connect(':memory:'))
+        ticker_ciks.set([('ABC', 101, None), ('XYZ', 100, None)])
+        self.page_urls['101'] = self.page_urls['ABC']
+        self.page_urls['100'] = self.page_urls['XYZ']
+        self.driver.use_ticker_ciks(ticker_ciks)
+        self.driver.crawl_workers = 4
+        self.driver.index_tickers(['ABC', 'XYZ'], filing_type='10-Q')
+        self.assertEqual(len(self.server.requests), len(self.filing_dates))
+        filings = self.driver.get_filings(ticker='ABC', filing_type='10-Q')
+        self.assertEqual([filing.date for filing in filings], self.filing_dates[1::2])
+        self.assertEqual(self.driver.filing_index_stats()['misses'], 0)
+
+# an older index, dates without dashes.
+QTR3_INDEX = '''CIK|Company Name|Form Type|Date Filed|Filename
+--------------------------------------------------------------------------------
+320193|APPLE INC|10-Q|20120725|edgar/data/320193/0001193125-12-314552.txt
+320193|APPLE INC|10-K|20121031|edgar/data/320193/0001193125-12-444068.txt
+'''
+
+class FullIndexEdgarDriverTestCase(unittest.TestCase):
+    def setUp(self):
+        class TestDriver(FullIndexEdgarDriver):
+            _filing_index = LRUCache()
+            _persistent_index = None
+        TestDriver.load_full_index([os.path.join(TEST_DOCS_DIR, 'xbrl.idx'), 
+                                    StringIO(QTR3_INDEX)],
+                                   ticker_ciks={'aapl' : '0000320193', 'JCP' : 1166126})
+        self.driver = TestDriver
+
+    def test_parse_full_index(self):
+        with open(os.path.join(TEST_DOCS_DIR, 'xbrl.idx')) as index_file:
+            entries = list(parse_full_index(index_file))
+        self.assertEqual(len(entries), 5)
+        self.assertEqual(entries[2], 
+                         (320193, '10-Q', datetime.date(2013, 1, 24),
+                          'http://www.sec.gov/Archives/edgar/data/320193/'
+                          '000119312513022339/0001193125-13-022339-index.htm'))
+
+    @mock.patch('financial_fundamentals.document_store.get_document')
+    def test_get_filings(self, get_document):
+        '''filings come from the index, nothing is fetched until a url is needed.'''
+        get_document.side_effect = AssertionError('fetched')
+        filings = self.driver.get_filings(ticker='AAPL', filing_type='10-Q')
+        self.assertEqual([filing.date for filing in filings],
+                         [datetime.date(2012, 7, 25), datetime.date(2013, 1, 24)])
+        self.assertEqual({filing.cik for filing in filings}, {'320193'})
+        self.assertIs(filings[0].next_filing, filings[1])
+        self.assertEqual(len(self.driver.get_filings(ticker='AAPL', filing_type='10-K')), 1)
+        self.assertRaises(XBRLNotAvailable,
+                          lambda : self.driver.get_filings(ticker='XYZ', filing_type='10-Q'))
+
+    @mock.patch('financial_fundamentals.document_store.get_document')
+    def test_persistent_index_stays_lazy(self, get_document):
+        '''filings are indexed under their document pages until they're looked up.'''
+        get_document.side_effect = AssertionError('fetched')
+        filing_index = SQLiteFilingIndex(connection=SQLiteFilingIndex.connect(':memory:'))
+        self.driver.use_persistent_index(filing_index)
+        self.driver.get_filings(ticker='AAPL', filing_type='10-Q')
+        indexed_urls = [url for _, _, url in 
+                        filing_index.get(ticker='320193', filing_type='10-Q')]
+        self.assertEqual(len(indexed_urls), 2)
+        self.assertTrue(all(url.endswith('-index.htm') for url in indexed_urls))
+        ticker_ciks = self.driver._ticker_ciks
+        class RestartedDriver(FullIndexEdgarDriver):
+            _filing_index = LRUCache()
+            _persistent_index = filing_index
+            _ticker_ciks = ticker_ciks
+        filings = RestartedDriver.get_filings(ticker='AAPL', filing_type='10-Q')
+        self.assertEqual([filing.date for filing in filings],
+                         [datetime.date(2012, 7, 25), datetime.date(2013, 1, 24)])
+        get_document.side_effect = None
+        get_document.return_value = DOCUMENT_PAGE.format(filing_date='2013-01-24',
+                                                         cik=320193,
+                                                         accession='000119312513022339')
+        self.assertEqual(filings[1].xbrl_url,
+                         'http://www.sec.gov/Archives/edgar/data/320193/'
+                         '000119312513022339/abc-2013-01-24.xml')
+
+    @mock.patch('financial_fundamentals.document_store.get_document')
+    def test_stands_in_for_html_driver(self, get_document):
+        '''the XBRL url is read from the document page when the filing is parsed.'''
+        with open(os.path.join(TEST_DOCS_DIR, 'aapl-20121229.xml'), 'rb') as f:
+            instance = f.read()
+        document_page = DOCUMENT_PAGE.format(filing_date='2013-01-24',
+                                             cik=320193,
+                                             accession='000119312513022339')
+        get_document.side_effect = lambda url, refresh=False : \
+            document_page if url.endswith('-index.htm') else instance
+        getter = AccountingMetricGetter(metric=QuarterlyEPS, filing_getter=self.driver)
+        start, value, end = getter.get_data(symbol='AAPL', date=datetime.date(2013, 2, 1))
+        self.assertEqual((start, value, end), (datetime.date(2013, 1, 24), 13.81, None))
+        filing = self.driver.get_filing(ticker='AAPL', filing_type='10-Q', 
+                                        date_after=datetime.date(2013, 2, 1))
+        self.assertEqual(filing.xbrl_url, 
+                         'http://www.sec.gov/Archives/edgar/data/320193/'
+                         '000119312513022339/abc-2013-01-24.xml')
+
+    @mock.patch('financial_fundamentals.document_store.get_document')
+    def test_refresh(self, get_document):
+        '''filings in a newly loaded index are added to the ones already known.'''
+        get_document.side_effect = lambda url, refresh=False : \
+            DOCUMENT_PAGE.format(filing_date='2013', cik=320193, accession=url.split('/')[-2])
+        self.driver.get_filings(ticker='AAPL', filing_type='10-Q')
+        qtr2_index = QTR3_INDEX.replace('20120725|edgar/data/320193/0001193125-12-314552',
+                                        '20130424|edgar/data/320193/0001193125-13-168288')
+        self.driver.load_full_index([StringIO(qtr2_index)],
+                                    ticker_ciks={'AAPL' : 320193})
+        new_filings = self.driver.refresh(ticker='AAPL', filing_type='10-Q')
+        self.assertEqual([filing.date for filing in new_filings], [datetime.date(2013, 4, 24)])
+        self.assertEqual(len(self.driver.get_filings(ticker='AAPL', filing_type='10-Q')), 3)
+        # only the newest known filing's and the new filing's pages were read.
+        self.assertEqual(get_document.call_count, 2)
+
+    @mock.patch('financial_fundamentals.document_store.get_document')
+    def test_no_instance_document(self, get_document):
+        get_document.return_value = '<html><body>no exhibits</body></html>'
+        filing = self.driver.get_filings(ticker='JCP', filing_type='10-K')[0]
+        self.assertIsNone(filing.xbrl_url)
+        self.assertEqual(filing.extract([QuarterlyEPS]), {})
+
 if __name__ == '__main__':
     suite = unittest.TestSuite()
     suite.addTest(TestsEdgar('test_JCP'))
@@ -0,0 +1,82 @@
+import unittest
+import datetime
+import numpy as np
+import pytz
+from financial_fundamentals.memory_cache import LRUCache, MemoryTier
+from financial_fundamentals.sqlite_drivers import SQLiteTimeseries,\
+    SQLiteIntervalseries
+
+
+class LRUCacheTestCase(unittest.TestCase):
+    def test_lazy_build(self):
+        cache = LRUCache(maxsize=2)
+        builds = []
+        build = lambda : builds.append(1) or len(builds)
+        self.assertEqual(cache.get('a', build), 1)
+        self.assertEqual(cache.get('a', build), 1)
+        self.assertEqual(len(builds), 1)
+        self.assertEqual(cache.stats()['hits'], 1)
+        self.assertEqual(cache.stats()['misses'], 1)
+
+    def test_eviction(self):
+        cache = LRUCache(maxsize=2)
+        cache['a'] = 1
+        cache['b'] = 2
+        cache.get('a', lambda : None) # a is now more recent than b.
+        cache['c'] = 3
+        self.assertIn('a', cache)
+        self.assertNotIn('b', cache)
+        self.assertEqual(len(cache), 2)
+
+    def test_byte_budget(self):
+        cache = LRUCache(max_bytes=250, sizeof=lambda value : value)
+        cache['a'] = 100
+        cache['b'] = 100
+        cache['c'] = 100
+        self.assertNotIn('a', cache)
+        self.assertEqual(cache.stats()['bytes'], 200)
+        cache['d'] = 300 # bigger than the budget, isn't kept.
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.bytes, 0)
+
+    def test_invalidate(self):
+        cache = LRUCache()
+        cache[('ABC', 1)] = 1
+        cache[('XYZ', 1)] = 2
+        cache.invalidate(lambda key : key[0] == 'ABC')
+        self.assertEqual(len(cache), 1)
+        self.assertIn(('XYZ', 1), cache)
+
+
+class MemoryTierTestCase(unittest.TestCase):
+    def test_timeseries(self):
+        '''repeated reads come from memory, writing a symbol invalidates it.'''
+        driver = SQLiteTimeseries(connection=SQLiteTimeseries.connect(':memory:'), 
+                                  table='price', 
+                                  metric='Adj Close')
+        tier = MemoryTier(driver)
+        dates = np.array(['2012-12-03', '2012-12-04'], dtype='datetime64[ns]')
+        tier.set_array(symbol='ABC', dates=dates[:1], values=[1.])
+        tier.set_array(symbol='XYZ', dates=dates[:1], values=[5.])
+        for _ in range(3):
+            tier.get_array(symbol='ABC', dates=dates)
+            tier.get_array(symbol='XYZ', dates=dates)
+        self.assertEqual(tier.stats()['misses'], 2)
+        self.assertEqual(tier.stats()['hits'], 4)
+        tier.set_array(symbol='ABC', dates=dates[1:], values=[2.])
+        _, values = tier.get_array(symbol='ABC', dates=dates)
+        np.testing.assert_array_equal(values, [1., 2.])
+        tier.get_array(symbol='XYZ', dates=dates)
+        self.assertEqual(tier.stats()['misses'], 3)
+
+    def test_intervals(self):
+        driver = SQLiteIntervalseries(connection=SQLiteIntervalseries.connect(':memory:'), 
+                                      table='fundamentals', 
+                                      metric='EPS')
+        tier = MemoryTier(driver)
+        start = datetime.datetime(2012, 12, 3, tzinfo=pytz.UTC)
+        self.assertEqual(tier.get_intervals(symbol='ABC'), [])
+        tier.set_interval(symbol='ABC', start=start, end=None, value=1.)
+        self.assertEqual(len(tier.get_intervals(symbol='ABC')), 1)
+        self.assertEqual(len(tier.get_intervals(symbol='ABC')), 1)
+        self.assertEqual(tier.stats()['hits'], 1)
@@ -7,7 +7,9 @@ Created on Sep 12, 2013
 import unittest
 import pymongo
 from financial_fundamentals.mongo_drivers import MongoIntervalseries,\
-    MongoTimeseries
+    MongoTimeseries, MongoBucketTimeseries, migrate_to_buckets, get_client,\
+    configure_clients
+import numpy as np
 import pytz
 from tests.infrastructure import IntervalseriesTestCase
 class MongoTestCase(unittest.TestCase):
@@ -33,6 +35,14 @@ class MongoIntervalSeriesTestCase(MongoTestCase, IntervalseriesTestCase):
         
     def insert_into_database(self, data):
         self.collection.insert(data)
+
+    def test_unique_start(self):
+        '''setting an interval that starts on a stored start replaces it.'''
+        import datetime
+        start, end = datetime.datetime(2012, 12, 1), datetime.datetime(2012, 12, 31)
+        self.cache.set_interval(symbol='ABC', start=start, end=None, value=1.)
+        self.cache.set_intervals(symbol='ABC', intervals=[(start, end, 2.)])
+        self.assertEqual(self.cache.get_intervals(symbol='ABC'), [(start, end, 2.)])
         
 class MongoTimeSeriesTestCase(MongoTestCase):
     metric = 'price'
@@ -65,4 +75,71 @@ class MongoTimeSeriesTestCase(MongoTestCase):
         test_data = self.collection.find({'symbol' : symbol})[0]
         self.assertEqual(test_data[metric], price)
         self.assertEqual(test_data['symbol'], symbol)
-        
\ No newline at end of file
+        
+    def test_set_batches(self):
+        '''records are written in batches, setting a date again replaces it.'''
+        import datetime
+        self.cache.batch_size = 2
+        dates = [datetime.datetime(2012, 12, day) for day in range(1, 6)]
+        self.cache.set(symbol='ABC', records=[(date, 1.) for date in dates])
+        self.cache.set(symbol='ABC', records=[(dates[0], 2.)])
+        self.assertEqual(self.collection.find({'symbol' : 'ABC'}).count(), 5)
+        self.assertEqual(self.collection.find_one({'date' : dates[0]})[self.metric], 2.)
+
+
+class MongoBucketTimeseriesTestCase(MongoTestCase):
+    metric = 'price'
+    def setUp(self):
+        super(MongoBucketTimeseriesTestCase, self).setUp()
+        self.db.price_buckets.drop()
+        self.cache = MongoBucketTimeseries(self.db.price_buckets, self.metric)
+
+    def test_arrays(self):
+        '''values are stored a document a year, setting a date again replaces it.'''
+        dates = np.array(['2011-12-30', '2012-01-03', '2012-12-31', '2013-01-02'], 
+                         dtype='datetime64[ns]')
+        self.cache.set_array(symbol='ABC', dates=dates, values=[1., np.nan, 3., 4.])
+        self.cache.set_array(symbol='ABC', dates=dates[:1], values=[5.])
+        self.assertEqual(self.db.price_buckets.find({'symbol' : 'ABC'}).count(), 3)
+        cached_dates, values = self.cache.get_array(symbol='ABC', dates=dates[:3])
+        np.testing.assert_array_equal(cached_dates, dates[:3])
+        np.testing.assert_array_equal(values, [5., np.nan, 3.])
+        self.assertEqual(len(self.cache.get_array(symbol='XYZ', dates=dates)[0]), 0)
+
+    def test_get(self):
+        import datetime
+        date = datetime.datetime(2012, 12, 3, tzinfo=pytz.UTC)
+        self.cache.set(symbol='ABC', records=[(date, 1.), 
+                                              (datetime.datetime(2012, 12, 4, tzinfo=pytz.UTC), 2.)])
+        self.assertEqual(list(self.cache.get(symbol='ABC', dates=[date])), [(date, 1.)])
+
+    def test_migrate(self):
+        import datetime
+        timeseries = MongoTimeseries(self.collection, self.metric)
+        timeseries.set(symbol='ABC', records=[(datetime.datetime(2012, 12, 3), 1.),
+                                              (datetime.datetime(2013, 1, 2), 2.),
+                                              (datetime.datetime(2013, 1, 3), 'NaN')])
+        self.assertEqual(migrate_to_buckets(self.collection, 
+                                            self.db.price_buckets, 
+                                            self.metric), 1)
+        dates = np.array(['2012-12-03', '2013-01-02', '2013-01-03'], dtype='datetime64[ns]')
+        cached_dates, values = self.cache.get_array(symbol='ABC', dates=dates)
+        np.testing.assert_array_equal(cached_dates, dates[:2])
+        np.testing.assert_array_equal(values, [1., 2.])
+        missing_dates, _ = self.cache.get_missing(symbol='ABC', dates=dates)
+        np.testing.assert_array_equal(missing_dates, dates[2:])
+
+
+class MongoClientsTestCase(MongoTestCase):
+    def test_get_client(self):
+        client = get_client(self.host, self.port)
+        self.assertIs(get_client(self.host, self.port), client)
+        configure_clients(max_pool_size=10)
+        self.assertIsNot(get_client(self.host, self.port), client)
+
+    def test_indexes_after_drop(self):
+        '''a driver made after its collection is dropped creates the indexes again.'''
+        MongoTimeseries(self.collection, 'price')
+        self.collection.drop()
+        MongoTimeseries(self.collection, 'price')
+        self.assertIn('symbol_1', self.collection.index_information())
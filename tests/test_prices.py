@@ -5,8 +5,31 @@ Created on Sep 20, 2013
 '''
 import unittest
 import datetime
-from financial_fundamentals.prices import _wrapped_get_data_yahoo
+import mock
+from financial_fundamentals.prices import _wrapped_get_data_yahoo,\
+    get_prices_from_yahoo, get_price_fields_from_yahoo, CSVPriceSource
+from financial_fundamentals.exceptions import NoDataForStock
+import os
+import shutil
+import tempfile
+import numpy as np
+import pandas as pd
+import pytz
 from financial_fundamentals.exceptions import ExternalRequestFailed
+from tests.infrastructure import LocalHTTPServer
+
+YAHOO_CSV = '''Date,Open,High,Low,Close,Volume,Adj Close
+2012-12-04,10.0,11.0,9.0,10.5,1000,10.4
+2012-12-03,9.0,10.0,8.0,9.5,2000,9.4
+'''
+
+BULK_CSV = '''Date,Symbol,Close,Adj Close
+2012-12-04,ABC,10.5,10.4
+2012-12-03,XYZ,20.5,20.4
+2012-12-03,ABC,9.5,9.4
+2012-12-05,ABC,11.5,11.4
+2011-12-05,ABC,1.5,1.4
+'''
 
 
 class YahooPricesTestCase(unittest.TestCase):
@@ -16,4 +39,100 @@ class YahooPricesTestCase(unittest.TestCase):
         self.assertRaises(ExternalRequestFailed,
                           lambda : _wrapped_get_data_yahoo(symbol='BMC', 
                                                            start=start, 
-                                                           end=end))
\ No newline at end of file
+                                                           end=end))
+
+    def test_local_yahoo(self):
+        server = LocalHTTPServer(responses={'/table.csv' : [(200, YAHOO_CSV)]})
+        try:
+            with mock.patch('financial_fundamentals.prices.YAHOO_URL', 
+                            server.url('/table.csv')):
+                prices = _wrapped_get_data_yahoo(symbol='ABC', 
+                                                 start=datetime.datetime(2012, 12, 3),
+                                                 end=datetime.datetime(2012, 12, 4))
+        finally:
+            server.stop()
+        self.assertEqual(list(prices['Adj Close']), [9.4, 10.4])
+        self.assertEqual(prices.index[0], datetime.datetime(2012, 12, 3))
+
+    def test_arrays(self):
+        '''prices come back as date and value arrays sorted by date.'''
+        server = LocalHTTPServer(responses={'/table.csv' : [(200, YAHOO_CSV)]})
+        try:
+            with mock.patch('financial_fundamentals.prices.YAHOO_URL', 
+                            server.url('/table.csv')):
+                dates, values = get_prices_from_yahoo(symbol='ABC', 
+                                                      dates=np.array(['2012-12-03', '2012-12-04'],
+                                                                     dtype='datetime64[ns]'))
+        finally:
+            server.stop()
+        np.testing.assert_array_equal(dates, np.array(['2012-12-03', '2012-12-04'],
+                                                      dtype='datetime64[ns]'))
+        np.testing.assert_array_equal(values, [9.4, 10.4])
+
+    def test_short_range(self):
+        '''short ranges are widened to 30 days, not back from today.'''
+        with mock.patch('financial_fundamentals.prices._wrapped_get_data_yahoo') as get_data:
+            get_data.return_value = pd.DataFrame({'Adj Close' : [1.]}, 
+                                                 index=[datetime.datetime(1995, 6, 1)])
+            get_prices_from_yahoo(symbol='ABC', 
+                                  dates=[datetime.datetime(1995, 6, 1, tzinfo=pytz.UTC)])
+        _, kwargs = get_data.call_args
+        self.assertEqual(kwargs['start'], datetime.datetime(1995, 5, 2, tzinfo=pytz.UTC))
+        self.assertEqual(kwargs['end'], datetime.datetime(1995, 6, 1, tzinfo=pytz.UTC))
+
+    def test_fields(self):
+        '''every field comes out of one download.'''
+        server = LocalHTTPServer(responses={'/table.csv' : [(200, YAHOO_CSV)]})
+        try:
+            with mock.patch('financial_fundamentals.prices.YAHOO_URL', 
+                            server.url('/table.csv')):
+                _, values = get_price_fields_from_yahoo(symbol='ABC', 
+                                                        dates=np.array(['2012-12-03', '2012-12-04'],
+                                                                       dtype='datetime64[ns]'),
+                                                        fields=['Close', 'Volume'])
+        finally:
+            server.stop()
+        np.testing.assert_array_equal(values, [[9.5, 2000.], [10.5, 1000.]])
+        self.assertEqual(len(server.requests), 1)
+
+
+class CSVPriceSourceTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'prices.csv')
+        with open(self.path, 'w') as f:
+            f.write(BULK_CSV)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_get_many(self):
+        '''get_many returns the symbols asked for sorted by date, within the dates.'''
+        source = CSVPriceSource(self.path, fields=['Close', 'Adj Close'], chunksize=2)
+        dates = np.array(['2012-12-01', '2012-12-04'], dtype='datetime64[ns]')
+        symbol_prices = source.get_many(['ABC', 'XYZ', 'NOPE'], dates)
+        self.assertEqual(set(symbol_prices), {'ABC', 'XYZ'})
+        abc_dates, abc_values = symbol_prices['ABC']
+        np.testing.assert_array_equal(abc_dates, np.array(['2012-12-03', '2012-12-04'], 
+                                                          dtype='datetime64[ns]'))
+        np.testing.assert_array_equal(abc_values, [[9.5, 9.4], [10.5, 10.4]])
+
+    def test_get_prices(self):
+        source = CSVPriceSource(self.path)
+        dates = [datetime.datetime(2012, 12, 3, tzinfo=pytz.UTC),
+                 datetime.datetime(2012, 12, 3, tzinfo=pytz.UTC)]
+        _, values = source('XYZ', dates)
+        np.testing.assert_array_equal(values, [20.4])
+        self.assertRaises(NoDataForStock, lambda : source('NOPE', dates))
+
+    def test_read_once(self):
+        '''the file is read when the source is made, not on each call.'''
+        source = CSVPriceSource(self.path, chunksize=2)
+        os.remove(self.path)
+        dates = np.array(['2011-12-01', '2012-12-31'], dtype='datetime64[ns]')
+        abc_dates, abc_values = source('ABC', dates)
+        self.assertEqual(len(abc_dates), 4)
+        np.testing.assert_array_equal(abc_dates, np.sort(abc_dates))
+        self.assertRaises(NoDataForStock, 
+                          lambda : source('XYZ', np.array(['2013-01-01'], 
+                                                          dtype='datetime64[ns]')))
@@ -0,0 +1,24 @@
+import unittest
+import datetime
+import mock
+from financial_fundamentals.sec_filing import Filing
+from financial_fundamentals.xbrl import MetricNodeNotFound
+
+
+class FilingTestCase(unittest.TestCase):
+    def setUp(self):
+        self.eps, self.assets, self.missing = mock.Mock(), mock.Mock(), mock.Mock()
+        self.document = mock.Mock()
+        self.document.extract.return_value = {self.eps : 1.5, self.assets : 100.}
+        self.filing = Filing(filing_date=datetime.date(2012, 12, 1),
+                             document=self.document)
+
+    def test_extract_once(self):
+        '''every metric asked for is extracted in the first pass.'''
+        metrics = [self.eps, self.assets, self.missing]
+        self.assertEqual(self.filing.extract(metrics), 
+                         {self.eps : 1.5, self.assets : 100.})
+        self.assertEqual(self.filing.latest_metric_value(self.assets), 100.)
+        self.assertRaises(MetricNodeNotFound,
+                          lambda : self.filing.latest_metric_value(self.missing))
+        self.document.extract.assert_called_once_with(metrics)
@@ -0,0 +1,98 @@
+import time
+import mock
+import unittest
+from financial_fundamentals.sessions import HTTPSession, TokenBucket,\
+    concurrent_map
+from financial_fundamentals.exceptions import ExternalRequestFailed
+from financial_fundamentals import sessions
+from tests.infrastructure import LocalHTTPServer, turn_off_request_caching
+
+
+class HTTPSessionTestCase(unittest.TestCase):
+    def setUp(self):
+        turn_off_request_caching()
+        self.server = LocalHTTPServer(responses={'/doc' : [(200, 'document')],
+                                                 '/flaky' : [(503, ''), 
+                                                             (503, ''), 
+                                                             (200, 'finally')],
+                                                 '/down' : [(503, '')]})
+        self.session = HTTPSession(backoff=.01, retries=3, 
+                                   max_requests_per_second=None)
+
+    def tearDown(self):
+        self.session.close()
+        self.server.stop()
+
+    def test_keep_alive(self):
+        '''every request goes over the same connection.'''
+        for _ in range(5):
+            self.assertEqual(self.session.get(self.server.url('/doc')).content, 
+                             'document')
+        client_addresses = {address for _, address in self.server.requests}
+        self.assertEqual(len(self.server.requests), 5)
+        self.assertEqual(len(client_addresses), 1)
+
+    def test_backoff(self):
+        response = self.session.get(self.server.url('/flaky'))
+        self.assertEqual(response.content, 'finally')
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_gives_up(self):
+        self.assertRaises(ExternalRequestFailed,
+                          lambda : self.session.get(self.server.url('/down')))
+        self.assertEqual(len(self.server.requests), 4)
+
+    def test_not_found_is_not_retried(self):
+        self.assertEqual(self.session.get(self.server.url('/missing')).status_code, 404)
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_connection_refused(self):
+        url = self.server.url('/doc')
+        self.server.stop()
+        self.assertRaises(ExternalRequestFailed, lambda : self.session.get(url))
+
+    def test_rate_limit(self):
+        '''requests from all threads share one limiter.'''
+        session = HTTPSession(max_requests_per_second=20)
+        start = time.time()
+        concurrent_map(lambda _ : session.get(self.server.url('/doc')), 
+                       range(11), 
+                       workers=4)
+        self.assertGreaterEqual(time.time() - start, .4)
+        request_times = sorted(self.server.request_times)
+        self.assertGreaterEqual(request_times[-1] - request_times[0], .4)
+        self.assertEqual(session.limiter.acquired, 11)
+        session.close()
+
+
+class TokenBucketTestCase(unittest.TestCase):
+    def test_rate(self):
+        bucket = TokenBucket(rate=50)
+        start = time.time()
+        for _ in range(11):
+            bucket.acquire()
+        self.assertGreaterEqual(time.time() - start, .19)
+
+    def test_burst(self):
+        bucket = TokenBucket(rate=1, burst=5)
+        start = time.time()
+        for _ in range(5):
+            bucket.acquire()
+        self.assertLess(time.time() - start, .1)
+
+
+class ConcurrentMapTestCase(unittest.TestCase):
+    def test_order(self):
+        self.assertEqual(concurrent_map(lambda x : x * 2, xrange(20), workers=5),
+                         range(0, 40, 2))
+
+    def test_one_shared_session(self):
+        '''threads asking for the shared session at once all get the same one.'''
+        sessions._session = None
+        init = HTTPSession.__init__
+        def slow_init(session, **kwargs):
+            time.sleep(.05)
+            init(session, **kwargs)
+        with mock.patch.object(HTTPSession, '__init__', slow_init):
+            shared = concurrent_map(lambda _ : sessions.get_session(), range(4), workers=4)
+        self.assertEqual(len(set(map(id, shared))), 1)
@@ -10,12 +10,15 @@ import unittest
 import datetime
 
 from financial_fundamentals.sqlite_drivers import SQLiteTimeseries,\
-    SQLiteIntervalseries, SQLiteDriver
+    SQLiteIntervalseries, SQLiteDriver, SQLiteFilingIndex, SQLiteFactStore,\
+    SQLiteTickerCIKs, SQLiteFieldsTimeseries
 import pytz
 from tests.infrastructure import IntervalseriesTestCase
 from zipline.utils.tradingcalendar import get_trading_days
 from financial_fundamentals.indicies import S_P_500_TICKERS
+from financial_fundamentals.time_series_cache import _resolve_intervals
 import random
+import numpy as np
 from collections import defaultdict
 
 class SQLiteTestCase(unittest.TestCase):
@@ -35,8 +38,7 @@ class SQLiteTimeseriesTestCase(SQLiteTestCase):
         symbol = 'ABC'
         date = datetime.datetime(2012, 12, 1, tzinfo=pytz.UTC)
         price = 6.5
-        self.connection.execute('INSERT INTO {} (symbol, date, metric, value) VALUES (?, ?, ?, ?)'\
-                                .format(self.table), (symbol, date, self.metric, price))
+        self.driver.set(symbol=symbol, records=[(date, price)])
         cache_date, cache_price = self.driver.get(symbol=symbol, dates=[date]).next()
         self.assertEqual(cache_price, price)
         self.assertEqual(cache_date, date)
@@ -45,8 +47,7 @@ class SQLiteTimeseriesTestCase(SQLiteTestCase):
         test_vals = defaultdict(dict)
         for symbol, date in symbol_date_combos:
             price = random.randint(0, 1000)
-            self.connection.execute('INSERT INTO {} (symbol, date, metric, value) VALUES (?, ?, ?, ?)'\
-                                    .format(self.table), (symbol, date, self.metric, price))
+            self.driver.set(symbol=symbol, records=[(date, price)])
             test_vals[symbol][date] = price
         return test_vals
         
@@ -110,14 +111,116 @@ class SQLiteTimeseriesTestCase(SQLiteTestCase):
         start = datetime.datetime(1990, 1,1, tzinfo=pytz.UTC)
         end = datetime.datetime.now(pytz.UTC)
         dates = list(get_trading_days(start, end).to_pydatetime())
-        for price, date in enumerate(dates):
-            self.connection.execute('INSERT INTO {} (symbol, date, metric, value) VALUES (?, ?, ?, ?)'.format(self.table),
-                                    ('ABC', date, self.metric, price))
+        self.driver.set(symbol='ABC', records=[(date, price) for price, date in enumerate(dates)])
         list(self.driver.get(symbol='ABC', dates=dates))
 
+    def test_arrays(self):
+        '''values set as arrays are read by get, NaN as NULL.'''
+        dates = np.array(['2012-12-03', '2012-12-04', '2012-12-05'], dtype='datetime64[ns]')
+        self.driver.set_array(symbol='ABC', dates=dates, values=np.array([1., np.nan, 3.]))
+        stored = dict(self.driver.get(symbol='ABC', 
+                                      dates=[datetime.datetime(2012, 12, 4, tzinfo=pytz.UTC),
+                                             datetime.datetime(2012, 12, 5, tzinfo=pytz.UTC)]))
+        self.assertEqual(stored[datetime.datetime(2012, 12, 5, tzinfo=pytz.UTC)], 3.)
+        self.assertTrue(np.isnan(stored[datetime.datetime(2012, 12, 4, tzinfo=pytz.UTC)]))
+        cached_dates, values = self.driver.get_array(symbol='ABC', dates=dates[1:])
+        np.testing.assert_array_equal(cached_dates, dates[1:])
+        np.testing.assert_array_equal(values, [np.nan, 3.])
+
+    def test_missing(self):
+        dates = np.array(['2012-12-03', '2012-12-04', '2013-01-01'], dtype='datetime64[ns]')
+        self.driver.set_missing(symbol='ABC', dates=dates[:2], checked=100.)
+        self.driver.set_missing(symbol='ABC', dates=dates[1:], checked=200.)
+        missing_dates, checked = self.driver.get_missing(symbol='ABC', dates=dates[:2])
+        np.testing.assert_array_equal(missing_dates, dates[:2])
+        np.testing.assert_array_equal(checked, [100., 200.])
+        _, values = self.driver.get_array(symbol='ABC', dates=dates)
+        self.assertEqual(len(values), 0)
+
+    def test_move_markers(self):
+        ''''NaN' markers stored by older versions, which had no missing table, 
+        become missing dates for every metric.
+        
+        '''
+        date = datetime.datetime(2012, 12, 3, tzinfo=pytz.UTC)
+        self.driver.set(symbol='ABC', records=[(date, 'NaN')])
+        self.driver.set(symbol='XYZ', records=[(date, 1.)])
+        other_driver = SQLiteTimeseries(connection=self.connection, 
+                                        table=self.table, 
+                                        metric='Close')
+        other_driver.set(symbol='XYZ', records=[(date, 'NaN')])
+        self.connection.execute('DROP TABLE {}_missing'.format(self.table))
+        driver = SQLiteTimeseries(connection=self.connection, 
+                                  table=self.table, 
+                                  metric=self.metric)
+        dates = np.array(['2012-12-03'], dtype='datetime64[ns]')
+        missing_dates, checked = driver.get_missing(symbol='ABC', dates=dates)
+        np.testing.assert_array_equal(missing_dates, dates)
+        np.testing.assert_array_equal(checked, [0.])
+        self.assertEqual(len(driver.get_array(symbol='ABC', dates=dates)[0]), 0)
+        self.assertEqual(len(driver.get_array(symbol='XYZ', dates=dates)[0]), 1)
+        missing_dates, _ = other_driver.get_missing(symbol='XYZ', dates=dates)
+        np.testing.assert_array_equal(missing_dates, dates)
+
+    def test_move_markers_once(self):
+        '''opening a table that has a missing table doesn't scan it for markers.'''
+        date = datetime.datetime(2012, 12, 3, tzinfo=pytz.UTC)
+        self.driver.set(symbol='ABC', records=[(date, 'NaN')])
+        driver = SQLiteTimeseries(connection=self.connection, 
+                                  table=self.table, 
+                                  metric=self.metric)
+        dates = np.array(['2012-12-03'], dtype='datetime64[ns]')
+        self.assertEqual(len(driver.get_missing(symbol='ABC', dates=dates)[0]), 0)
+        self.assertEqual(self.connection.execute('SELECT count(*) FROM {}'.format(self.table))\
+                         .fetchone()[0], 1)
+
+    def test_upsert(self):
+        date = datetime.datetime(2012, 12, 3, tzinfo=pytz.UTC)
+        self.driver.set(symbol='ABC', records=[(date, 1.)])
+        self.driver.set(symbol='ABC', records=[(date, 2.)])
+        self.assertEqual(list(self.driver.get(symbol='ABC', dates=[date])), [(date, 2.)])
+
+    def test_migrate(self):
+        '''tables with timestamp dates are rebuilt in place, the last duplicate wins.'''
+        connection = SQLiteDriver.connect(':memory:')
+        connection.execute('CREATE TABLE price (date timestamp, symbol text, metric text, value real)')
+        rows = [(datetime.datetime(2012, 12, 3, tzinfo=pytz.UTC), 'ABC', self.metric, 1.),
+                (datetime.datetime(2012, 12, 4, tzinfo=pytz.UTC), 'ABC', self.metric, 2.),
+                (datetime.datetime(2012, 12, 4, tzinfo=pytz.UTC), 'ABC', self.metric, 3.),
+                (datetime.datetime(2012, 12, 5, tzinfo=pytz.UTC), 'ABC', self.metric, 'NaN'),
+                ]
+        connection.executemany('INSERT INTO price VALUES (?, ?, ?, ?)', rows)
+        connection.commit()
+        driver = SQLiteTimeseries(connection=connection, table='price', metric=self.metric)
+        dates = np.array(['2012-12-03', '2012-12-04', '2012-12-05'], dtype='datetime64[ns]')
+        cached_dates, values = driver.get_array(symbol='ABC', dates=dates)
+        np.testing.assert_array_equal(cached_dates, dates[:2])
+        np.testing.assert_array_equal(values, [1., 3.])
+        missing_dates, _ = driver.get_missing(symbol='ABC', dates=dates)
+        np.testing.assert_array_equal(missing_dates, dates[2:])
+        tables = [row[0] for row in connection.execute("SELECT name FROM sqlite_master WHERE type = 'table'")]
+        self.assertItemsEqual(tables, ['price', 'price_missing'])
+
+class SQLiteFieldsTimeseriesTestCase(SQLiteTestCase):
+    def test_arrays(self):
+        '''every field is stored in one row, setting a date again replaces it.'''
+        driver = SQLiteFieldsTimeseries(connection=self.connection, 
+                                        table='price_fields', 
+                                        fields=['Close', 'Adj Close'])
+        dates = np.array(['2012-12-03', '2012-12-04'], dtype='datetime64[ns]')
+        driver.set_array(symbol='ABC', dates=dates, values=[[1., 2.], [np.nan, np.nan]])
+        driver.set_array(symbol='ABC', dates=dates[:1], values=[[5., 6.]])
+        cached_dates, values = driver.get_array(symbol='ABC', dates=dates)
+        np.testing.assert_array_equal(cached_dates, dates)
+        np.testing.assert_array_equal(values, [[5., 6.], [np.nan, np.nan]])
+        count = self.connection.execute('SELECT COUNT(*) FROM price_fields').fetchone()[0]
+        self.assertEqual(count, 2)
+        _, values = driver.get_array(symbol='XYZ', dates=dates)
+        self.assertEqual(values.shape, (0, 2))
+
 class SQLiteTimestampTestCase(SQLiteTestCase):
     def test_datetime_type_storage(self):
-        '''make sure we can store datetimes in sqlite.'''
+        '''dates are stored as days since the epoch.'''
         conn = self.connection
         table_name, test_value = 'test_table', 'test_value'
         symbol = 'ABC'
@@ -125,12 +228,10 @@ class SQLiteTimestampTestCase(SQLiteTestCase):
         record_date = datetime.datetime(2012, 12, 1, tzinfo=pytz.UTC)
         driver.set(symbol=symbol, records=[(record_date, 100.)])
         result = conn.cursor().execute('select * from {}'.format(table_name)).fetchone()
-        date = result['date']
-        self.assertIsInstance(date, datetime.datetime)
-        self.assertEqual(date.tzinfo, pytz.UTC)
+        self.assertEqual(result['date'], (record_date.date() - datetime.date(1970, 1, 1)).days)
         
         qry = 'select value from {} where date = ?'.format(table_name)
-        results = conn.cursor().execute(qry, (record_date,)).fetchall()
+        results = conn.cursor().execute(qry, (result['date'],)).fetchall()
         self.assertEqual(len(list(results)), 1)
         
 class SQLiteIntervalseriesTestCase(SQLiteTestCase, IntervalseriesTestCase):
@@ -153,6 +254,106 @@ class SQLiteIntervalseriesTestCase(SQLiteTestCase, IntervalseriesTestCase):
                                                           data['end'], 
                                                           self.metric, 
                                                           data[self.metric]))
+
+    def test_unique_start(self):
+        '''setting an interval that starts on a stored start replaces it.'''
+        start = datetime.datetime(2012, 12, 1)
+        self.cache.set_interval(symbol='ABC', start=start, end=None, value=1.)
+        self.cache.set_interval(symbol='ABC', start=start, 
+                                end=datetime.datetime(2012, 12, 31), value=2.)
+        self.assertEqual(self.cache.get_intervals(symbol='ABC'),
+                         [(start, datetime.datetime(2012, 12, 31), 2.)])
+
+    def test_border_date(self):
+        '''a date on the border of two intervals belongs to the earlier one, 
+        as it does when the intervals are resolved in memory.'''
+        border = datetime.datetime(2012, 12, 31)
+        intervals = [(datetime.datetime(2012, 12, 1), border, 1.),
+                     (border, None, 2.)]
+        self.cache.set_intervals(symbol='ABC', intervals=intervals)
+        dates = [datetime.datetime(2012, 12, 1), border, datetime.datetime(2013, 1, 1)]
+        values, _ = _resolve_intervals(self.cache.get_intervals(symbol='ABC'), dates)
+        self.assertEqual(list(values), [1., 1., 2.])
+        self.assertEqual([self.cache.get(symbol='ABC', date=date) for date in dates], 
+                         list(values))
+
+    def test_lookup_uses_key(self):
+        qry = 'EXPLAIN QUERY PLAN ' + self.cache._get_qry.format(table=self.table, op='<')
+        date = datetime.datetime(2012, 12, 1)
+        plan = ' '.join(row[-1] for row in 
+                        self.connection.execute(qry, (self.metric, 'ABC', date, 
+                                                      self.metric, 'ABC', date)))
+        self.assertIn('SEARCH', plan)
+        self.assertNotIn('TEMP B-TREE', plan)
+
+    def test_migrate(self):
+        '''tables without a key are rebuilt, the last duplicate wins.'''
+        connection = SQLiteDriver.connect(':memory:')
+        connection.execute('CREATE TABLE fundamentals (start timestamp, end timestamp, '
+                           'symbol text, metric text, value real)')
+        start = datetime.datetime(2012, 12, 1)
+        connection.executemany('INSERT INTO fundamentals VALUES (?, ?, ?, ?, ?)',
+                               [(start, None, 'ABC', self.metric, 1.),
+                                (start, None, 'ABC', self.metric, 2.)])
+        connection.commit()
+        driver = SQLiteIntervalseries(connection=connection, 
+                                      table='fundamentals', 
+                                      metric=self.metric)
+        self.assertEqual(driver.get_intervals(symbol='ABC'), [(start, None, 2.)])
+
+
+class SQLiteFilingIndexTestCase(SQLiteTestCase):
+    def setUp(self):
+        super(SQLiteFilingIndexTestCase, self).setUp()
+        self.index = SQLiteFilingIndex(connection=self.connection)
+
+    def test_not_indexed(self):
+        self.assertIsNone(self.index.get(ticker='ABC', filing_type='10-Q'))
+
+    def test_no_filings(self):
+        '''a ticker without XBRL filings is indexed too.'''
+        self.index.set(ticker='ABC', filing_type='10-Q', filings=[])
+        self.assertEqual(self.index.get(ticker='ABC', filing_type='10-Q'), [])
+
+    def test_set(self):
+        filings = [(datetime.date(2013, 1, 1), '123', 'http://sec.gov/abc-20130101.xml'),
+                   (datetime.date(2012, 10, 1), '123', 'http://sec.gov/abc-20121001.xml')]
+        self.index.set(ticker='ABC', filing_type='10-Q', filings=filings)
+        self.index.set(ticker='ABC', filing_type='10-Q', filings=filings[:1])
+        self.assertEqual(self.index.get(ticker='ABC', filing_type='10-Q'),
+                         sorted(filings))
+        self.assertIsNone(self.index.get(ticker='ABC', filing_type='10-K'))
+
+
+class SQLiteTickerCIKsTestCase(SQLiteTestCase):
+    def test_get_set(self):
+        ticker_ciks = SQLiteTickerCIKs(connection=self.connection)
+        self.assertIsNone(ticker_ciks.get('AAPL'))
+        ticker_ciks.set([('AAPL', 320193, 'Apple Inc.'), ('BRK-B', 1067983, None)])
+        self.assertEqual(ticker_ciks.get('AAPL'), 320193)
+        # a reused ticker points at the new company.
+        ticker_ciks.set([('AAPL', 123, 'Not Apple')])
+        self.assertEqual(ticker_ciks.get('AAPL'), 123)
+        self.assertEqual(ticker_ciks.get('BRK-B'), 1067983)
+
+
+class SQLiteFactStoreTestCase(SQLiteTestCase):
+    def setUp(self):
+        super(SQLiteFactStoreTestCase, self).setUp()
+        self.store = SQLiteFactStore(connection=self.connection)
+
+    def test_not_stored(self):
+        self.assertIsNone(self.store.get(xbrl_url='http://sec.gov/abc.xml', tags=['Assets']))
+
+    def test_set(self):
+        url = 'http://sec.gov/abc.xml'
+        facts = [('Liabilities', None, datetime.date(2012, 12, 31), 'USD', 50.),
+                 ('EPS', datetime.date(2012, 10, 1), datetime.date(2012, 12, 31), 'USD_per_share', 1.5),
+                 ('Assets', None, datetime.date(2012, 12, 31), 'USD', 100.),
+                 ('EPS', datetime.date(2012, 7, 1), datetime.date(2012, 12, 31), 'USD_per_share', 3.)]
+        self.store.set(xbrl_url=url, facts=facts)
+        self.assertEqual(self.store.get(xbrl_url=url, tags=['EPS', 'Assets']), facts[1:])
+        self.assertEqual(self.store.get(xbrl_url=url, tags=['Goodwill']), [])
         
 if __name__ == '__main__':
     suite = unittest.TestSuite()
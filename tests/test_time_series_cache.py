@@ -7,7 +7,7 @@ Created on Sep 12, 2013
 
 import unittest
 from financial_fundamentals.time_series_cache import FinancialDataTimeSeriesCache,\
-    FinancialIntervalCache
+    FinancialIntervalCache, FinancialDataFieldsCache
 import datetime
 import pytz
 import pandas as pd
@@ -15,9 +15,11 @@ import pandas as pd
 from financial_fundamentals.mongo_drivers import MongoTimeseries,\
     MongoIntervalseries
 from financial_fundamentals import prices
+from financial_fundamentals.prices import PriceSource
 from tests.test_mongo_drivers import MongoTestCase
 from tests.infrastructure import turn_on_request_caching
-from financial_fundamentals.sqlite_drivers import SQLiteTimeseries
+from financial_fundamentals.sqlite_drivers import SQLiteTimeseries,\
+    SQLiteFieldsTimeseries
 import numpy as np
 
 class FinancialDataTimeSeriesCacheTestCase(MongoTestCase, unittest.TestCase):
@@ -28,10 +30,13 @@ class FinancialDataTimeSeriesCacheTestCase(MongoTestCase, unittest.TestCase):
     def test_load_from_cache(self):
         cache = FinancialDataTimeSeriesCache(gets_data=None, database=None)
         test_date, test_price = datetime.datetime(2012, 12, 3, tzinfo=pytz.UTC), 100
-        cache.get = lambda *args, **kwargs : [(test_date, test_price),
-                                              (datetime.datetime(2012, 12, 4, tzinfo=pytz.UTC), 101),
-                                              (datetime.datetime(2012, 12, 5, tzinfo=pytz.UTC), 102),
-                                              ]
+        def get_array(symbol, dates):
+            values = np.empty(len(dates))
+            values.fill(np.nan)
+            values[dates.searchsorted(np.array(['2012-12-03', '2012-12-04', '2012-12-05'],
+                                               dtype='datetime64[ns]'))] = [test_price, 101, 102]
+            return values
+        cache.get_array = get_array
         symbol = 'ABC'
         df = cache.load_from_cache(start=datetime.datetime(2012, 11, 30, tzinfo=pytz.UTC),
                                    end=datetime.datetime(2013, 1, 1, tzinfo=pytz.UTC),
@@ -94,10 +99,12 @@ class FinancialDataTimeSeriesCacheTestCase(MongoTestCase, unittest.TestCase):
                                    start=datetime.datetime(2012, 12, 1, tzinfo=pytz.UTC),
                                    end=datetime.datetime(2012, 12, 31, tzinfo=pytz.UTC))
         self.assertEqual(df['SPX'][datetime.datetime(2012, 12, 3, tzinfo=pytz.UTC)], 1409.46)
-        
+
+
+class FinancialDataTimeSeriesCacheArrayTestCase(unittest.TestCase):
     def test_nan_insertion(self):
         '''when the external data source returns a subset of the requested dates
-        NaNs are inserted into the database for the dates not returned.
+        the dates not returned are recorded as missing.
         '''
         connection = SQLiteTimeseries.connect(':memory:')
         driver = SQLiteTimeseries(connection=connection, 
@@ -112,14 +119,129 @@ class FinancialDataTimeSeriesCacheTestCase(MongoTestCase, unittest.TestCase):
                           }
         requested_dates = missing_dates | returned_dates
         mock_yahoo = mock.Mock()
-        mock_yahoo.return_value = ((date, 10.) for date in returned_dates)
+        mock_yahoo.return_value = (np.array(sorted(date.replace(tzinfo=None) for 
+                                                   date in returned_dates),
+                                            dtype='datetime64[ns]'),
+                                   np.repeat(10., len(returned_dates)))
         cache = FinancialDataTimeSeriesCache(gets_data=mock_yahoo, database=driver)
         cached_values = list(cache.get(symbol=symbol, dates=list(requested_dates)))
-        db_val = connection.execute("SELECT value FROM price WHERE date = '{}'".format(missing_date)).next()
-        self.assertEqual(db_val['value'], 'NaN')
+        stored_missing, checked = driver.get_missing(symbol=symbol, 
+                                                     dates=np.array([missing_date.replace(tzinfo=None)],
+                                                                    dtype='datetime64[ns]'))
+        np.testing.assert_array_equal(stored_missing, 
+                                      np.array(['2012-12-04'], dtype='datetime64[ns]'))
+        self.assertFalse(np.isnan(checked[0]))
         cache_value_dict = {date : value for date, value in cached_values}
         assert np.isnan(cache_value_dict[missing_date])
 
+    def test_get_array(self):
+        '''cached dates aren't fetched again, values come back aligned to dates.'''
+        driver = SQLiteTimeseries(connection=SQLiteTimeseries.connect(':memory:'), 
+                                  table='price', 
+                                  metric='Adj Close')
+        source = mock.Mock(return_value=(np.array(['2012-12-03', '2012-12-04'], 
+                                                  dtype='datetime64[ns]'),
+                                         np.array([1., 2.])))
+        cache = FinancialDataTimeSeriesCache(gets_data=source, database=driver)
+        dates = pd.DatetimeIndex(['2012-12-04', '2012-12-03'], tz='UTC')
+        np.testing.assert_array_equal(cache.get_array(symbol='ABC', dates=dates), [2., 1.])
+        np.testing.assert_array_equal(cache.get_array(symbol='ABC', dates=dates), [2., 1.])
+        self.assertEqual(source.call_count, 1)
+
+    def test_missing_ranges(self):
+        '''each gap is fetched on its own, only rows that aren't stored are written.'''
+        connection = SQLiteTimeseries.connect(':memory:')
+        driver = SQLiteTimeseries(connection=connection, table='price', metric='Adj Close')
+        dates = np.array(['2012-12-03', '2012-12-04', '2012-12-05', 
+                          '2012-12-06', '2012-12-07'], dtype='datetime64[ns]')
+        driver.set_array(symbol='ABC', dates=dates[1:4], values=[2., 3., 4.])
+        def source(symbol, dates):
+            # like yahoo, return the whole week whatever is asked for.
+            return week, np.arange(1., 6.)
+        week = dates
+        source = mock.Mock(side_effect=source)
+        cache = FinancialDataTimeSeriesCache(gets_data=source, database=driver)
+        values = cache.get_array(symbol='ABC', dates=dates[::-1])
+        np.testing.assert_array_equal(values, [5., 4., 3., 2., 1.])
+        self.assertEqual([list(call[0][1]) for call in source.call_args_list],
+                         [[dates[0]], [dates[4]]])
+        count = connection.execute('SELECT COUNT(*) FROM price').fetchone()[0]
+        self.assertEqual(count, len(dates))
+
+    def test_memory_tier(self):
+        '''a repeated load doesn't read the database again.'''
+        driver = mock.Mock(wraps=SQLiteTimeseries(connection=SQLiteTimeseries.connect(':memory:'), 
+                                                  table='price', 
+                                                  metric='Adj Close'))
+        source = mock.Mock(return_value=(np.array(['2012-12-03'], dtype='datetime64[ns]'),
+                                         np.array([1.])))
+        cache = FinancialDataTimeSeriesCache(gets_data=source, database=driver)
+        cache.use_memory_tier()
+        dates = pd.DatetimeIndex(['2012-12-03'], tz='UTC')
+        cache.get_array(symbol='ABC', dates=dates) # fetching and storing invalidates.
+        cache.get_array(symbol='ABC', dates=dates)
+        reads = driver.get_array.call_count
+        for _ in range(3):
+            np.testing.assert_array_equal(cache.get_array(symbol='ABC', dates=dates), [1.])
+        self.assertEqual(driver.get_array.call_count, reads)
+
+    def test_missing_ttls(self):
+        '''recent missing dates are asked for again once their ttl passes, old ones aren't.'''
+        driver = SQLiteTimeseries(connection=SQLiteTimeseries.connect(':memory:'), 
+                                  table='price', 
+                                  metric='Adj Close')
+        today = np.datetime64(datetime.date.today()).astype('datetime64[ns]')
+        old, recent = np.datetime64('2012-12-25', 'ns'), today - np.timedelta64(1, 'D')
+        driver.set_missing(symbol='ABC', dates=np.array([old, recent]), checked=0.)
+        source = mock.Mock(return_value=(np.array([recent]), np.array([2.])))
+        cache = FinancialDataTimeSeriesCache(gets_data=source, database=driver)
+        values = cache.get_array(symbol='ABC', dates=np.array([old, recent]))
+        self.assertTrue(np.isnan(values[0]))
+        self.assertEqual(values[1], 2.)
+        self.assertEqual(list(source.call_args[0][1]), [recent])
+        # a fresh missing date isn't asked for.
+        driver.set_missing(symbol='ABC', dates=np.array([today]))
+        self.assertTrue(np.isnan(cache.get_array(symbol='ABC', dates=np.array([today]))[0]))
+        self.assertEqual(source.call_count, 1)
+
+    def test_warm(self):
+        '''symbols are fetched in one batch, cached symbols aren't fetched.'''
+        driver = SQLiteTimeseries(connection=SQLiteTimeseries.connect(':memory:'), 
+                                  table='price', 
+                                  metric='Adj Close')
+        dates = np.array(['2012-12-03', '2012-12-04'], dtype='datetime64[ns]')
+        driver.set_array(symbol='XYZ', dates=dates, values=[1., 2.])
+        source = mock.Mock(spec=PriceSource)
+        source.get_many.return_value = {'ABC' : (dates, np.array([3., 4.]))}
+        cache = FinancialDataTimeSeriesCache(gets_data=source, database=driver)
+        cache.warm(symbols=['ABC', 'XYZ', 'NOPE'], dates=dates)
+        _, kwargs = source.get_many.call_args
+        self.assertEqual(sorted(kwargs['symbols']), ['ABC', 'NOPE'])
+        np.testing.assert_array_equal(cache.get_array(symbol='ABC', dates=dates), [3., 4.])
+        self.assertFalse(source.called)
+
+class FinancialDataFieldsCacheTestCase(unittest.TestCase):
+    def test_load_from_cache(self):
+        '''fields come from one download, asking for more doesn't download again.'''
+        driver = SQLiteFieldsTimeseries(connection=SQLiteFieldsTimeseries.connect(':memory:'), 
+                                        table='price_fields', 
+                                        fields=['Close', 'Volume', 'Adj Close'])
+        def source(symbol, dates):
+            return dates, np.array([[10., 1000., 9.]] * len(dates))
+        source = mock.Mock(side_effect=source)
+        cache = FinancialDataFieldsCache(gets_data=source, database=driver)
+        start = datetime.datetime(2012, 12, 3, tzinfo=pytz.UTC)
+        end = datetime.datetime(2012, 12, 7, tzinfo=pytz.UTC)
+        panel = cache.load_from_cache(stocks=['ABC'], fields=['Adj Close'], 
+                                      start=start, end=end)
+        self.assertIsInstance(panel, pd.Panel)
+        self.assertEqual(list(panel.minor_axis), ['Adj Close'])
+        self.assertEqual(panel['ABC']['Adj Close'][start], 9.)
+        panel = cache.load_from_cache(stocks=['ABC'], start=start, end=end)
+        self.assertEqual(list(panel.minor_axis), ['Close', 'Volume', 'Adj Close'])
+        self.assertEqual(panel['ABC']['Volume'][end], 1000.)
+        self.assertEqual(source.call_count, 1)
+
         
 import mock
 class FinancialDataRangesCacheTestCase(unittest.TestCase):
@@ -133,21 +255,117 @@ class FinancialDataRangesCacheTestCase(unittest.TestCase):
         symbol = 'ABC'
         date = datetime.datetime(2012, 12, 1)
         value = 100.
-        self.mock_db.get.return_value = value
-        cache_value = self.date_range_cache.get(symbol=symbol, dates=[date]).next()
+        self.mock_db.get_intervals.return_value = [(datetime.datetime(2012, 11, 1),
+                                                    datetime.datetime(2012, 12, 31),
+                                                    value)]
+        cache_value = self.date_range_cache.get(symbol=symbol, dates=[date])[0]
         self.assertEqual(cache_value, value)
 
         
     def test_cache_miss(self):
         symbol = 'ABC'
         date = datetime.datetime(2012, 12, 1)
-        self.mock_db.get.return_value = None
+        self.mock_db.get_intervals.return_value = []
         mock_get_set = mock.Mock()
+        mock_get_set.return_value = 100.
         self.date_range_cache._get_set = mock_get_set
-        self.mock_db.get.return_value = None
-        self.date_range_cache.get(symbol=symbol, dates=[date]).next()
+        self.date_range_cache.get(symbol=symbol, dates=[date])
         mock_get_set.assert_called_once_with(symbol=symbol, date=date)
 
+    def test_vectorized_get(self):
+        '''values come back aligned to the dates, borders belong to the earlier interval.'''
+        self.mock_db.get_intervals.return_value = [
+                    (datetime.datetime(2012, 10, 1, tzinfo=pytz.UTC),
+                     datetime.datetime(2012, 11, 1, tzinfo=pytz.UTC),
+                     1.),
+                    (datetime.datetime(2012, 11, 1, tzinfo=pytz.UTC),
+                     None,
+                     2.)]
+        dates = [datetime.datetime(2012, 12, 3, tzinfo=pytz.UTC),
+                 datetime.datetime(2012, 10, 15, tzinfo=pytz.UTC),
+                 datetime.datetime(2012, 11, 1, tzinfo=pytz.UTC),
+                 datetime.datetime(2012, 11, 2, tzinfo=pytz.UTC)]
+        values = self.date_range_cache.get(symbol='ABC', dates=dates)
+        self.assertIsInstance(values, np.ndarray)
+        self.assertListEqual(list(values), [2., 1., 1., 2.])
+        self.assertFalse(self.mock_data_getter.called)
+
+    def test_one_miss_per_interval(self):
+        '''dates covered by the interval set on a miss are not misses.'''
+        intervals = []
+        def get_set(symbol, date):
+            intervals.append((datetime.datetime(2012, 12, 1),
+                              datetime.datetime(2012, 12, 31),
+                              5.))
+            return 5.
+        mock_get_set = mock.Mock(side_effect=get_set)
+        self.date_range_cache._get_set = mock_get_set
+        self.mock_db.get_intervals.side_effect = lambda symbol : intervals
+        dates = [datetime.datetime(2012, 12, day) for day in range(3, 8)]
+        values = self.date_range_cache.get(symbol='ABC', dates=dates)
+        self.assertEqual(mock_get_set.call_count, 1)
+        self.assertListEqual(list(values), [5.] * len(dates))
+
+    def test_backfill(self):
+        '''the first miss sets every interval, later misses don't backfill again.'''
+        cached_intervals = []
+        def set_intervals(symbol, intervals):
+            cached_intervals.extend(intervals)
+        self.mock_db.get_intervals.side_effect = lambda symbol : sorted(cached_intervals)
+        self.mock_db.set_intervals.side_effect = set_intervals
+        get_all_data = mock.Mock(return_value=[(datetime.date(2012, 10, 1), 1., datetime.date(2012, 11, 1)),
+                                               (datetime.date(2012, 11, 1), 2., None)])
+        cache = FinancialIntervalCache(get_data=self.mock_data_getter,
+                                       database=self.mock_db,
+                                       get_all_data=get_all_data)
+        dates = [datetime.datetime(2012, 10, 15, tzinfo=pytz.UTC),
+                 datetime.datetime(2012, 12, 3, tzinfo=pytz.UTC)]
+        values = cache.get(symbol='ABC', dates=dates)
+        self.assertListEqual(list(values), [1., 2.])
+        self.assertEqual(len(cached_intervals), 2)
+        self.assertFalse(self.mock_data_getter.called)
+        
+        self.mock_data_getter.return_value = (datetime.date(2012, 9, 1), 
+                                              .5, 
+                                              datetime.date(2012, 10, 1))
+        cache.get(symbol='ABC', dates=[datetime.datetime(2012, 9, 15, tzinfo=pytz.UTC)])
+        get_all_data.assert_called_once_with(symbol='ABC')
+        self.assertTrue(self.mock_data_getter.called)
+
+    def test_refresh(self):
+        '''the open interval is closed at the first new filing.'''
+        get_new_data = mock.Mock(side_effect=lambda symbol : \
+            [(datetime.date(2013, 4, 24), 2., None),
+             (datetime.date(2013, 1, 24), 1., datetime.date(2013, 4, 24))] if \
+            symbol == 'ABC' else [])
+        self.mock_db.get_intervals.return_value = []
+        cache = FinancialIntervalCache(get_data=self.mock_data_getter,
+                                       database=self.mock_db,
+                                       get_new_data=get_new_data)
+        cache.refresh(['ABC', 'XYZ'])
+        self.mock_db.close_interval.assert_called_once_with(
+                            symbol='ABC', 
+                            end=datetime.datetime(2013, 1, 24, tzinfo=pytz.UTC))
+        _, kwargs = self.mock_db.set_intervals.call_args
+        self.assertEqual([value for _, _, value in kwargs['intervals']], [1., 2.])
+        self.assertFalse(self.mock_data_getter.called)
+
+    def test_backfill_batches(self):
+        '''only new intervals are written, batch_size at a time.'''
+        self.mock_db.get_intervals.side_effect = lambda symbol : \
+            [(datetime.datetime(2012, 1, 1), datetime.datetime(2012, 2, 1), 1.)] if \
+            symbol == 'ABC' else []
+        intervals = [(datetime.date(2012, month, 1), float(month), 
+                      datetime.date(2012, month + 1, 1)) for month in range(1, 6)]
+        cache = FinancialIntervalCache(get_data=self.mock_data_getter,
+                                       database=self.mock_db)
+        cache.backfill([('ABC', intervals), ('XYZ', intervals)], batch_size=2)
+        batches = [(kwargs['symbol'], len(kwargs['intervals'])) for _, kwargs in 
+                   self.mock_db.set_intervals.call_args_list]
+        self.assertEqual(batches, [('ABC', 2), ('ABC', 2), 
+                                   ('XYZ', 2), ('XYZ', 2), ('XYZ', 1)])
+        self.assertFalse(self.mock_data_getter.called)
+
 
 class MongoDataRangesIntegrationTestCase(MongoTestCase):
     metric = 'price'
@@ -170,7 +388,7 @@ class MongoDataRangesIntegrationTestCase(MongoTestCase):
         self.mock_getter.return_value = (range_start,
                                          price,
                                          range_end)
-        cache_price = self.cache.get(symbol=symbol, dates=[date]).next()
+        cache_price = self.cache.get(symbol=symbol, dates=[date])[0]
         self.assertEqual(cache_price, price)
         self.assertEqual(self.collection.find({'start' : range_start,
                                                'end' : range_end,
@@ -7,19 +7,20 @@ import unittest
 import xmltodict
 import os
 from tests.infrastructure import TEST_DOCS_DIR, turn_on_request_caching
-from financial_fundamentals.xbrl import XBRLDocument
+from financial_fundamentals.xbrl import XBRLDocument, parse_instance,\
+    extract_concurrently
+from financial_fundamentals.accounting_metrics import QuarterlyEPS, AnnualEPS
+from financial_fundamentals.sqlite_drivers import SQLiteFactStore
 import datetime
 import mock
 
+TEST_FILING_PATH = os.path.join(TEST_DOCS_DIR, 'aapl-20121229.xml')
+
 class Test(unittest.TestCase):
     def setUp(self):
         turn_on_request_caching()
-        test_filing_path = os.path.join(TEST_DOCS_DIR, 'aapl-20121229.xml')
-        with open(test_filing_path) as f:
-            test_statement_xml_dict = xmltodict.parse(f.read())
-            self.xbrl_dict = test_statement_xml_dict['xbrl']
         self.xbrl_doc = XBRLDocument(None)
-        self.xbrl_doc._xbrl_dict_ = self.xbrl_dict
+        self.xbrl_doc._open = lambda : open(TEST_FILING_PATH, 'rb')
 
     def test_context_dates(self):
         context_id = 'eol_PE2035----1210-Q0013_STD_98_20111231_0'
@@ -29,15 +30,94 @@ class Test(unittest.TestCase):
 
     def test_document_downloading(self):
         doc = XBRLDocument('http://www.sec.gov/Archives/edgar/data/320193/000119312513022339/aapl-20121229.xml')
-        self.assertDictEqual(doc._xbrl_dict, self.xbrl_dict)
-        
+        metric = mock.Mock()
+        metric.xbrl_tags = ['us-gaap:EarningsPerShareDiluted']
+        self.assertEqual(doc.latest_metric_value(metric),
+                         self.xbrl_doc.latest_metric_value(metric))
+
     def test_get_most_recent_metric_value(self):
         metric = mock.Mock()
         metric.xbrl_tags = ['us-gaap:EarningsPerShareDiluted']
         self.assertEqual(self.xbrl_doc.latest_metric_value(metric),
                          13.81)
-        
+
+    def test_matches_xmltodict(self):
+        '''streaming extraction gives the values we got from the whole document.'''
+        with open(TEST_FILING_PATH) as f:
+            xbrl_dict = xmltodict.parse(f.read())['xbrl']
+        context_start_dates = {}
+        for context in xbrl_dict['context']:
+            period = context['period']
+            if 'startDate' in period:
+                context_start_dates[context['@id']] = period['startDate']
+        tags = ['us-gaap:EarningsPerShareBasic',
+                'us-gaap:SalesRevenueNet',
+                'us-gaap:NetIncomeLoss']
+        for tag in tags:
+            nodes = [node for node in xbrl_dict[tag] if
+                     node['@contextRef'] in context_start_dates]
+            expected = sorted(nodes,
+                              key=lambda node : context_start_dates[node['@contextRef']],
+                              reverse=True)[0]
+            metric = mock.Mock()
+            metric.xbrl_tags = [tag]
+            self.assertEqual(self.xbrl_doc.latest_metric_value(metric),
+                             float(expected['#text']))
+
+    def test_extract(self):
+        '''several metrics come out of one pass over the document.'''
+        opens = []
+        self.xbrl_doc._open = lambda : opens.append(1) or open(TEST_FILING_PATH, 'rb')
+        eps, sales, missing = mock.Mock(), mock.Mock(), mock.Mock()
+        eps.xbrl_tags = ['us-gaap:EarningsPerShareBasicAndDiluted',
+                         'us-gaap:EarningsPerShareDiluted']
+        sales.xbrl_tags = ['us-gaap:SalesRevenueNet']
+        missing.xbrl_tags = ['us-gaap:NotATag']
+        values = self.xbrl_doc.extract([eps, sales, missing])
+        self.assertEqual(len(opens), 1)
+        self.assertEqual(values[eps], 13.81)
+        self.assertIn(sales, values)
+        self.assertNotIn(missing, values)
+
+    def test_fact_store(self):
+        '''a stored document is not downloaded again, new metrics come from the store.'''
+        fact_store = SQLiteFactStore(connection=SQLiteFactStore.connect(':memory:'))
+        self.xbrl_doc._xbrl_url = 'http://sec.gov/aapl-20121229.xml'
+        self.xbrl_doc._fact_store = fact_store
+        eps, sales = mock.Mock(), mock.Mock()
+        eps.xbrl_tags = ['us-gaap:EarningsPerShareDiluted']
+        sales.xbrl_tags = ['us-gaap:SalesRevenueNet']
+        self.assertEqual(self.xbrl_doc.extract([eps]), {eps : 13.81})
+
+        stored_doc = XBRLDocument('http://sec.gov/aapl-20121229.xml')
+        stored_doc._fact_store = fact_store
+        stored_doc._open = mock.Mock(side_effect=AssertionError('downloaded'))
+        parsed_doc = XBRLDocument(None)
+        parsed_doc._open = lambda : open(TEST_FILING_PATH, 'rb')
+        self.assertEqual(stored_doc.extract([eps, sales]), 
+                         parsed_doc.extract([eps, sales]))
+
+    def test_only_referenced_contexts(self):
+        with open(TEST_FILING_PATH, 'rb') as f:
+            facts, contexts = parse_instance(f, tags=['us-gaap:EarningsPerShareDiluted'])
+        self.assertListEqual(facts.keys(), ['us-gaap:EarningsPerShareDiluted'])
+        self.assertSetEqual(set(contexts),
+                            {context_ref for context_ref, _, _ in
+                             facts['us-gaap:EarningsPerShareDiluted']})
+
+    def test_extract_concurrently(self):
+        '''documents parsed in other processes come back in order.'''
+        with open(TEST_FILING_PATH, 'rb') as f:
+            content = f.read()
+        contents = [content, '<xbrl/>', content]
+        metrics = [QuarterlyEPS, AnnualEPS]
+        expected = self.xbrl_doc.extract(metrics)
+        self.assertEqual(list(extract_concurrently(contents, metrics, processes=2)),
+                         [expected, {}, expected])
+        self.assertEqual(list(extract_concurrently(contents, metrics, processes=1)),
+                         [expected, {}, expected])
+
 
 if __name__ == "__main__":
     #import sys;sys.argv = ['', 'Test.testName']
-    unittest.main()
\ No newline at end of file
+    unittest.main()